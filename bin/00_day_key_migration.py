@@ -0,0 +1,148 @@
+#!/bin/python
+#
+# DAY KEY MIGRATION
+# =================
+#
+# This executable renumbers the keys of `dimension.day` as yyyymmdd numbers,
+# for instance 20200401 for 2020-04-01, and updates every column referencing
+# them, such as the `*_day_key` columns of the daily fact tables. It should be
+# run with the Airflow DAGs paused, after which the DAGs can be restarted with
+# `DAY_KEY=yyyymmdd`, computing day keys from timestamps instead of joining
+# them with `dimension.day`.
+#
+# The migration runs in a single transaction. The foreign keys referencing
+# `dimension.day` are dropped, the days are renumbered, each referencing table
+# is rewritten once with its new day keys and the foreign keys are added back
+# as NOT VALID, since the rows are consistent by construction. They can be
+# validated later without blocking writes with
+# `ALTER TABLE ... VALIDATE CONSTRAINT ...`.
+#
+# Days without a date keep their key. Serial keys are far below the yyyymmdd
+# numbers, hence renumbering cannot collide with keys yet to be renumbered.
+#
+
+import logging
+import argparse
+from collections import OrderedDict
+from sqlalchemy import create_engine
+from __init__ import resolve_args
+
+
+def is_migrated(conn):
+    """ Whether all days are already keyed as yyyymmdd numbers. """
+
+    result = conn.execute(
+        f"""
+    SELECT COALESCE(bool_and(key = to_char(day, 'YYYYMMDD')::INTEGER), TRUE)
+    FROM dimension.day
+    WHERE day IS NOT NULL
+    """
+    )
+    return result.scalar()
+
+
+def day_references(conn):
+    """ Foreign keys referencing dimension.day, by referencing table. """
+
+    result = conn.execute(
+        f"""
+    SELECT c.conrelid::REGCLASS::TEXT, c.conname, a.attname, pg_get_constraintdef(c.oid)
+    FROM pg_constraint c
+    JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+    WHERE c.contype = 'f' AND c.confrelid = 'dimension.day'::REGCLASS
+    ORDER BY 1, 2
+    """
+    )
+    references = OrderedDict()
+    for table, name, column, definition in result:
+        references.setdefault(table, []).append((name, column, definition))
+    return references
+
+
+def migrate(conn, dry_run=False):
+    """ Renumber the day keys and the columns referencing them. """
+
+    def execute(sql):
+        logging.info(sql)
+        if not dry_run:
+            conn.execute(sql)
+
+    execute("LOCK TABLE dimension.day IN EXCLUSIVE MODE")
+    execute(
+        """
+    CREATE TEMPORARY TABLE day_key ON COMMIT DROP AS
+    SELECT key AS old, to_char(day, 'YYYYMMDD')::INTEGER AS new
+    FROM dimension.day
+    WHERE day IS NOT NULL AND key != to_char(day, 'YYYYMMDD')::INTEGER
+    """
+    )
+    execute("ALTER TABLE day_key ADD PRIMARY KEY (old)")
+    execute("ANALYZE day_key")
+
+    references = day_references(conn)
+
+    for table, constraints in references.items():
+        for name, column, definition in constraints:
+            execute(f"ALTER TABLE {table} DROP CONSTRAINT {name}")
+
+    execute(
+        """
+    UPDATE dimension.day d SET key = k.new
+    FROM day_key k
+    WHERE d.key = k.old
+    """
+    )
+
+    for table, constraints in references.items():
+        logging.info(f"Updating the day keys of {table}.")
+        columns = sorted({column for _, column, _ in constraints})
+        assignments = ",\n        ".join(
+            f"""{column} = COALESCE(
+            (SELECT new FROM day_key WHERE old = {column}), {column}
+        )"""
+            for column in columns
+        )
+        execute(
+            f"""
+    UPDATE ONLY {table} SET
+        {assignments}
+    """
+        )
+
+    for table, constraints in references.items():
+        for name, column, definition in constraints:
+            if not definition.endswith("NOT VALID"):
+                definition = f"{definition} NOT VALID"
+            execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+
+    return len(references)
+
+
+def main(args):
+
+    engine = create_engine(args.wifi_conn)
+
+    with engine.begin() as conn:
+        if is_migrated(conn):
+            logging.info("dimension.day is already keyed as yyyymmdd numbers.")
+            return
+        logging.info("Renumbering dimension.day keys as yyyymmdd numbers.")
+        n = migrate(conn, args.dry_run)
+
+    if args.dry_run:
+        logging.info(f"Dry run, {n} referencing tables would be updated.")
+    else:
+        logging.info(f"Done, {n} referencing tables updated.")
+
+
+if __name__ == "__main__":
+
+    cli = argparse.ArgumentParser(description="Renumber the day keys.")
+    cli.add_argument(
+        "-d",
+        "--dry-run",
+        action="store_true",
+        help="log the migration statements without running them.",
+    )
+    args = resolve_args(cli)
+    main(args)
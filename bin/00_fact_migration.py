@@ -0,0 +1,157 @@
+#!/bin/python
+#
+# FACT MIGRATION
+# ==============
+#
+# This executable migrates an inheritance based `fact.session` table, in which
+# daily `fact.session_YYYY_MM_DD` tables inherit from `fact.session`, to a
+# table partitioned by range of `session_start`, in which the daily tables are
+# attached as partitions. It should be run with the Airflow DAGs paused, after
+# which the DAGs can be restarted with `FACT_PARTITIONING=range`.
+#
+# The migration runs in a single transaction. The inheritance parent is
+# renamed, a partitioned `fact.session` is created with the same columns, each
+# daily table is detached from the old parent and attached to the new one and
+# the old parent is dropped. Rows stored directly in the old parent, if any,
+# are moved to the new table.
+#
+# The daily tables keep their check constraints, foreign keys and indices.
+# Partitioned tables cannot hold foreign keys or indices on AgensGraph 2.1
+# (PostgreSQL 10), so the new parent has none. Attaching a table scans it once
+# to validate its bounds, as its check constraint does not rule out nulls.
+#
+# Partition pruning only applies to queries that filter `session_start` by
+# constant values, filters on `session_start_day_key` scan every partition.
+#
+# Views depending on `fact.session` would follow the renamed parent, hence the
+# migration stops if there are any, they should be dropped beforehand and
+# re-created afterwards.
+#
+
+import re
+import logging
+import argparse
+import pendulum
+from sqlalchemy import create_engine
+from __init__ import resolve_args
+
+
+def is_partitioned(conn):
+    """ Whether fact.session is already partitioned. """
+
+    result = conn.execute(
+        f"""
+    SELECT c.relkind = 'p'
+    FROM pg_class c JOIN pg_namespace n ON c.relnamespace = n.oid
+    WHERE n.nspname = 'fact' AND c.relname = 'session'
+    """
+    )
+    return result.scalar()
+
+
+def dependent_views(conn):
+    """ Views that depend on fact.session. """
+
+    result = conn.execute(
+        f"""
+    SELECT DISTINCT v.oid::REGCLASS::TEXT
+    FROM pg_depend d
+    JOIN pg_rewrite r ON d.objid = r.oid
+    JOIN pg_class v ON r.ev_class = v.oid
+    WHERE d.refobjid = 'fact.session'::REGCLASS AND v.oid != d.refobjid
+    """
+    )
+    return [name for (name,) in result]
+
+
+def daily_tables(conn, parent):
+    """ Daily tables inheriting from the parent and their dates. """
+
+    result = conn.execute(
+        f"""
+    SELECT c.relname
+    FROM pg_inherits i JOIN pg_class c ON i.inhrelid = c.oid
+    WHERE i.inhparent = '{parent}'::REGCLASS
+    ORDER BY c.relname
+    """
+    )
+    tables = []
+    for (name,) in result:
+        match = re.fullmatch(r"session_(\d{4}_\d{2}_\d{2})", name)
+        if match is None:
+            raise Exception(f"Unexpected table fact.{name} inherits from {parent}.")
+        date = pendulum.from_format(match[1], "YYYY_MM_DD")
+        tables.append((f"fact.{name}", date))
+    return tables
+
+
+def migrate(conn, dry_run=False):
+    """ Migrate fact.session to a range partitioned table. """
+
+    def execute(sql):
+        logging.info(sql)
+        if not dry_run:
+            conn.execute(sql)
+
+    views = dependent_views(conn)
+    if len(views) > 0:
+        raise Exception(f"Drop the views depending on fact.session first: {views}.")
+
+    execute("ALTER TABLE fact.session RENAME TO session_inherited")
+    if dry_run:
+        tables = daily_tables(conn, "fact.session")
+    else:
+        tables = daily_tables(conn, "fact.session_inherited")
+
+    execute(
+        """
+    CREATE TABLE fact.session (
+        LIKE fact.session_inherited INCLUDING DEFAULTS
+    ) PARTITION BY RANGE (session_start)
+    """
+    )
+    for name, date in tables:
+        logging.info(f"Attaching {name}.")
+        date_str = date.format("YYYY-MM-DD")
+        next_date_str = date.add(days=1).format("YYYY-MM-DD")
+        execute(f"ALTER TABLE {name} NO INHERIT fact.session_inherited")
+        execute(
+            f"""
+        ALTER TABLE fact.session ATTACH PARTITION {name}
+        FOR VALUES FROM ('{date_str}') TO ('{next_date_str}')
+        """
+        )
+    execute("INSERT INTO fact.session SELECT * FROM ONLY fact.session_inherited")
+    execute("DROP TABLE fact.session_inherited")
+
+    return len(tables)
+
+
+def main(args):
+
+    engine = create_engine(args.wifi_conn)
+
+    with engine.begin() as conn:
+        if is_partitioned(conn):
+            logging.info("fact.session is already partitioned.")
+            return
+        logging.info("Migrating fact.session to a range partitioned table.")
+        n = migrate(conn, args.dry_run)
+
+    if args.dry_run:
+        logging.info(f"Dry run, {n} daily tables would be attached.")
+    else:
+        logging.info(f"Done, {n} daily tables attached.")
+
+
+if __name__ == "__main__":
+
+    cli = argparse.ArgumentParser(description="Partition the fact table.")
+    cli.add_argument(
+        "-d",
+        "--dry-run",
+        action="store_true",
+        help="log the migration statements without running them.",
+    )
+    args = resolve_args(cli)
+    main(args)
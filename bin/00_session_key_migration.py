@@ -0,0 +1,142 @@
+#!/bin/python
+#
+# SESSION KEY MIGRATION
+# =====================
+#
+# This executable adds a `session_key` column to `fact.session` and fills it
+# in the daily fact tables with a 64-bit hash of the session columns
+# (userid_key, mac_key, ap_key, ssid_key, protocol_key and session_start). It
+# should be run with the Airflow DAGs paused, after which the DAGs can be
+# restarted with `FACT_SESSION_KEY=1`, consolidating sessions by their key
+# instead of comparing the six session columns.
+#
+# The column is added to `fact.session` and, through it, to every daily table.
+# Each daily table is then filled in its own transaction, so the migration can
+# be interrupted and resumed. The session index of each table is rebuilt on
+# the session key, dropping the index on the session columns.
+#
+# The hash must match the one computed at ingest, see `Fact.session_key` in
+# `src/airflow/dags/models.py`. Two sessions of the same day colliding on
+# their key would be consolidated together, which for a million sessions a day
+# happens with a probability in the order of 1e-8.
+#
+# Delta tables hold the sessions to consolidate incrementally by their
+# columns, they are dropped once empty and the migration stops if any still
+# holds sessions, the daily tables should be consolidated beforehand.
+#
+
+import logging
+import argparse
+from sqlalchemy import create_engine
+from __init__ import resolve_args
+
+SESSION_KEY = """('x' || substr(md5(concat_ws('|',
+    userid_key,
+    mac_key,
+    ap_key,
+    ssid_key,
+    protocol_key,
+    to_char(session_start, 'YYYYMMDDHH24MISSUS')
+)), 1, 16))::BIT(64)::BIGINT"""
+
+
+def delta_tables(conn):
+    """ Delta tables of incremental consolidation and whether they are empty. """
+
+    result = conn.execute(
+        f"""
+    SELECT c.oid::REGCLASS::TEXT
+    FROM pg_class c JOIN pg_namespace n ON c.relnamespace = n.oid
+    WHERE n.nspname = 'etl' AND c.relname ~ '^session_delta_[0-9_]+$'
+    ORDER BY 1
+    """
+    )
+    tables = []
+    for (name,) in result.fetchall():
+        empty = conn.execute(f"SELECT NOT EXISTS (SELECT FROM {name})").scalar()
+        tables.append((name, empty))
+    return tables
+
+
+def daily_tables(conn):
+    """ Daily tables of fact.session. """
+
+    result = conn.execute(
+        f"""
+    SELECT c.oid::REGCLASS::TEXT, c.relname
+    FROM pg_inherits i JOIN pg_class c ON i.inhrelid = c.oid
+    WHERE i.inhparent = 'fact.session'::REGCLASS
+    ORDER BY c.relname
+    """
+    )
+    return result.fetchall()
+
+
+def migrate(engine, dry_run=False):
+    """ Add and fill the session key of the daily fact tables. """
+
+    def execute(conn, sql):
+        logging.info(sql)
+        if not dry_run:
+            conn.execute(sql)
+
+    with engine.begin() as conn:
+        deltas = delta_tables(conn)
+        pending = [name for name, empty in deltas if not empty]
+        if len(pending) > 0:
+            raise Exception(f"Consolidate the pending delta tables first: {pending}.")
+        for name, _ in deltas:
+            execute(conn, f"DROP TABLE {name}")
+        execute(
+            conn, "ALTER TABLE fact.session ADD COLUMN IF NOT EXISTS session_key BIGINT"
+        )
+        tables = daily_tables(conn)
+
+    for table, name in tables:
+        logging.info(f"Filling the session key of {table}.")
+        with engine.begin() as conn:
+            execute(
+                conn,
+                f"""
+            UPDATE ONLY {table}
+            SET session_key = {SESSION_KEY}
+            WHERE session_key IS NULL
+            """,
+            )
+            execute(
+                conn,
+                f"""
+            CREATE INDEX IF NOT EXISTS ix_fact_{name}_session_key_pulltime
+            ON {table} (session_key, pulltime)
+            """,
+            )
+            execute(conn, f"DROP INDEX IF EXISTS fact.ix_fact_{name}_session_pulltime")
+            execute(conn, f"ANALYZE {table}")
+
+    return len(tables)
+
+
+def main(args):
+
+    engine = create_engine(args.wifi_conn)
+
+    logging.info("Adding session keys to fact.session.")
+    n = migrate(engine, args.dry_run)
+
+    if args.dry_run:
+        logging.info(f"Dry run, {n} daily tables would be filled.")
+    else:
+        logging.info(f"Done, {n} daily tables filled.")
+
+
+if __name__ == "__main__":
+
+    cli = argparse.ArgumentParser(description="Add session keys to the facts.")
+    cli.add_argument(
+        "-d",
+        "--dry-run",
+        action="store_true",
+        help="log the migration statements without running them.",
+    )
+    args = resolve_args(cli)
+    main(args)
@@ -24,31 +24,69 @@
 # campus. Again more sophisticated modelling would be possible, but for now we
 # will just employ this simple heuristic.
 #
+# The features of each userid-mac pair and day are kept in
+# `dimension.userid_mac_day`: the number of sessions, of short sessions, the
+# longest session duration, and the number of distinct APs and AP locations,
+# computed in a single scan of each daily fact table. Both classifications
+# read these features rather than the facts. By default, every run
+# counts all daily tables again, `--workers` of them in parallel, and
+# classifies all userid-mac pairs. With `--incremental`, only the days
+# consolidated since the previous run are scanned again, after which the pairs
+# and the user days whose statistics changed are classified from these daily
+# statistics, and only the rows whose flags change are updated. Days whose
+# `pull_hours_missing` changes are not picked up, run without `--incremental`
+# to classify all pairs again.
+#
+# The thresholds above are set with `--short-ratio`, `--short-minutes` and
+# `--long-hours`, and are stored with the watermark. An incremental run with
+# other thresholds than the previous run counts all days and classifies all
+# userid-mac pairs again, as a run without `--incremental` and with `--force`.
+#
 
+import time
 import logging
 import argparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import create_engine
 from __init__ import resolve_args
 
 
+USERID_MAC_TABLE = """
+CREATE TABLE IF NOT EXISTS dimension.userid_mac (
+    key SERIAL PRIMARY KEY,
+    userid_key INTEGER REFERENCES dimension.userid(key),
+    mac_key INTEGER REFERENCES dimension.mac(key),
+    day_key INTEGER REFERENCES dimension.day(key),
+    mobile BOOLEAN,
+    main BOOLEAN,
+    UNIQUE(userid_key, mac_key, day_key)
+)
+"""
+
+WATERMARK = "user_mac_classification"
+
+THRESHOLDS = "etl.user_mac_classification"
+
+PAIRS = "SELECT DISTINCT userid_key, mac_key FROM dimension.userid_mac"
+
+STATISTICS = """
+    userid_key,
+    mac_key,
+    day_key,
+    sessions,
+    short_sessions,
+    max_duration,
+    ap_count,
+    location_count
+"""
+
+
 def create_dimension_table(engine):
     """ Create dimension table if it does not exist, insert new userid-mac pairs. """
 
     with engine.begin() as conn:
-        conn.execute(
-            f"""
-        CREATE TABLE IF NOT EXISTS dimension.userid_mac (
-            key SERIAL PRIMARY KEY,
-            userid_key INTEGER REFERENCES dimension.userid(key),
-            mac_key INTEGER REFERENCES dimension.mac(key),
-            day_key INTEGER REFERENCES dimension.day(key),
-            mobile BOOLEAN,
-            main BOOLEAN,
-            UNIQUE(userid_key, mac_key, day_key)
-        )
-        """
-        )
+        conn.execute(USERID_MAC_TABLE)
         conn.execute(
             f"""
         INSERT INTO dimension.userid_mac (
@@ -74,7 +112,7 @@ def create_dimension_table(engine):
         )
 
 
-def classify_as_mobile(engine):
+def classify_as_mobile(engine, args):
     """Classify userid-mac pairs as mobile or not.
 
     Mobile (or always on) devices are those that are present in transitory
@@ -84,45 +122,47 @@ def classify_as_mobile(engine):
     minutes and if none of its sessions lasted over 24 hours. This is a very
     simple heuristic which could eventually be improved with additional
     modelling or empirical work.
+
+    The sessions of each daily fact table are counted in a single scan, on
+    `args.workers` days in parallel, into dimension.userid_mac_day from which
+    the pairs are then classified. The statistics are then up to date for
+    incremental runs.
     """
 
+    with engine.begin() as conn:
+        create_daily_table(conn)
+        # incremental runs start over if this one does not complete
+        conn.execute(f"DELETE FROM etl.watermark WHERE name = '{WATERMARK}'")
+        watermark = next_watermark(conn)
+        days = daily_tables(conn, "SELECT day FROM dimension.day")
+        conn.execute("TRUNCATE dimension.userid_mac_day")
+
+    def count_sessions(day):
+        day_key, day = day
+        with engine.begin() as conn:
+            conn.execute(
+                f"""
+            INSERT INTO dimension.userid_mac_day ({STATISTICS})
+            {day_statistics(day_key, day, args)}
+            """
+            )
+
+    logging.info(f"Counting the sessions of {len(days)} days.")
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(count_sessions, days))
+
     with engine.begin() as conn:
         conn.execute(
             f"""
-        UPDATE dimension.userid_mac AS d SET mobile = FALSE
-        """
-        )
-        conn.execute(
-            f"""
-        UPDATE dimension.userid_mac AS d SET mobile = TRUE
-        FROM (
-            SELECT a.userid_key, a.mac_key
-            FROM (
-                SELECT f.userid_key, f.mac_key, COUNT(*) AS total
-                FROM fact.session f, dimension.day d
-                WHERE
-                    pulltime_last AND
-                    f.session_start_day_key = d.key AND
-                    d.pull_hours_missing = 0
-                GROUP BY userid_key, mac_key
-                HAVING NOT bool_or(session_duration > '24 hours')
-            ) a
-            JOIN (
-                SELECT userid_key, mac_key, COUNT(*) AS total
-                FROM fact.session f, dimension.day d
-                WHERE
-                    f.pulltime_last AND
-                    f.session_duration < '10 minutes' AND
-                    f.session_start_day_key = d.key AND
-                    d.pull_hours_missing = 0
-                GROUP BY userid_key, mac_key
-            ) b
-            ON a.userid_key = b.userid_key AND a.mac_key = b.mac_key
-            WHERE (b.total::FLOAT / a.total::FLOAT) > 0.1
-        ) f
-        WHERE d.userid_key = f.userid_key AND d.mac_key = f.mac_key
+        UPDATE dimension.userid_mac AS u SET mobile = m.mobile
+        FROM ({mobile_pairs(f"({PAIRS})", args)}) m
+        WHERE
+            u.userid_key = m.userid_key AND
+            u.mac_key = m.mac_key AND
+            u.mobile IS DISTINCT FROM m.mobile
         """
         )
+        set_watermark(conn, watermark, args)
 
 
 def classify_as_main(engine):
@@ -135,39 +175,429 @@ def classify_as_main(engine):
     that a user will carry his primary device to most of the places she/he
     visit on campus. Again more sophisticated modelling would be possible, but
     for now we will just employ this simple heuristic.
+
+    The user days are classified from the daily statistics of their pairs,
+    the device with the most sessions is taken as the one that visited the
+    most locations.
     """
 
     with engine.begin() as conn:
         conn.execute(
             f"""
-        UPDATE dimension.userid_mac AS d SET main = FALSE
+        UPDATE dimension.userid_mac AS u
+        SET main = COALESCE(u.mac_key = w.mac_key, FALSE)
+        FROM dimension.userid_mac t
+        LEFT JOIN ({main_macs()}) w
+        ON w.userid_key = t.userid_key AND w.day_key = t.day_key
+        WHERE
+            u.key = t.key AND
+            u.main IS DISTINCT FROM COALESCE(u.mac_key = w.mac_key, FALSE)
+        """
+        )
+
+
+def create_daily_table(conn):
+    """ Create the daily statistics and watermark tables if they do not exist. """
+
+    conn.execute(USERID_MAC_TABLE)
+    conn.execute(
+        f"""
+    CREATE TABLE IF NOT EXISTS dimension.userid_mac_day (
+        userid_key INTEGER REFERENCES dimension.userid(key),
+        mac_key INTEGER REFERENCES dimension.mac(key),
+        day_key INTEGER REFERENCES dimension.day(key),
+        sessions INTEGER,
+        short_sessions INTEGER,
+        max_duration INTERVAL,
+        ap_count INTEGER,
+        location_count INTEGER,
+        PRIMARY KEY (userid_key, mac_key, day_key)
+    )
+    """
+    )
+    conn.execute(
+        f"""
+    CREATE INDEX IF NOT EXISTS ix_dimension_userid_mac_day_day_key
+    ON dimension.userid_mac_day (day_key)
+    """
+    )
+    conn.execute(
+        f"""
+    CREATE TABLE IF NOT EXISTS etl.watermark (
+        name TEXT PRIMARY KEY,
+        value TIMESTAMP
+    )
+    """
+    )
+    conn.execute(
+        f"""
+    CREATE TABLE IF NOT EXISTS {THRESHOLDS} (
+        short_ratio FLOAT,
+        short_minutes FLOAT,
+        long_hours FLOAT
+    )
+    """
+    )
+
+
+def next_watermark(conn, since=None):
+    """The watermark to store once the current run completes, None if no
+    consolidation completed since the previous one.
+
+    The watermark is taken from the consolidations themselves, whose triggered
+    time is in the time of the Airflow database sessions rather than of this
+    one. It stops an hour before the latest consolidation, so that
+    consolidations committed late are not missed.
+    """
+
+    after = "" if since is None else f"AND triggered >= TIMESTAMP '{since}'"
+    return conn.execute(
+        f"""
+    SELECT MAX(triggered) - INTERVAL '1 hour'
+    FROM etl.etl
+    WHERE task_type = 'consolidation'
+    AND status = 'completed'
+    {after}
+    """
+    ).scalar()
+
+
+def set_watermark(conn, watermark, args):
+    """ Store the watermark and thresholds of the next incremental run. """
+
+    if watermark is not None:
+        conn.execute(
+            f"""
+        INSERT INTO etl.watermark VALUES ('{WATERMARK}', '{watermark}')
+        ON CONFLICT (name) DO UPDATE
+        SET value = GREATEST(etl.watermark.value, EXCLUDED.value)
+        """
+        )
+    conn.execute(f"DELETE FROM {THRESHOLDS}")
+    conn.execute(
+        f"""
+    INSERT INTO {THRESHOLDS}
+    VALUES ({args.short_ratio}, {args.short_minutes}, {args.long_hours})
+    """
+    )
+
+
+def thresholds_changed(conn, args):
+    """ Whether the thresholds differ from those of the previous run. """
+
+    thresholds = conn.execute(
+        f"SELECT short_ratio, short_minutes, long_hours FROM {THRESHOLDS}"
+    ).first()
+    return thresholds is None or tuple(thresholds) != (
+        args.short_ratio,
+        args.short_minutes,
+        args.long_hours,
+    )
+
+
+def daily_tables(conn, days):
+    """ Keys and dates of the given days which have a daily fact table. """
+
+    result = conn.execute(
+        f"""
+    SELECT key, day
+    FROM dimension.day
+    WHERE day IN ({days})
+    AND to_regclass('fact.session_' || to_char(day, 'YYYY_MM_DD')) IS NOT NULL
+    ORDER BY day
+    """
+    )
+    return result.fetchall()
+
+
+def day_statistics(day_key, day, args):
+    """ Select the statistics of the userid-mac pairs of a day in one scan. """
+
+    return f"""
+    SELECT
+        f.userid_key,
+        f.mac_key,
+        {day_key} AS day_key,
+        COUNT(*) AS sessions,
+        COUNT(*) FILTER (
+            WHERE f.session_duration < INTERVAL '{args.short_minutes} minutes'
+        ) AS short_sessions,
+        MAX(f.session_duration) AS max_duration,
+        COUNT(DISTINCT f.ap_key) AS ap_count,
+        COUNT(DISTINCT a.path) AS location_count
+    FROM fact.session_{day:%Y_%m_%d} f
+    LEFT JOIN dimension.ap a ON f.ap_key = a.key
+    WHERE f.pulltime_last AND f.session_start_day_key = {day_key}
+    GROUP BY f.userid_key, f.mac_key
+    """
+
+
+def mobile_pairs(pairs, args):
+    """ Select whether the given userid-mac pairs are mobile, from the
+    statistics of their complete days. """
+
+    return f"""
+    SELECT
+        t.userid_key,
+        t.mac_key,
+        COALESCE(
+            MAX(s.max_duration) <= INTERVAL '{args.long_hours} hours'
+            AND SUM(s.short_sessions)::FLOAT / SUM(s.sessions)::FLOAT
+                > {args.short_ratio},
+            FALSE
+        ) AS mobile
+    FROM {pairs} t
+    LEFT JOIN (
+        dimension.userid_mac_day s
+        JOIN dimension.day d
+        ON s.day_key = d.key AND d.pull_hours_missing = 0
+    ) ON s.userid_key = t.userid_key AND s.mac_key = t.mac_key
+    GROUP BY t.userid_key, t.mac_key
+    """
+
+
+def main_macs(user_days=None):
+    """Select the main mac of the given user days, of all user days by
+    default, the mobile mac with the most sessions on complete days."""
+
+    join = ""
+    if user_days is not None:
+        join = f"""
+        JOIN {user_days} t
+        ON s.userid_key = t.userid_key AND s.day_key = t.day_key
         """
+
+    return f"""
+    SELECT DISTINCT ON (s.userid_key, s.day_key)
+        s.userid_key, s.day_key, s.mac_key
+    FROM dimension.userid_mac_day s
+    {join}
+    JOIN dimension.userid_mac u
+    ON
+        u.userid_key = s.userid_key AND
+        u.mac_key = s.mac_key AND
+        u.day_key = s.day_key
+    JOIN dimension.day d ON s.day_key = d.key
+    WHERE u.mobile AND d.pull_hours_missing = 0
+    ORDER BY s.userid_key, s.day_key, s.sessions DESC, s.mac_key
+    """
+
+
+def touched_days(conn):
+    """Days consolidated since the previous incremental run, all days on the
+    first run, and the watermark to store once they are classified.
+    """
+
+    since = conn.execute(
+        f"SELECT value FROM etl.watermark WHERE name = '{WATERMARK}'"
+    ).scalar()
+    watermark = next_watermark(conn, since)
+
+    if since is None:
+        days = f"SELECT day FROM dimension.day"
+    else:
+        days = f"""
+        SELECT task_timestamp::DATE
+        FROM etl.etl
+        WHERE task_type = 'consolidation'
+        AND status = 'completed'
+        AND triggered >= TIMESTAMP '{since}'
+        """
+
+    return daily_tables(conn, days), watermark
+
+
+def update_day(conn, day_key, day, args):
+    """Update the statistics of the userid-mac pairs of a day.
+
+    The pairs whose statistics changed, and those new to dimension.userid_mac,
+    are added to the touched temporary table.
+    """
+
+    conn.execute(
+        f"""
+    CREATE TEMPORARY TABLE day_stats AS
+    {day_statistics(day_key, day, args)}
+    """
+    )
+    conn.execute(
+        f"""
+    WITH removed AS (
+        DELETE FROM dimension.userid_mac_day s
+        WHERE s.day_key = {day_key}
+        AND NOT EXISTS (
+            SELECT FROM day_stats n
+            WHERE n.userid_key = s.userid_key AND n.mac_key = s.mac_key
         )
+        RETURNING s.userid_key, s.mac_key, s.day_key
+    ), upserted AS (
+        INSERT INTO dimension.userid_mac_day AS s ({STATISTICS})
+        SELECT {STATISTICS} FROM day_stats
+        ON CONFLICT (userid_key, mac_key, day_key) DO UPDATE SET
+            sessions = EXCLUDED.sessions,
+            short_sessions = EXCLUDED.short_sessions,
+            max_duration = EXCLUDED.max_duration,
+            ap_count = EXCLUDED.ap_count,
+            location_count = EXCLUDED.location_count
+        WHERE (
+            s.sessions,
+            s.short_sessions,
+            s.max_duration,
+            s.ap_count,
+            s.location_count
+        ) IS DISTINCT FROM (
+            EXCLUDED.sessions,
+            EXCLUDED.short_sessions,
+            EXCLUDED.max_duration,
+            EXCLUDED.ap_count,
+            EXCLUDED.location_count
+        )
+        RETURNING s.userid_key, s.mac_key, s.day_key
+    ), inserted AS (
+        INSERT INTO dimension.userid_mac (
+            userid_key,
+            mac_key,
+            day_key,
+            mobile,
+            main
+        )
+        SELECT n.userid_key, n.mac_key, d.key, FALSE, FALSE
+        FROM day_stats n, dimension.day d
+        WHERE d.key = {day_key} AND d.pull_hours_missing = 0
+        ON CONFLICT DO NOTHING
+        RETURNING userid_key, mac_key, day_key
+    )
+    INSERT INTO touched
+    SELECT * FROM removed
+    UNION SELECT * FROM upserted
+    UNION SELECT * FROM inserted
+    """
+    )
+    conn.execute("DROP TABLE day_stats")
+
+
+def classify_touched(conn, args):
+    """Classify the touched userid-mac pairs as mobile, then the touched user
+    days as main, from the daily statistics.
+
+    User days are touched when the statistics of one of their pairs changed or
+    when one of their pairs changed from or to mobile. Returns the number of
+    rows whose mobile and main flags changed.
+    """
+
+    conn.execute(
+        f"""
+    CREATE TEMPORARY TABLE touched_pairs ON COMMIT DROP AS
+    SELECT DISTINCT userid_key, mac_key FROM touched
+    """
+    )
+    conn.execute("ANALYZE touched_pairs")
+    conn.execute(
+        f"""
+    CREATE TEMPORARY TABLE mobile_changed (
+        userid_key INTEGER,
+        mac_key INTEGER,
+        day_key INTEGER
+    ) ON COMMIT DROP
+    """
+    )
+    conn.execute(
+        f"""
+    WITH changed AS (
+        UPDATE dimension.userid_mac AS u SET mobile = m.mobile
+        FROM ({mobile_pairs("touched_pairs", args)}) m
+        WHERE
+            u.userid_key = m.userid_key AND
+            u.mac_key = m.mac_key AND
+            u.mobile IS DISTINCT FROM m.mobile
+        RETURNING u.userid_key, u.mac_key, u.day_key
+    )
+    INSERT INTO mobile_changed SELECT * FROM changed
+    """
+    )
+    mobile = conn.execute("SELECT COUNT(*) FROM mobile_changed").scalar()
+
+    conn.execute(
+        f"""
+    CREATE TEMPORARY TABLE touched_user_days ON COMMIT DROP AS
+    SELECT userid_key, day_key FROM touched
+    UNION
+    SELECT u.userid_key, u.day_key
+    FROM dimension.userid_mac u
+    JOIN (SELECT DISTINCT userid_key, mac_key FROM mobile_changed) c
+    ON u.userid_key = c.userid_key AND u.mac_key = c.mac_key
+    """
+    )
+    conn.execute("ANALYZE touched_user_days")
+    main = conn.execute(
+        f"""
+    UPDATE dimension.userid_mac AS u
+    SET main = COALESCE(u.mac_key = w.mac_key, FALSE)
+    FROM touched_user_days t
+    LEFT JOIN ({main_macs("touched_user_days")}) w
+    ON w.userid_key = t.userid_key AND w.day_key = t.day_key
+    WHERE
+        u.userid_key = t.userid_key AND
+        u.day_key = t.day_key AND
+        u.main IS DISTINCT FROM COALESCE(u.mac_key = w.mac_key, FALSE)
+    """
+    ).rowcount
+    return mobile, main
+
+
+def classify_incrementally(engine, args):
+    """Classify the userid-mac pairs of the days consolidated since the
+    previous incremental run.
+
+    The run takes place in a single transaction, the watermark only moves
+    once every touched day is classified. All pairs are classified again if
+    the thresholds changed since the previous run.
+    """
+
+    with engine.begin() as conn:
+        create_daily_table(conn)
+        changed = thresholds_changed(conn, args)
+
+    if changed:
+        logging.info("The thresholds changed, classifying all userid-mac pairs.")
+        create_dimension_table(engine)
+        classify_as_mobile(engine, args)
+        classify_as_main(engine)
+        return
+
+    with engine.begin() as conn:
+        days, watermark = touched_days(conn)
+        logging.info(f"Updating the statistics of {len(days)} days.")
+
         conn.execute(
             f"""
-        UPDATE dimension.userid_mac AS u SET main = TRUE
-        FROM (
-            SELECT DISTINCT ON (f.userid_key, f.session_start_day_key) f.userid_key, f.mac_key, f.session_start_day_key
-            FROM fact.session f, dimension.day d, dimension.userid_mac u
-            WHERE
-                pulltime_last AND
-                f.session_start_day_key = d.key AND
-                d.pull_hours_missing = 0 AND
-                u.mobile AND
-                u.userid_key = f.userid_key AND
-                u.mac_key = f.mac_key AND
-                u.day_key = f.session_start_day_key
-            GROUP BY f.userid_key, f.mac_key, f.session_start_day_key
-            ORDER BY f.userid_key, f.session_start_day_key, COUNT(*) DESC, f.mac_key
-        ) f
-        WHERE u.userid_key = f.userid_key AND u.mac_key = f.mac_key AND u.day_key = f.session_start_day_key
+        CREATE TEMPORARY TABLE touched (
+            userid_key INTEGER,
+            mac_key INTEGER,
+            day_key INTEGER
+        ) ON COMMIT DROP
         """
         )
+        for day_key, day in days:
+            logging.info(f"Updating the statistics of {day}.")
+            update_day(conn, day_key, day, args)
+
+        mobile, main = classify_touched(conn, args)
+        logging.info(f"Changed the mobile flag of {mobile} rows, main of {main}.")
+
+        set_watermark(conn, watermark, args)
 
 
 def main(args):
 
-    engine = create_engine(args.wifi_conn)
+    engine = create_engine(args.wifi_conn, pool_size=max(args.workers, 5))
+    start = time.perf_counter()
+
+    if args.incremental:
+        logging.info("Classifying the userid-mac pairs of new days.")
+        classify_incrementally(engine, args)
+        logging.info(f"Done in {time.perf_counter() - start:.1f}s.")
+        return
 
     if args.force:
         logging.info(
@@ -176,10 +606,13 @@ def main(args):
         create_dimension_table(engine)
 
     logging.info("Classifying userid-mac pairs as mobile.")
-    classify_as_mobile(engine)
+    classify_as_mobile(engine, args)
+    logging.info(f"Classified as mobile in {time.perf_counter() - start:.1f}s.")
 
+    start = time.perf_counter()
     logging.info("Classifying userid-mac pairs as main.")
     classify_as_main(engine)
+    logging.info(f"Classified as main in {time.perf_counter() - start:.1f}s.")
 
 
 if __name__ == "__main__":
@@ -191,5 +624,39 @@ if __name__ == "__main__":
         action="store_true",
         help="Re-create dimension table and insert new userid-mac pairs, otherwise just update.",
     )
+    cli.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="only classify the days consolidated since the last incremental run.",
+    )
+    cli.add_argument(
+        "-r",
+        "--short-ratio",
+        default=0.1,
+        type=float,
+        help="fraction of short sessions above which a pair can be mobile.",
+    )
+    cli.add_argument(
+        "-s",
+        "--short-minutes",
+        default=10,
+        type=float,
+        help="duration in minutes under which a session is short.",
+    )
+    cli.add_argument(
+        "-l",
+        "--long-hours",
+        default=24,
+        type=float,
+        help="duration in hours over which a session rules out a mobile pair.",
+    )
+    cli.add_argument(
+        "-w",
+        "--workers",
+        default=1,
+        type=int,
+        help="number of days whose sessions are counted in parallel.",
+    )
     args = resolve_args(cli)
     main(args)
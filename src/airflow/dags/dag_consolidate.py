@@ -18,7 +18,11 @@ def init_callable(**kwargs):
 
 
 def consolidate_callable(**kwargs):
-    """ consolidate session table. """
+    """consolidate session table.
+
+    A final consolidation is recorded as such once completed, so that the
+    date does not get another one.
+    """
 
     task_instance = kwargs["ti"]
     table_config = task_instance.xcom_pull(key="config", task_ids="init")
@@ -27,11 +31,16 @@ def consolidate_callable(**kwargs):
     date = pendulum.from_format(date, "YYYY-MM-DD[T]HH:mm:ss").naive()
 
     table_name = table_config["table_name"]
+    final = table_config.get("final", False)
 
     session = Session()
     try:
-        Fact.consolidate(date)
+        Fact.consolidate(date, final)
         ETL.set_status("consolidation", table_name, date, "completed", session)
+        if final and ETL.can_process("final_consolidation", table_name, date, session):
+            ETL.set_status(
+                "final_consolidation", table_name, date, "completed", session
+            )
         session.close()
     except Exception as e:
         ETL.set_status("consolidation", table_name, date, "quarantine", session)
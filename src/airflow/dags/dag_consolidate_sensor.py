@@ -7,21 +7,69 @@ from airflow import DAG
 from airflow.operators.python import PythonOperator
 from airflow.api.common.experimental.trigger_dag import trigger_dag
 
-from environment import AIRFLOW_DEFAULT_ARGS
+from environment import (
+    AIRFLOW_DEFAULT_ARGS,
+    CONSOLIDATION_CLOSE_AFTER,
+    CONSOLIDATION_MIN_INTERVAL,
+    SENSOR_WATERMARK,
+    TIMEZONE_OFFSET,
+)
 
-from models import Session, ETL
+from models import Session, ETL, Watermark
+
+
+def closed_until(session):
+    """the last closed date, None if no date is closed.
+
+    A date is closed CONSOLIDATION_CLOSE_AFTER hours after its end, counted in
+    pull time up to the pull file watermark with SENSOR_WATERMARK or in local
+    time otherwise.
+    """
+
+    if CONSOLIDATION_CLOSE_AFTER == 0:
+        return None
+    if SENSOR_WATERMARK:
+        until = Watermark.get("pull_file", session)
+        if until is None:
+            return None
+    else:
+        until = pendulum.now("UTC").add(seconds=TIMEZONE_OFFSET).naive()
+    until = until.subtract(hours=CONSOLIDATION_CLOSE_AFTER)
+    return until.start_of("day").subtract(days=1)
 
 
 def sense_callable(**kwargs):
-    """ look for tables to consolidate. """
+    """look for tables to consolidate.
+
+    Dates are consolidated once ready, unless consolidated less than
+    CONSOLIDATION_MIN_INTERVAL minutes ago, in which case they are left for
+    a later tick. Closed dates get a final consolidation once, and again
+    when late files are ingested into them.
+    """
 
     task_instance = kwargs["ti"]
     session = Session()
     dates = ETL.ready_for_consolidation(session)
+
+    final_dates = []
+    closed = closed_until(session)
+    if closed is not None:
+        final_dates = ETL.ready_for_final_consolidation(closed, session)
+        logging.info(f"Dates closed until {closed}, final: {final_dates}.")
+
+    recent = set()
+    if CONSOLIDATION_MIN_INTERVAL > 0:
+        recent = ETL.recently_consolidated(dates, CONSOLIDATION_MIN_INTERVAL, session)
+        logging.info(f"Postponing recently consolidated dates: {sorted(recent)}.")
+
+    dates = sorted((set(dates) - recent) | set(final_dates))
+    table_names = [f"fact.session_{date.format('YYYY_MM_DD')}" for date in dates]
+    can_process = ETL.can_process_many(
+        "consolidation", list(zip(table_names, dates)), session
+    )
     queue = []
 
-    for date in dates:
-        table_name = f"fact.session_{date.format('YYYY_MM_DD')}"
+    for date, table_name, can in zip(dates, table_names, can_process):
         hash = hashlib.sha1()
         hash.update(str(pendulum.now()).encode("utf-8"))
         hex = hash.hexdigest()
@@ -29,10 +77,11 @@ def sense_callable(**kwargs):
             "config": {
                 "date": str(date),
                 "table_name": table_name,
+                "final": closed is not None and date <= closed,
             },
             "run_id": f"{hex[:10]}-consolidation-{date}",
         }
-        if ETL.can_process("consolidation", table_name, date, session):
+        if can:
             queue.append(table_name)
             task_instance.xcom_push(table_name, table_task_dict)
 
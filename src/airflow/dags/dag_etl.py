@@ -1,17 +1,32 @@
-import csv
 import logging
 import pendulum
-import pandas as pd
-import numpy as np
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
 from airflow.utils.state import State
 
-from models import Session, ETL, Fact
+from models import engine, Session, ETL, Fact
 from airflow import DAG
 from airflow.operators.python import PythonOperator
 
-from environment import AIRFLOW_DEFAULT_ARGS, AIRFLOW_IMPORT, RAW_GLOB
+from preprocess import (
+    STAGING_SUFFIXES,
+    DateWriter,
+    DuplicateFilter,
+    LatestPullFilter,
+    assign_keys,
+    read_pull_file,
+    transform,
+)
+from environment import (
+    AIRFLOW_DEFAULT_ARGS,
+    AIRFLOW_IMPORT,
+    INGEST_WORKERS,
+    PREPROCESS_CHUNKSIZE,
+    PREPROCESS_LATEST_ONLY,
+    RAW_GLOB,
+    RESOLVE_KEYS,
+    STAGING_FORMAT,
+)
 
 
 def init_callable(**kwargs):
@@ -23,77 +38,101 @@ def init_callable(**kwargs):
     logging.info(f"File configuration: {file_config}")
 
 
+def batch_files(file_config):
+    """ configurations of the pull files of an etl run. """
+    return file_config.get("batch", [file_config])
+
+
 def preprocess_callable(**kwargs):
-    """ preprocess raw wifi log files. """
+    """preprocess raw wifi log files.
+
+    The pull files of a batch are staged together, in the daily files of the
+    first file of the batch, duplicates are removed across all of them. With
+    PREPROCESS_LATEST_ONLY, only the latest pull of each session is staged.
+    """
 
     task_instance = kwargs["ti"]
     file_config = task_instance.xcom_pull(key="config", task_ids="init")
-    file_name = file_config["file_name"]
     file_stem = file_config["file_stem"]
 
-    columns = [
-        "username",
-        "macaddress",
-        "protocol",
-        "apname",
-        "location",
-        "ssid",
-        "sessionstarttime",
-        "sessionendtime",
-        "pulltime",
-        "rssi",
-    ]
+    session = Session()
 
-    df = pd.read_csv((file_name), header=None, sep="\t", quoting=csv.QUOTE_NONE)
-    df.columns = columns
-    df.fillna("N/A", inplace=True)
+    def can_process(group_file_path, date_str):
+        return ETL.can_process("session_file", f"{group_file_path}", date_str, session)
+
+    # the whole file is read at once, unless a chunk size is configured in
+    # which case duplicates are tracked across chunks and each date file is
+    # appended to incrementally
+    writer = DateWriter(AIRFLOW_IMPORT, file_stem, can_process, STAGING_FORMAT)
+    files = batch_files(file_config)
+    if PREPROCESS_LATEST_ONLY:
+        # the most recent file is read first so that its rows are kept
+        files = files[::-1]
+        remove_duplicates = LatestPullFilter()
+    else:
+        remove_duplicates = DuplicateFilter()
+    rows_before = 0
+    rows_after = 0
+
+    # when keys are resolved by the client, dimension values are replaced by
+    # their keys here and ingest does not need to update the dimensions
+    dimensions = {
+        d.fact_key: list(d.extract_mapping.values()) for d in Fact.dimensions
+    }
+    key_cache_counts = Fact.key_cache_counts()
+
+    for batch_config in files:
+        file_name = batch_config["file_name"]
+        logging.info(f"Preprocessing {file_name}.")
+        for df in read_pull_file(file_name, PREPROCESS_CHUNKSIZE):
+            rows_before += len(df)
+            df = remove_duplicates(transform(df))
+            rows_after += len(df)
+            if RESOLVE_KEYS == "client":
+                df = assign_keys(df, dimensions, Fact.resolve_keys)
+            writer.write(df)
+    writer.close()
+
+    logging.info(f"Original files, number of rows: {rows_before}.")
+    logging.info(f"After removal of duplicates, number of rows: {rows_after}.")
+    if RESOLVE_KEYS == "client":
+        Fact.log_key_caches(key_cache_counts)
 
-    df["sessionstarttime"] = pd.to_datetime(df["sessionstarttime"], unit="ms").dt.floor(
-        "s"
-    )
-    df["sessionendtime"] = pd.to_datetime(df["sessionendtime"], unit="ms").dt.floor("s")
-    df["pulltime"] = pd.to_datetime(df["pulltime"], unit="s")
+    session.close()
 
-    # we add the timezone offset as the data is collected in GMT+00:00
-    timezone_offset = pd.Timedelta("8 hours")
-    df["sessionstarttime"] = df["sessionstarttime"] + timezone_offset
-    df["sessionendtime"] = df["sessionendtime"] + timezone_offset
-    df["pulltime"] = df["pulltime"] + timezone_offset
 
-    logging.info(f"Original file, number of rows: {len(df)}.")
-    df = df[-df.duplicated()]
-    logging.info(f"After removal of duplicates, number of rows: {len(df)}.")
+def ingest_file(file_path, extract_table_name, load_table_name):
+    """ingest a single preprocessed file, keeping track of its etl status.
 
-    # assign null values to missing end time
-    missing_time = pd.to_datetime("2100-01-01 00:00:00") + timezone_offset
-    df.loc[df.sessionendtime == missing_time, "sessionendtime"] = np.nan
+    Returns whether the file had to be quarantined.
+    """
 
-    # save each date in a separate file
+    logging.info(f"Ingesting {file_path}.")
+    date = pendulum.from_format(file_path.stem[23:], "YYYY_MM_DD").naive()
+    quarantined = False
     session = Session()
-    for date, group in df.groupby(df["sessionstarttime"].map(lambda x: x.date())):
-
-        date_str = date.strftime("%Y_%m_%d")
-        group_file_path = Path(AIRFLOW_IMPORT / (f"{file_stem}_{date_str}.csv"))
-
-        if ETL.can_process("session_file", f"{group_file_path}", date_str, session):
-            group.loc[:, "sessionstarttime"] = group["sessionstarttime"].dt.strftime(
-                "%Y-%m-%d %H:%M:%S"
-            )
-            group.loc[:, "sessionendtime"] = group["sessionendtime"].dt.strftime(
-                "%Y-%m-%d %H:%M:%S"
-            )
-            group.loc[group.sessionendtime == "NaT", "sessionendtime"] = ""
-            group.loc[:, "pulltime"] = group["pulltime"].dt.strftime(
-                "%Y-%m-%d %H:%M:%S"
-            )
-            group.to_csv(group_file_path, index=False)
-            logging.info(f"Preprocessed group, {group_file_path}:\n{group.head()}")
-
+    if ETL.can_process("session_file", file_path, date, session):
+        try:
+            ETL.commit_new("session_file", file_path, date, session)
+            Fact.etl(date, file_path.name, extract_table_name, load_table_name)
+            ETL.set_status("session_file", file_path, date, "completed", session)
+        except:
+            logging.exception(f"Failed to ingest {file_path}.")
+            quarantined = True
+            ETL.set_status("session_file", file_path, date, "quarantine", session)
+            # the auxiliary tables are only dropped by a successful etl
+            Fact.remove_auxiliary_tables(extract_table_name, load_table_name)
     session.close()
+    return quarantined
 
 
 def ingest_callable(**kwargs):
-    """ ingest preprocessed wifi log files to database. """
+    """ingest preprocessed wifi log files to database.
+
+    Each file targets a different daily fact table, if more than one ingest
+    worker is configured the files are ingested concurrently by a pool of
+    processes.
+    """
 
     task_instance = kwargs["ti"]
     file_config = task_instance.xcom_pull(key="config", task_ids="init")
@@ -102,43 +141,50 @@ def ingest_callable(**kwargs):
     extract_table_name = file_config["extract_table"]
     load_table_name = file_config["load_table"]
 
-    logging.info(f"Looping through '{file_stem}*.csv'")
-
-    ingest_errors = []
-
-    for file_path in AIRFLOW_IMPORT.glob(f"{file_stem}*.csv"):
-        logging.info(f"Ingesting {file_path}.")
-        date = pendulum.from_format(file_path.stem[23:], "YYYY_MM_DD").naive()
-        session = Session()
-        if ETL.can_process("session_file", file_path, date, session):
-            try:
-                ETL.commit_new("session_file", file_path, date, session)
-                Fact.etl(date, file_path.name, extract_table_name, load_table_name)
-                ETL.set_status("session_file", file_path, date, "completed", session)
-                session.close()
-            except:
-                ingest_errors.append(file_path)
-                ETL.set_status("session_file", file_path, date, "quarantine", session)
-                session.close()
-
-        if len(ingest_errors) > 0:
-            logging.info(f"The following files could not be ingested: {ingest_errors}.")
-            raise Exception(
-                f"A total of {len(ingest_errors)} files could not be ingested. Failing DAG run"
-            )
+    suffix = STAGING_SUFFIXES[STAGING_FORMAT]
+
+    logging.info(f"Looping through '{file_stem}*{suffix}'")
+
+    file_paths = sorted(AIRFLOW_IMPORT.glob(f"{file_stem}*{suffix}"))
+    # every file gets its own auxiliary tables, so that concurrent workers
+    # do not clash with each other
+    tasks = [
+        (
+            file_path,
+            f"{extract_table_name}_{file_path.stem[23:]}",
+            f"{load_table_name}_{file_path.stem[23:]}",
+        )
+        for file_path in file_paths
+    ]
+
+    if INGEST_WORKERS > 1 and len(tasks) > 1:
+        # forked workers must not share the connections of this process
+        engine.dispose()
+        with ProcessPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+            quarantined = list(pool.map(ingest_file, *zip(*tasks)))
+    else:
+        quarantined = [ingest_file(*task) for task in tasks]
+
+    ingest_errors = [f for f, q in zip(file_paths, quarantined) if q]
+
+    if len(ingest_errors) > 0:
+        logging.info(f"The following files could not be ingested: {ingest_errors}.")
+        raise Exception(
+            f"A total of {len(ingest_errors)} files could not be ingested. Failing DAG run"
+        )
 
 
 def fail_callable(**kwargs):
-    """ quarantine file if any previous etl task fails. """
+    """ quarantine files if any previous etl task fails. """
 
     task_instance = kwargs["ti"]
     file_config = task_instance.xcom_pull(key="config", task_ids="init")
 
-    file_name = file_config["file_name"]
-    pulltime = file_config["pulltime"]
-
     session = Session()
-    ETL.set_status("pull_file", file_name, pulltime, "quarantine", session)
+    for batch_config in batch_files(file_config):
+        file_name = batch_config["file_name"]
+        pulltime = batch_config["pulltime"]
+        ETL.set_status("pull_file", file_name, pulltime, "quarantine", session)
     session.close()
 
 
@@ -148,11 +194,11 @@ def success_callable(**kwargs):
     task_instance = kwargs["ti"]
     file_config = task_instance.xcom_pull(key="config", task_ids="init")
 
-    file_name = file_config["file_name"]
-    pulltime = file_config["pulltime"]
-
     session = Session()
-    ETL.set_status("pull_file", file_name, pulltime, "completed", session)
+    for batch_config in batch_files(file_config):
+        file_name = batch_config["file_name"]
+        pulltime = batch_config["pulltime"]
+        ETL.set_status("pull_file", file_name, pulltime, "completed", session)
     session.close()
 
 
@@ -172,7 +218,8 @@ def clean_callable(**kwargs):
 
     extract_table_name = file_config["extract_table"]
     load_table_name = file_config["load_table"]
-    Fact.remove_tables(extract_table_name, load_table_name)
+    # including the tables of ingest workers which were killed
+    Fact.remove_auxiliary_tables(extract_table_name, load_table_name)
 
     for task_instance in kwargs["dag_run"].get_task_instances():
         if (
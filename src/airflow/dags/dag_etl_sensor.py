@@ -2,86 +2,184 @@ import json
 import logging
 import hashlib
 import pendulum
+from pathlib import Path
 
 from airflow import DAG
 from airflow.operators.python import PythonOperator
 from airflow.api.common.experimental.trigger_dag import trigger_dag
 
-from environment import AIRFLOW_DEFAULT_ARGS, AIRFLOW_RAW, RAW_GLOB
+from environment import (
+    AIRFLOW_DEFAULT_ARGS,
+    AIRFLOW_RAW,
+    ETL_BATCH_SIZE,
+    ETL_BATCH_WINDOW,
+    FACT_PARTITIONING,
+    FACT_PARTITIONS_AHEAD,
+    RAW_GLOB,
+    SENSOR_WATERMARK,
+)
 
-from models import Session, ETL
+from models import Session, ETL, Fact, Watermark
 
 
 def sense_callable(**kwargs):
-    """ look for files to process. """
+    """look for files to process.
+
+    The status of all files is looked up at once and the files to process are
+    pushed as a single work list, mapping file names to their configuration.
+    With SENSOR_WATERMARK, files pulled before the watermark are skipped by
+    name, without parsing their pull time, and the watermark moves past the
+    files whose processing completed or was quarantined. Quarantined files
+    before the watermark are looked up in the etl tables and retried.
+    """
 
     task_instance = kwargs["ti"]
 
     logging.info(
         f"Looking for files with the following pattern: {AIRFLOW_RAW.resolve()}/{RAW_GLOB}"
     )
-    files = list(AIRFLOW_RAW.glob(RAW_GLOB))
     session = Session()
-    queue = []
-
-    for file_name in files:
-
-        file_config = {}
-
-        file_config["file_name"] = str(file_name)
-        file_config["file_stem"] = file_name.stem
-        file_config["pulltime"] = str(
-            pendulum.from_format(file_name.stem, "YYYY_MM_DD_HH_mm_ss[-v2]").naive()
-        )
+    watermark = Watermark.get("pull_file", session) if SENSOR_WATERMARK else None
+
+    # file names sort by pull time, names up to the watermark are skipped
+    # before their pull time is parsed
+    skipped = None if watermark is None else watermark.format("YYYY_MM_DD_HH_mm_ss")
+
+    files = {}
+    for file_name in AIRFLOW_RAW.glob(RAW_GLOB):
+        if skipped is not None and file_name.name[: len(skipped)] <= skipped:
+            continue
+        pulltime = pendulum.from_format(file_name.stem, "YYYY_MM_DD_HH_mm_ss[-v2]")
+        files[str(file_name)] = pulltime.naive()
+
+    if SENSOR_WATERMARK:
+        logging.info(f"Watermark at {watermark}, {len(files)} files after it.")
+        if watermark is not None:
+            # quarantined files before the watermark are retried, they are
+            # looked up in the etl tables instead of the raw directory
+            for file_name, pulltime in ETL.get_quarantined(
+                "pull_file", watermark, session
+            ):
+                if Path(file_name).exists():
+                    files[file_name] = pulltime
+
+    files = sorted(files.items(), key=lambda file: (file[1], file[0]))
+    most_recent = ETL.get_most_recent_many("pull_file", files, session)
+
+    # one hash per tick, table names are made unique by the file name
+    now = str(pendulum.now())
+    work = {}
+    dates = set()
+
+    for (file_name, pulltime), status in zip(files, most_recent):
+
+        if not ETL.can_process_status("pull_file", status):
+            continue
 
         hash = hashlib.sha1()
-        hash.update(str(pendulum.now()).encode("utf-8"))
+        hash.update(f"{now}{file_name}".encode("utf-8"))
         hex = hash.hexdigest()
 
+        file_config = {}
+
+        file_config["file_name"] = file_name
+        file_config["file_stem"] = Path(file_name).stem
+        file_config["pulltime"] = str(pulltime)
         file_config["extract_table"] = f"etl.x{hex}"
         file_config["load_table"] = f"etl.l{hex}"
 
         run_id = f"{hex[:10]}-{file_name}"
 
-        file_name = file_config["file_name"]
-        pulltime = file_config["pulltime"]
+        work[file_name] = {"config": file_config, "run_id": run_id}
+
+        day = pulltime.start_of("day")
+        for i in range(-1, FACT_PARTITIONS_AHEAD + 1):
+            dates.add(day.add(days=i))
+
+    task_instance.xcom_push("work", work)
+    logging.info(f"Queued files: {list(work.keys())}")
+
+    if SENSOR_WATERMARK:
+        # the watermark stops at the first file after it which is neither
+        # completed nor quarantined, quarantined files are retried above
+        moved = None
+        for (file_name, pulltime), status in zip(files, most_recent):
+            if watermark is not None and pulltime <= watermark:
+                continue
+            if status is None or status.status.name not in ("completed", "quarantine"):
+                break
+            moved = pulltime
+        if moved is not None:
+            Watermark.set("pull_file", moved, session)
+            logging.info(f"Watermark moved to {moved}.")
+
+    if FACT_PARTITIONING == "range":
+        # attaching a partition locks fact.session, daily partitions around
+        # the pull time of new files are created ahead of their ingestion
+        logging.info(f"Creating partitions for {len(dates)} days.")
+        Fact.create_partitions(sorted(dates))
 
-        file_task_dict = {"config": file_config, "run_id": run_id}
+    session.close()
 
-        if ETL.can_process("pull_file", file_name, pulltime, session):
-            queue.append(file_name)
-            task_instance.xcom_push(file_name, file_task_dict)
 
-    task_instance.xcom_push("files", queue)
-    logging.info(f"Queued files: {queue}")
+def batch_work(work, size=1, window=0):
+    """group queued files into etl batches.
 
-    session.close()
+    Files are taken in pull time order, a batch holds at most `size` files
+    whose pull times span at most `window` minutes, if `window` is not 0. A
+    batch uses the configuration and run id of its first file, the files it
+    holds are listed under "batch".
+    """
+
+    batches = []
+    for file_task_dict in work.values():
+        file_config = file_task_dict["config"]
+        pulltime = pendulum.parse(file_config["pulltime"])
+        if len(batches) > 0:
+            batch, start = batches[-1]
+            files = batch["config"]["batch"]
+            if len(files) < size and (
+                window == 0 or pulltime <= start.add(minutes=window)
+            ):
+                files.append(file_config)
+                continue
+        batch = {
+            "config": {**file_config, "batch": [file_config]},
+            "run_id": file_task_dict["run_id"],
+        }
+        batches.append((batch, pulltime))
+
+    return [batch for batch, _ in batches]
 
 
 def trigger_etl_callable(**kwargs):
-    """ trigger etl tasks. """
+    """ trigger etl tasks, one per batch of files. """
 
     task_instance = kwargs["ti"]
-    files = task_instance.xcom_pull(key="files", task_ids="sense")
+    work = task_instance.xcom_pull(key="work", task_ids="sense")
 
     session = Session()
 
-    for file_name in files:
-        file_task_dict = task_instance.xcom_pull(key=file_name, task_ids="sense")
-        file_config = file_task_dict["config"]
-        file_name = file_config["file_name"]
-        pulltime = file_config["pulltime"]
-        run_id = file_task_dict["run_id"]
-        if ETL.can_process("pull_file", file_name, pulltime, session):
-            ETL.commit_new("pull_file", file_name, pulltime, session)
-            logging.info(f"Triggering {run_id}.")
-            trigger_dag(
-                "etl",
-                run_id,
-                conf=json.dumps(file_config),
-                execution_date=pendulum.now(),
-                replace_microseconds=False,
-            )
+    tasks = [
+        (file_task_dict["config"]["file_name"], file_task_dict["config"]["pulltime"])
+        for file_task_dict in work.values()
+    ]
+    can_process = ETL.can_process_many("pull_file", tasks, session)
+    tasks = [task for task, can in zip(tasks, can_process) if can]
+    ETL.commit_new_many("pull_file", tasks, session)
+
+    work = {file_name: work[file_name] for file_name, _ in tasks}
+    for batch in batch_work(work, ETL_BATCH_SIZE, ETL_BATCH_WINDOW):
+        batch_config = batch["config"]
+        run_id = batch["run_id"]
+        logging.info(f"Triggering {run_id}, {len(batch_config['batch'])} files.")
+        trigger_dag(
+            "etl",
+            run_id,
+            conf=json.dumps(batch_config),
+            execution_date=pendulum.now(),
+            replace_microseconds=False,
+        )
 
     session.close()
 
@@ -20,4 +20,113 @@ AIRFLOW_IMPORT = AIRFLOW_DATA / os.getenv("HOST_IMPORT", "import")
 
 RAW_GLOB = os.getenv("RAW_GLOB", r"*-v2.tsv")
 
+# we add the timezone offset as the data is collected in GMT+00:00
+TIMEZONE_OFFSET = 8 * 60 * 60
+
+# whether the etl sensor skips raw files pulled before a persisted watermark,
+# which moves past files once they are completed or quarantined, quarantined
+# files before it are still retried, files arriving late with a pull time
+# before the watermark are then ignored
+SENSOR_WATERMARK = bool(int(os.getenv("SENSOR_WATERMARK", 0)))
+
+# number of pull files ingested together by a single etl run, a batch is
+# closed early if the pull times of its files would span more than
+# ETL_BATCH_WINDOW minutes, set to 0 for no window
+ETL_BATCH_SIZE = int(os.getenv("ETL_BATCH_SIZE", 1))
+ETL_BATCH_WINDOW = int(os.getenv("ETL_BATCH_WINDOW", 0))
+
 POSTGRES_IMPORT = Path("/home/agens/import")
+
+# number of rows read at a time when preprocessing a raw file, set to 0 to read
+# the whole file at once
+PREPROCESS_CHUNKSIZE = int(os.getenv("PREPROCESS_CHUNKSIZE", 0))
+
+# whether preprocessing keeps only the latest pull of each session across the
+# files of a batch, which drops the pull history of sessions from the facts
+PREPROCESS_LATEST_ONLY = bool(int(os.getenv("PREPROCESS_LATEST_ONLY", 0)))
+
+# format of the files staged between preprocess and ingest, either "csv" files
+# read through a foreign table or postgres "binary" copy files
+STAGING_FORMAT = os.getenv("STAGING_FORMAT", "csv")
+
+# how csv files are extracted, either read through a "fdw" foreign table or
+# loaded once with "copy" into an unlogged staging table
+EXTRACT_MODE = os.getenv("EXTRACT_MODE", "fdw")
+
+# where dimension keys are resolved, either on the "server" by joining the
+# extract with the dimensions or by the "client" while preprocessing, in which
+# case a key cache of DIMENSION_CACHE_SIZE entries per dimension is kept
+RESOLVE_KEYS = os.getenv("RESOLVE_KEYS", "server")
+DIMENSION_CACHE_SIZE = int(os.getenv("DIMENSION_CACHE_SIZE", 100000))
+
+# how the day keys of facts are resolved, either by a "join" of their
+# timestamps with dimension.day or computed as "yyyymmdd" numbers, in which
+# case missing days are added to dimension.day and existing day keys must be
+# migrated first (see bin/00_day_key_migration.py)
+DAY_KEY = os.getenv("DAY_KEY", "join")
+
+# number of processes ingesting the daily files of a pull file concurrently
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 1))
+
+# how daily fact tables are attached to fact.session, either "inherit" child
+# tables or "range" partitions, which requires fact.session to be partitioned
+# by session start (see bin/00_fact_migration.py), in which case partitions
+# are created FACT_PARTITIONS_AHEAD days ahead of the pull time of new files
+FACT_PARTITIONING = os.getenv("FACT_PARTITIONING", "inherit")
+FACT_PARTITIONS_AHEAD = int(os.getenv("FACT_PARTITIONS_AHEAD", 2))
+
+# how daily fact tables are consolidated, either "update" them in place with a
+# sequence of statements, "rebuild" them from a single pass over their rows or
+# update only the sessions ingested since the last consolidation with
+# "incremental"
+CONSOLIDATION_MODE = os.getenv("CONSOLIDATION_MODE", "update")
+
+# minimum number of minutes between consolidations of a date, the files
+# ingested in the meantime are consolidated together by the next one
+CONSOLIDATION_MIN_INTERVAL = int(os.getenv("CONSOLIDATION_MIN_INTERVAL", 0))
+
+# number of hours after the end of a date at which it is closed and gets its
+# final consolidation, hours are counted in pull time up to the pull file
+# watermark with SENSOR_WATERMARK and in local time otherwise, set to 0 for
+# dates never to be closed
+CONSOLIDATION_CLOSE_AFTER = int(os.getenv("CONSOLIDATION_CLOSE_AFTER", 0))
+
+# incremental consolidations keep a delta table per date until the date is
+# closed, closed dates are consolidated in full and their delta table dropped
+if CONSOLIDATION_MODE == "incremental" and CONSOLIDATION_CLOSE_AFTER == 0:
+    raise Exception(
+        "CONSOLIDATION_MODE=incremental requires CONSOLIDATION_CLOSE_AFTER, "
+        "otherwise the delta tables of dates are never dropped."
+    )
+
+# whether daily fact tables store a 64-bit hash of the session columns as
+# session_key, on which consolidation groups and joins the pulls of sessions,
+# which requires adding the column to fact.session first (see
+# bin/00_session_key_migration.py)
+FACT_SESSION_KEY = bool(int(os.getenv("FACT_SESSION_KEY", 0)))
+
+# whether facts are upserted against a unique index on their session and
+# pulltime, in which case duplicate inserts are never written to the daily
+# fact tables and consolidation does not need to remove them
+FACT_UPSERT = bool(int(os.getenv("FACT_UPSERT", 0)))
+
+# when the indices of daily fact tables are built, either on "always" every
+# consolidation or only on the "final" consolidation of a day, and whether
+# they are built inside a "transaction" or "concurrently" without blocking
+# inserts
+FACT_INDEX_POLICY = os.getenv("FACT_INDEX_POLICY", "always")
+FACT_INDEX_BUILD = os.getenv("FACT_INDEX_BUILD", "transaction")
+
+# the final consolidation of a day only happens once the day is closed
+if FACT_INDEX_POLICY == "final" and CONSOLIDATION_CLOSE_AFTER == 0:
+    raise Exception(
+        "FACT_INDEX_POLICY=final requires CONSOLIDATION_CLOSE_AFTER, "
+        "otherwise daily fact tables are never indexed."
+    )
+
+# whether the duration and rows of each etl and consolidation statement are
+# recorded in etl.metrics, with ETL_METRICS_EXPLAIN their plans and buffer
+# usage are recorded too, which executes every statement twice, rows hold the
+# full statement text and are never removed, this is meant for benchmarking
+ETL_METRICS = bool(int(os.getenv("ETL_METRICS", 0)))
+ETL_METRICS_EXPLAIN = bool(int(os.getenv("ETL_METRICS_EXPLAIN", 0)))
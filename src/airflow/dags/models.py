@@ -1,9 +1,15 @@
+import re
 import enum
+import time
 import logging
 import pendulum
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from sqlalchemy import (
     and_,
+    BigInteger,
     Boolean,
     case,
     cast,
@@ -14,28 +20,51 @@ from sqlalchemy import (
     Date,
     DateTime,
     Enum,
+    event,
+    exists,
     extract,
+    Float,
     ForeignKey,
     func,
-    Index,
     Integer,
     literal,
     literal_column,
+    MetaData,
     Numeric,
     null,
     select,
     Text,
+    text,
     Table,
+    true,
+    tuple_,
     type_coerce,
+    union,
     UniqueConstraint,
 )
-from sqlalchemy.dialects.postgresql import insert, INTERVAL
+from sqlalchemy.dialects.postgresql import insert, INTERVAL, JSONB
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 from sqlalchemy_fdw import ForeignDataWrapper, ForeignTable
 
-from environment import WIFI_CONN, POSTGRES_IMPORT
+from environment import (
+    WIFI_CONN,
+    AIRFLOW_IMPORT,
+    CONSOLIDATION_MODE,
+    DAY_KEY,
+    DIMENSION_CACHE_SIZE,
+    ETL_METRICS,
+    ETL_METRICS_EXPLAIN,
+    EXTRACT_MODE,
+    FACT_INDEX_BUILD,
+    FACT_INDEX_POLICY,
+    FACT_PARTITIONING,
+    FACT_SESSION_KEY,
+    FACT_UPSERT,
+    POSTGRES_IMPORT,
+    RESOLVE_KEYS,
+)
 
 WIFI_CONN = WIFI_CONN.replace("postgres://", "pgfdw://")
 engine = create_engine(WIFI_CONN)
@@ -76,6 +105,127 @@ class ETL(Base):
         self.status = status
         self.triggered = pendulum.now()
 
+    # the latest status projection is installed once per process
+    installed = False
+
+    # as are the indices looking up dates ready for consolidation
+    consolidation_installed = False
+
+    @classmethod
+    def install(cls):
+        """install the index on tasks and the table holding the latest status
+        of each task, which a trigger keeps up to date with etl.etl.
+
+        The installation runs in its own transaction, which leaves the
+        transaction of the calling session alone.
+        """
+
+        if cls.installed:
+            return
+
+        with engine.begin() as conn:
+            # serialize concurrent installations
+            conn.execute(
+                text("SELECT pg_advisory_xact_lock(hashtext('etl.etl_latest'))")
+            )
+            exists = conn.execute(text("SELECT to_regclass('etl.etl_latest')")).scalar()
+
+            if not exists:
+                logging.info("Installing etl.etl_latest.")
+                conn.execute(
+                    text(
+                        """
+                    CREATE INDEX IF NOT EXISTS ix_etl_task ON etl.etl (
+                        task_type, task_name, task_timestamp, triggered DESC
+                    )
+                    """
+                    )
+                )
+                conn.execute(
+                    text(
+                        """
+                    CREATE TABLE etl.etl_latest (
+                        task_type      TEXT,
+                        task_name      TEXT,
+                        task_timestamp TIMESTAMP,
+                        status         ETLSTATUS,
+                        triggered      TIMESTAMP,
+                        UNIQUE (task_type, task_name, task_timestamp)
+                    )
+                    """
+                    )
+                )
+                # inserted rows become the latest status unless older, when rows
+                # are updated or deleted the latest status is looked up again
+                conn.execute(
+                    text(
+                        """
+                    CREATE OR REPLACE FUNCTION etl.refresh_latest() RETURNS TRIGGER AS $$
+                    BEGIN
+                        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                            DELETE FROM etl.etl_latest l
+                            WHERE l.task_type = OLD.task_type
+                            AND l.task_name = OLD.task_name
+                            AND l.task_timestamp = OLD.task_timestamp;
+                            INSERT INTO etl.etl_latest
+                            SELECT task_type, task_name, task_timestamp, status, triggered
+                            FROM etl.etl e
+                            WHERE e.task_type = OLD.task_type
+                            AND e.task_name = OLD.task_name
+                            AND e.task_timestamp = OLD.task_timestamp
+                            ORDER BY e.triggered DESC
+                            LIMIT 1
+                            ON CONFLICT DO NOTHING;
+                        END IF;
+                        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                            INSERT INTO etl.etl_latest VALUES (
+                                NEW.task_type,
+                                NEW.task_name,
+                                NEW.task_timestamp,
+                                NEW.status,
+                                NEW.triggered
+                            )
+                            ON CONFLICT (task_type, task_name, task_timestamp) DO UPDATE
+                            SET status = EXCLUDED.status, triggered = EXCLUDED.triggered
+                            WHERE etl.etl_latest.triggered <= EXCLUDED.triggered;
+                        END IF;
+                        RETURN NULL;
+                    END
+                    $$ LANGUAGE plpgsql
+                    """
+                    )
+                )
+                conn.execute(
+                    text(
+                        """
+                    CREATE INDEX ix_etl_latest_quarantine ON etl.etl_latest (
+                        task_type, task_timestamp
+                    ) WHERE status = 'quarantine'
+                    """
+                    )
+                )
+                conn.execute(
+                    text(
+                        """
+                    CREATE TRIGGER etl_latest AFTER INSERT OR UPDATE OR DELETE
+                    ON etl.etl FOR EACH ROW EXECUTE PROCEDURE etl.refresh_latest()
+                    """
+                    )
+                )
+                conn.execute(
+                    text(
+                        """
+                    INSERT INTO etl.etl_latest
+                    SELECT DISTINCT ON (task_type, task_name, task_timestamp)
+                        task_type, task_name, task_timestamp, status, triggered
+                    FROM etl.etl
+                    ORDER BY task_type, task_name, task_timestamp, triggered DESC
+                    """
+                    )
+                )
+
+        cls.installed = True
+
     @classmethod
     def commit_new(cls, task_type, task_name, task_timestamp, session):
         """ add a newly triggered task to the table as ongoing. """
@@ -94,16 +244,18 @@ class ETL(Base):
     @classmethod
     def get_most_recent(cls, task_type, task_name, task_timestamp, session):
         """ for a given task return the most recent status. """
+        cls.install()
+        # latest statuses change, rows cached by the session are refreshed
         q = (
-            session.query(cls)
+            session.query(ETLLatest)
+            .populate_existing()
             .filter(
                 and_(
-                    cls.task_type == task_type,
-                    cls.task_name == f"{task_name}",
-                    cls.task_timestamp == task_timestamp,
+                    ETLLatest.task_type == task_type,
+                    ETLLatest.task_name == f"{task_name}",
+                    ETLLatest.task_timestamp == task_timestamp,
                 )
             )
-            .order_by(cls.triggered.desc())
             .first()
         )
         return q
@@ -130,6 +282,12 @@ class ETL(Base):
         quarantined then we will begin the task.
         """
         most_recent = cls.get_most_recent(task_type, task_name, task_timestamp, session)
+        return cls.can_process_status(task_type, most_recent)
+
+    @classmethod
+    def can_process_status(cls, task_type, most_recent):
+        """determine if we should continue with a task given its most recent
+        status."""
         seen = most_recent is not None
         if seen:
             if task_type != "consolidation":
@@ -143,50 +301,532 @@ class ETL(Base):
         return (not seen) or can
 
     @classmethod
-    def ready_for_consolidation(cls, session):
-        """ determine which tables are ready for consolidation. """
-        ingested = (
-            session.query(
-                cls.task_timestamp, func.max(cls.triggered).label("triggered")
+    def get_most_recent_many(cls, task_type, tasks, session):
+        """for many tasks return their most recent status at once.
+
+        `tasks` is a list of (task_name, task_timestamp) tuples, a list of
+        statuses, or None for unseen tasks, in the same order is returned.
+        """
+
+        cls.install()
+
+        def key(task_name, task_timestamp):
+            if isinstance(task_timestamp, str):
+                task_timestamp = pendulum.parse(task_timestamp)
+            return f"{task_name}", pendulum.instance(task_timestamp).naive()
+
+        keys = [key(*task) for task in tasks]
+        most_recent = {}
+        for i in range(0, len(keys), 1000):
+            q = (
+                session.query(ETLLatest)
+                .populate_existing()
+                .filter(
+                    and_(
+                        ETLLatest.task_type == task_type,
+                        tuple_(ETLLatest.task_name, ETLLatest.task_timestamp).in_(
+                            keys[i : i + 1000]
+                        ),
+                    )
+                )
+            )
+            for row in q:
+                most_recent[key(row.task_name, row.task_timestamp)] = row
+
+        return [most_recent.get(k) for k in keys]
+
+    @classmethod
+    def can_process_many(cls, task_type, tasks, session):
+        """determine if we should continue with many tasks at once.
+
+        `tasks` is a list of (task_name, task_timestamp) tuples, a list of
+        booleans in the same order is returned.
+        """
+        most_recent = cls.get_most_recent_many(task_type, tasks, session)
+        return [cls.can_process_status(task_type, m) for m in most_recent]
+
+    @classmethod
+    def get_quarantined(cls, task_type, before, session):
+        """the tasks whose most recent status is quarantined, with a timestamp
+        up to `before`, as a list of (task_name, task_timestamp) tuples."""
+
+        cls.install()
+        q = (
+            session.query(ETLLatest.task_name, ETLLatest.task_timestamp)
+            .filter(
+                and_(
+                    ETLLatest.task_type == task_type,
+                    ETLLatest.status == "quarantine",
+                    ETLLatest.task_timestamp <= before,
+                )
             )
-            .filter(and_(cls.task_type == "session_file", cls.status == "completed"))
-            .group_by(cls.task_timestamp)
-            .all()
+            .order_by(ETLLatest.task_timestamp)
         )
-        if len(ingested) > 0:
-            ingested = {
-                pendulum.instance(date).naive(): triggered
-                for date, triggered in ingested
-            }
-        else:
-            ingested = {}
+        return [
+            (task_name, pendulum.instance(task_timestamp).naive())
+            for task_name, task_timestamp in q
+        ]
 
-        consolidated = (
-            session.query(
-                cls.task_timestamp, func.max(cls.triggered).label("triggered")
+    @classmethod
+    def commit_new_many(cls, task_type, tasks, session):
+        """add many newly triggered tasks to the table as ongoing at once.
+
+        Unlike `commit_new`, the tasks are expected to have been checked with
+        `can_process_many` beforehand.
+        """
+        session.add_all(
+            [
+                cls(task_type, task_name, task_timestamp, "ongoing")
+                for task_name, task_timestamp in tasks
+            ]
+        )
+        session.commit()
+
+    @classmethod
+    def install_consolidation(cls):
+        """install the indices looking up tasks ready for consolidation, in
+        their own transaction."""
+
+        if cls.consolidation_installed:
+            return
+
+        cls.install()
+        with engine.begin() as conn:
+            # partial indices on completed tasks, kept small by their filters
+            for name, columns, task_type in [
+                ("ix_etl_ingested", "triggered", "session_file"),
+                ("ix_etl_ingested_day", "task_timestamp", "session_file"),
+                ("ix_etl_consolidated", "task_timestamp, triggered", "consolidation"),
+                ("ix_etl_finalized", "task_timestamp", "final_consolidation"),
+            ]:
+                exists = conn.execute(
+                    text(f"SELECT to_regclass('etl.{name}')")
+                ).scalar()
+                if not exists:
+                    logging.info(f"Creating index etl.{name}.")
+                    conn.execute(
+                        text(
+                            f"""
+                        CREATE INDEX IF NOT EXISTS {name} ON etl.etl ({columns})
+                        WHERE task_type = '{task_type}' AND status = 'completed'
+                        """
+                        )
+                    )
+        cls.consolidation_installed = True
+
+    @classmethod
+    def now(cls, session):
+        """the current time as written in the triggered column, which holds
+        the local time of the database sessions that wrote it."""
+
+        return session.execute(
+            text("SELECT CAST(:now AS TIMESTAMP)"), {"now": pendulum.now()}
+        ).scalar()
+
+    @classmethod
+    def ready_for_consolidation(cls, session):
+        """determine which tables are ready for consolidation.
+
+        A date is ready when a session file of that date completed after its
+        last completed consolidation. Session files before the "consolidation"
+        watermark are known to be consolidated and are not looked at again,
+        the watermark moves up to the first session file still waiting for
+        consolidation, but no later than an hour ago so that tasks committed
+        late are not skipped. The watermark is compared with the triggered
+        column as is, both are in the time of the database sessions.
+        """
+
+        cls.install_consolidation()
+        watermark = Watermark.get("consolidation", session)
+
+        rows = session.execute(
+            text(
+                """
+            SELECT s.task_timestamp, s.triggered
+            FROM etl.etl s
+            WHERE s.task_type = 'session_file'
+            AND s.status = 'completed'
+            AND s.triggered >= COALESCE(CAST(:watermark AS TIMESTAMP), '-infinity')
+            AND NOT EXISTS (
+                SELECT FROM etl.etl c
+                WHERE c.task_type = 'consolidation'
+                AND c.status = 'completed'
+                AND c.task_timestamp = s.task_timestamp
+                AND c.triggered >= s.triggered
+            )
+            """
+            ),
+            {"watermark": watermark},
+        ).fetchall()
+
+        lag = pendulum.instance(cls.now(session)).naive().subtract(hours=1)
+        Watermark.set("consolidation", min([lag] + [t for _, t in rows]), session)
+
+        dates = sorted({date for date, _ in rows})
+        return [pendulum.instance(date).naive() for date in dates]
+
+    @classmethod
+    def ready_for_final_consolidation(cls, closed, session):
+        """determine which closed dates, up to `closed` included, are ready
+        for their final consolidation.
+
+        A date is ready when it has completed session files but no completed
+        final consolidation. Dates before the "final_consolidation" watermark
+        are known to be final, the watermark moves up to the first date still
+        waiting. It starts after `closed`, dates closed beforehand are left as
+        they are.
+        """
+
+        cls.install_consolidation()
+        watermark = Watermark.get("final_consolidation", session)
+        after = pendulum.instance(closed).naive().add(days=1)
+
+        if watermark is None:
+            Watermark.set("final_consolidation", after, session)
+            return []
+
+        rows = session.execute(
+            text(
+                """
+            SELECT DISTINCT s.task_timestamp
+            FROM etl.etl s
+            WHERE s.task_type = 'session_file'
+            AND s.status = 'completed'
+            AND s.task_timestamp >= :watermark
+            AND s.task_timestamp <= :closed
+            AND NOT EXISTS (
+                SELECT FROM etl.etl f
+                WHERE f.task_type = 'final_consolidation'
+                AND f.status = 'completed'
+                AND f.task_timestamp = s.task_timestamp
+            )
+            ORDER BY 1
+            """
+            ),
+            {"watermark": watermark, "closed": closed},
+        ).fetchall()
+
+        dates = [pendulum.instance(date).naive() for date, in rows]
+        Watermark.set("final_consolidation", min(dates + [after]), session)
+        return dates
+
+    @classmethod
+    def recently_consolidated(cls, dates, minutes, session):
+        """ the dates whose last consolidation completed less than `minutes` ago. """
+
+        cls.install_consolidation()
+        rows = session.execute(
+            text(
+                """
+            SELECT DISTINCT task_timestamp
+            FROM etl.etl
+            WHERE task_type = 'consolidation'
+            AND status = 'completed'
+            AND task_timestamp = ANY(:dates)
+            AND triggered > CAST(:now AS TIMESTAMP) - make_interval(mins => :minutes)
+            """
+            ),
+            {"dates": list(dates), "now": pendulum.now(), "minutes": minutes},
+        ).fetchall()
+        return {pendulum.instance(date).naive() for date, in rows}
+
+
+class ETLLatest(Base):
+    """
+    Latest state of each ETL task, maintained by a trigger on etl.etl.
+    """
+
+    __tablename__ = "etl_latest"
+    __table_args__ = {"schema": "etl"}
+
+    task_type = Column(Text, primary_key=True)
+    task_name = Column(Text, primary_key=True)
+    task_timestamp = Column(DateTime, primary_key=True)
+    status = Column(Enum(ETLStatus))
+    triggered = Column(DateTime)
+
+
+class Watermark(Base):
+    """
+    Table for storing how far sensors have processed their inputs.
+    """
+
+    __tablename__ = "watermark"
+    __table_args__ = {"schema": "etl"}
+
+    name = Column(Text, primary_key=True)
+    value = Column(DateTime)
+
+    @classmethod
+    def get(cls, name, session):
+        """ the watermark of the given name, None if not set yet. """
+        if not cls.__table__.exists(session.connection()):
+            # created on first use, before the first watermark is set
+            cls.__table__.create(session.connection(), checkfirst=True)
+            session.commit()
+        row = session.query(cls).populate_existing().get(name)
+        return None if row is None else pendulum.instance(row.value).naive()
+
+    @classmethod
+    def set(cls, name, value, session):
+        """ move the watermark of the given name forward to `value`. """
+        session.execute(
+            insert(cls.__table__)
+            .values(name=name, value=value)
+            .on_conflict_do_update(
+                index_elements=[cls.name],
+                set_={"value": func.greatest(cls.value, value)},
             )
-            .filter(and_(cls.task_type == "consolidation", cls.status == "completed"))
-            .group_by(cls.task_timestamp)
-            .all()
         )
-        if len(consolidated) > 0:
-            consolidated = {
-                pendulum.instance(date).naive(): triggered
-                for date, triggered in consolidated
+        session.commit()
+
+
+class Metric(Base):
+    """
+    Table for storing the duration and rows of the stages of etl and
+    consolidation runs, and of each of their statements.
+    """
+
+    __tablename__ = "metrics"
+    __table_args__ = {"schema": "etl"}
+
+    id = Column(Integer, primary_key=True)
+    recorded = Column(DateTime(timezone=True))
+    date = Column(Date)
+    table_name = Column(Text)
+    file_name = Column(Text)
+    stage = Column(Text)
+    # position of the statement in its stage, null for the whole stage
+    statement = Column(Integer)
+    sql = Column(Text)
+    seconds = Column(Float)
+    rows = Column(BigInteger)
+    # plan of the statement, or details given for the whole stage
+    details = Column(JSONB(none_as_null=True))
+
+    # statements executed by the stage being measured, if any
+    recording = None
+
+    # the table is created once per process
+    created = False
+
+    @classmethod
+    @contextmanager
+    def measure(cls, stage, date, table_name, file_name=None):
+        """measure a stage, yielding a dictionary of details to record.
+
+        The statements executed in the meantime are recorded by the engine
+        listeners below. Nothing is recorded if the stage fails.
+        """
+
+        if not ETL_METRICS:
+            yield {}
+            return
+
+        outer, cls.recording = cls.recording, []
+        details = {}
+        start = time.perf_counter()
+        try:
+            yield details
+            seconds = time.perf_counter() - start
+            statements, cls.recording = cls.recording, None
+            try:
+                cls.record(
+                    stage, date, table_name, file_name, seconds, statements, details
+                )
+            except:
+                # metrics are not worth failing the stage for
+                logging.exception(f"Failed to record the metrics of {stage}.")
+        finally:
+            cls.recording = outer
+
+    @classmethod
+    def record(cls, stage, date, table_name, file_name, seconds, statements, details):
+        """ write the metrics of a stage and of its statements. """
+
+        recorded = pendulum.now()
+        row = {
+            "recorded": recorded,
+            "date": date,
+            "table_name": table_name,
+            "file_name": file_name,
+            "stage": stage,
+        }
+        rows = [
+            {
+                **row,
+                "statement": None,
+                "sql": None,
+                "seconds": seconds,
+                "rows": sum(s["rows"] or 0 for s in statements),
+                "details": details or None,
             }
-        else:
-            consolidated = {}
+        ] + [{**row, "statement": i, **s} for i, s in enumerate(statements)]
+
+        with engine.begin() as conn:
+            if not cls.created:
+                cls.__table__.create(conn, checkfirst=True)
+                cls.created = True
+            conn.execute(cls.__table__.insert(), rows)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """time statements and, with ETL_METRICS_EXPLAIN, explain them first.
+
+    Statements are explained within a savepoint which is rolled back, so that
+    they take effect once, when executed for real. The start time and plan are
+    kept on the execution context, which goes away with statements that fail.
+    """
 
-        dates_for_consolidation = []
+    if Metric.recording is None or context is None:
+        return
 
-        for date in ingested.keys():
-            if (date not in consolidated) or (ingested[date] > consolidated[date]):
-                dates_for_consolidation.append(date)
+    plan = None
+    explainable = re.match(r"\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b", statement, re.I)
+    autocommit = cursor.connection.autocommit
+    if ETL_METRICS_EXPLAIN and explainable and not autocommit and not executemany:
+        cursor.execute("SAVEPOINT metrics_explain")
+        cursor.execute(
+            f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", parameters
+        )
+        plan = cursor.fetchone()[0]
+        cursor.execute("ROLLBACK TO SAVEPOINT metrics_explain")
+
+    context.metrics = (time.perf_counter(), plan)
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ record the duration and rows of statements of the measured stage. """
 
-        return dates_for_consolidation
+    if Metric.recording is None or getattr(context, "metrics", None) is None:
+        return
+
+    start, plan = context.metrics
+    Metric.recording.append(
+        {
+            "sql": statement,
+            "seconds": time.perf_counter() - start,
+            "rows": cursor.rowcount if cursor.rowcount >= 0 else None,
+            "details": plan,
+        }
+    )
+
+
+class DimensionCache:
+    """Size-bounded (LRU) map from dimension values to their surrogate keys.
+
+    The cache is warmed with the most recently created keys of the dimension,
+    only values which were not seen before hit the database. Unseen values are
+    looked up and, if they do not exist yet, inserted.
+    """
+
+    def __init__(self, dimension, maxsize):
+        self.dimension = dimension
+        self.maxsize = maxsize
+        self.keys = OrderedDict()
+        self.warm = False
+        self.hits = 0
+        self.misses = 0
+
+    def _columns(self):
+        table = self.dimension.__table__
+        return [table.c[c] for c in self.dimension.extract_mapping.keys()]
+
+    def _store(self, rows):
+        for (key, *value) in rows:
+            self.keys[tuple(value)] = key
+            self.keys.move_to_end(tuple(value))
+        while len(self.keys) > self.maxsize:
+            self.keys.popitem(last=False)
+
+    def _select(self, values, conn):
+        table = self.dimension.__table__
+        columns = self._columns()
+        rows = []
+        for i in range(0, len(values), 1000):
+            rows += conn.execute(
+                select([table.c.key, *columns]).where(
+                    tuple_(*columns).in_(values[i : i + 1000])
+                )
+            ).fetchall()
+        return rows
+
+    def _insert(self, values, conn):
+        table = self.dimension.__table__
+        names = list(self.dimension.extract_mapping.keys())
+        # values are inserted in order to avoid deadlocks between processes
+        rows = [dict(zip(names, value)) for value in sorted(values)]
+        if "prepopulated" in table.c:
+            for row in rows:
+                row["prepopulated"] = False
+        inserted = []
+        for i in range(0, len(rows), 1000):
+            inserted += conn.execute(
+                insert(table)
+                .values(rows[i : i + 1000])
+                .on_conflict_do_nothing()
+                .returning(table.c.key, *self._columns())
+            ).fetchall()
+        return inserted
+
+    def resolve(self, values, conn):
+        """ return the keys of the given values, inserting new values. """
+
+        if not self.warm:
+            table = self.dimension.__table__
+            self._store(
+                reversed(
+                    conn.execute(
+                        select([table.c.key, *self._columns()])
+                        .order_by(table.c.key.desc())
+                        .limit(self.maxsize)
+                    ).fetchall()
+                )
+            )
+            self.warm = True
+
+        # hits are marked as recently used, and kept apart, before misses are
+        # stored so that storing the misses cannot evict them
+        keys = {}
+        for value in values:
+            if value in self.keys:
+                keys[value] = self.keys[value]
+                self.keys.move_to_end(value)
+        unseen = [v for v in values if v not in keys]
+        self.hits += len(values) - len(unseen)
+        self.misses += len(unseen)
+
+        if len(unseen) > 0:
+            found = self._select(unseen, conn)
+            seen = {tuple(value) for (key, *value) in found}
+            new = [v for v in unseen if v not in seen]
+            if len(new) > 0:
+                inserted = self._insert(new, conn)
+                seen.update(tuple(value) for (key, *value) in inserted)
+                # values inserted concurrently by another process are not
+                # returned by the insert, we look them up instead
+                missing = [v for v in new if v not in seen]
+                found += inserted + self._select(missing, conn)
+            self._store(found)
+            keys.update((tuple(value), key) for (key, *value) in found)
+
+        return [keys[value] for value in values]
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
 
 
 class DimensionMixin:
+    @classmethod
+    def key_cache(cls):
+        """ get the dimension key cache of this process. """
+        if "_key_cache" not in cls.__dict__:
+            cls._key_cache = DimensionCache(cls, DIMENSION_CACHE_SIZE)
+        return cls._key_cache
+
     @classmethod
     def get_column_mapping(cls, extract):
         update_columns, extract_columns = zip(*cls.extract_mapping.items())
@@ -201,30 +841,36 @@ class DimensionMixin:
         return and_(*condition)
 
     @classmethod
-    def update(cls, extract):
-        """ update table with newly extracted data. """
+    def insert_new(cls, extract):
+        """insert statement of the extracted values missing from the table.
+
+        Values already in the table are filtered out before the insert, so
+        that they do not draw keys from the sequence. New values are inserted
+        in a fixed order so that concurrent ingest workers acquire the unique
+        index locks in the same order, values inserted meanwhile by another
+        worker are skipped on conflict.
+        """
         table = cls.__table__
-        logging.info(f"Updating: {table}")
         update_columns, extract_columns = cls.get_column_mapping(extract)
-        logging.info(f"Update columns: {update_columns}")
-        logging.info(f"Extract columns: {extract_columns}")
+        new_data = (
+            select(extract_columns)
+            .where(~exists().where(cls.where_clause(extract)))
+            .distinct()
+            .order_by(*extract_columns)
+        )
+        if "prepopulated" in table.c:
+            new_data = new_data.add_columns(literal_column("FALSE"))
+            update_columns.append(table.c["prepopulated"])
+        return (
+            insert(table).from_select(update_columns, new_data).on_conflict_do_nothing()
+        )
+
+    @classmethod
+    def update(cls, extract):
+        """ update table with newly extracted data. """
+        logging.info(f"Updating: {cls.__table__}")
         with engine.begin() as conn:
-            new_data = select(extract_columns).distinct()
-            if "prepopulated" in cls.__table__.c:
-                new_data = select(
-                    [
-                        new_data.alias("new_data"),
-                        literal_column("FALSE as prepopulated"),
-                    ]
-                )
-                update_columns.append(cls.__table__.c["prepopulated"])
-            # conflicts will arise whenever there are non-unique dimensions, we
-            # skip inserting these dimensions
-            conn.execute(
-                insert(table)
-                .from_select(update_columns, new_data)
-                .on_conflict_do_nothing()
-            )
+            conn.execute(cls.insert_new(extract))
 
 
 class SessionStatus(enum.Enum):
@@ -244,6 +890,7 @@ class User(DimensionMixin, Base):
     name = Column(Text, unique=True)
 
     extract_mapping = {"name": "username"}
+    fact_key = "userid_key"
 
 
 class Mac(DimensionMixin, Base):
@@ -254,6 +901,7 @@ class Mac(DimensionMixin, Base):
     address = Column(Text, unique=True)
 
     extract_mapping = {"address": "macaddress"}
+    fact_key = "mac_key"
 
 
 class AP(DimensionMixin, Base):
@@ -268,6 +916,7 @@ class AP(DimensionMixin, Base):
     UniqueConstraint("name", "path")
 
     extract_mapping = {"name": "apname", "path": "location"}
+    fact_key = "ap_key"
 
 
 class SSID(DimensionMixin, Base):
@@ -279,6 +928,7 @@ class SSID(DimensionMixin, Base):
     prepopulated = Column(Boolean)
 
     extract_mapping = {"name": "ssid"}
+    fact_key = "ssid_key"
 
 
 class Protocol(DimensionMixin, Base):
@@ -290,6 +940,7 @@ class Protocol(DimensionMixin, Base):
     prepopulated = Column(Boolean)
 
     extract_mapping = {"name": "protocol"}
+    fact_key = "protocol_key"
 
 
 class SessionDay(Base):
@@ -307,44 +958,217 @@ class SessionDay(Base):
         else:
             return cast(timestamp_column, Date) == cls.__table__.c.day
 
+    @classmethod
+    def key_of(cls, timestamp_column):
+        """ key of the day of a timestamp, as a yyyymmdd number. """
+        return cast(func.to_char(timestamp_column, "YYYYMMDD"), Integer)
+
+    @classmethod
+    def update(cls, extract):
+        """insert the days of the extracted timestamps missing from the table,
+        keyed as yyyymmdd numbers."""
+        table = cls.__table__
+        days = union(
+            *[
+                select([cast(extract.c[c], Date).label("day")])
+                for c in ["sessionstarttime", "sessionendtime", "pulltime"]
+            ]
+        ).alias("days")
+        new_data = (
+            select([cls.key_of(days.c.day), days.c.day, literal_column("FALSE")])
+            .where(
+                and_(days.c.day != None, ~exists().where(table.c.day == days.c.day))
+            )
+            .order_by(days.c.day)
+        )
+        with engine.begin() as conn:
+            conn.execute(
+                insert(table)
+                .from_select([table.c.key, table.c.day, table.c.prepopulated], new_data)
+                .on_conflict_do_nothing()
+            )
+
 
 class Fact:
 
     sessionstatus = Enum(SessionStatus, validate_strings=True, metadata=Base.metadata)
 
+    extract_columns = [
+        ("username", Text),
+        ("macaddress", Text),
+        ("protocol", Text),
+        ("apname", Text),
+        ("location", Text),
+        ("ssid", Text),
+        ("sessionstarttime", DateTime(timezone=False)),
+        ("sessionendtime", DateTime(timezone=False)),
+        ("pulltime", DateTime(timezone=False)),
+        ("rssi", Integer),
+    ]
+
+    dimensions = [User, Mac, AP, SSID, Protocol]
+
+    # columns identifying a session across pulls
+    session_columns = [
+        "userid_key",
+        "mac_key",
+        "ap_key",
+        "ssid_key",
+        "protocol_key",
+        "session_start",
+    ]
+
+    # indices of the daily fact tables by name suffix, the last one covers
+    # the grouping of pulls by session used during consolidation
+    indices = {
+        "session_start": ["session_start"],
+        "session_end": ["session_end"],
+        "pulltime_last": ["pulltime_last"],
+        "session_pulltime": session_columns + ["pulltime"],
+    }
+
+    # copy options for each staged file format
+    copy_options = {".csv": "FORMAT csv, HEADER true", ".pgcopy": "FORMAT binary"}
+
+    @classmethod
+    def get_extract_columns(cls):
+        """extract columns, followed by the dimension keys when these are
+        resolved by the client during preprocessing."""
+        columns = list(cls.extract_columns)
+        if RESOLVE_KEYS == "client":
+            columns += [(d.fact_key, Integer) for d in cls.dimensions]
+        return columns
+
+    @classmethod
+    def get_session_columns(cls):
+        """columns identifying a session across pulls in the daily fact tables,
+        the session key with FACT_SESSION_KEY."""
+        return ["session_key"] if FACT_SESSION_KEY else cls.session_columns
+
+    @classmethod
+    def session_key(cls, table):
+        """64-bit hash of the session columns of the named table.
+
+        Hashes are taken over a fixed text representation of the columns, so
+        that the keys computed at ingest match those of migrated tables.
+        """
+        columns = [f"{table}.{c}" for c in cls.session_columns[:-1]]
+        columns.append(f"to_char({table}.session_start, 'YYYYMMDDHH24MISSUS')")
+        return literal_column(
+            f"('x' || substr(md5(concat_ws('|', {', '.join(columns)})), 1, 16))"
+            "::BIT(64)::BIGINT"
+        ).label("session_key")
+
+    @classmethod
+    def session_join(cls, left, right):
+        """ condition joining the rows of the same sessions of two tables. """
+        return " AND ".join(
+            f"{left}.{c} = {right}.{c}" for c in cls.get_session_columns()
+        )
+
+    @classmethod
+    def session_index(cls):
+        """ name suffix and columns of the index grouping pulls by session. """
+        if FACT_SESSION_KEY:
+            return "session_key_pulltime", ["session_key", "pulltime"]
+        return "session_pulltime", cls.indices["session_pulltime"]
+
+    @classmethod
+    def get_indices(cls):
+        """ indices of the daily fact tables by name suffix. """
+        indices = {k: v for k, v in cls.indices.items() if k != "session_pulltime"}
+        suffix, columns = cls.session_index()
+        indices[suffix] = columns
+        return indices
+
+    @classmethod
+    def resolve_keys(cls, values):
+        """resolve dimension values to their surrogate keys with the key cache
+        of this process. `values` maps each fact key column to a list of
+        dimension value tuples."""
+
+        keys = {}
+        with engine.begin() as conn:
+            for dimension in cls.dimensions:
+                if dimension.fact_key not in values:
+                    continue
+                keys[dimension.fact_key] = dimension.key_cache().resolve(
+                    values[dimension.fact_key], conn
+                )
+        return keys
+
+    @classmethod
+    def key_cache_counts(cls):
+        """ hits and misses of the dimension key caches of this process. """
+        return {
+            d.__tablename__: (d.key_cache().hits, d.key_cache().misses)
+            for d in cls.dimensions
+        }
+
+    @classmethod
+    def log_key_caches(cls, before):
+        """ log the hit ratio of each key cache since the `before` counts. """
+        for name, (hits, misses) in cls.key_cache_counts().items():
+            hits, misses = hits - before[name][0], misses - before[name][1]
+            logging.info(
+                f"dimension.{name} key cache: {hits} hits, {misses} misses, "
+                f"hit ratio {hits / max(hits + misses, 1):.2%}."
+            )
+
     @classmethod
     def extract_table(cls, file_basename, name):
-        """get corresponding extract foreign table,
-        mapping the csv file to the database."""
+        """get corresponding extract table.
+
+        Csv files are mapped to the database with a foreign table, unless the
+        extract mode is "copy". Otherwise, and for binary files, the file is
+        copied once into an unlogged staging table so that the dimension
+        updates and the fact insert do not re-parse it.
+        """
 
         if name not in Base.metadata.tables:
 
             schema, table_name = name.split(".")
-
-            table = ForeignTable(
-                table_name,
-                Base.metadata,
-                Column("username", Text),
-                Column("macaddress", Text),
-                Column("protocol", Text),
-                Column("apname", Text),
-                Column("location", Text),
-                Column("ssid", Text),
-                Column("sessionstarttime", DateTime(timezone=False)),
-                Column("sessionendtime", DateTime(timezone=False)),
-                Column("pulltime", DateTime(timezone=False)),
-                Column("rssi", Integer),
-                schema="etl",
-                pgfdw_server="csv_fdw",
-                pgfdw_options={
-                    "filename": f"{POSTGRES_IMPORT / file_basename}",
-                    "format": "csv",
-                    "header": "true",
-                },
-            )
+            suffix = Path(file_basename).suffix
+
+            if suffix != ".csv" or EXTRACT_MODE == "copy":
+                table = Table(
+                    table_name,
+                    Base.metadata,
+                    *[Column(c, t) for c, t in cls.get_extract_columns()],
+                    schema="etl",
+                    prefixes=["UNLOGGED"],
+                )
+            else:
+                table = ForeignTable(
+                    table_name,
+                    Base.metadata,
+                    *[Column(c, t) for c, t in cls.get_extract_columns()],
+                    schema="etl",
+                    pgfdw_server="csv_fdw",
+                    pgfdw_options={
+                        "filename": f"{POSTGRES_IMPORT / file_basename}",
+                        "format": "csv",
+                        "header": "true",
+                    },
+                )
 
         return Base.metadata.tables[name]
 
+    @classmethod
+    def copy_extract(cls, extract, file_basename, conn):
+        """ copy a staged file into its extract table. """
+
+        options = cls.copy_options[Path(file_basename).suffix]
+        columns = ", ".join(c for c, _ in cls.get_extract_columns())
+        cursor = conn.connection.cursor()
+        with open(AIRFLOW_IMPORT / file_basename, "rb") as f:
+            cursor.copy_expert(
+                f"COPY {extract.fullname} ({columns}) FROM STDIN WITH ({options})", f
+            )
+        logging.info(f"Copied {cursor.rowcount} rows into {extract.fullname}.")
+        # unlogged tables are not analyzed until autovacuum gets to them
+        conn.execute(f"ANALYZE {extract.fullname}")
+
     @classmethod
     def child_or_load_table(cls, date, name=None):
         """join extract table with dimension keys and get corresponding load
@@ -361,26 +1185,42 @@ class Fact:
 
         if f"{schema}.{table_name}" not in Base.metadata.tables:
 
+            def references(column):
+                # load tables are dropped after each run, their foreign keys
+                # would lock the dimensions against concurrent runs
+                return [] if name else [ForeignKey(column)]
+
+            # the session key is computed when loading into the daily table
+            if FACT_SESSION_KEY and not name:
+                session_key = [Column("session_key", BigInteger)]
+            else:
+                session_key = []
+
             table = Table(
                 table_name,
                 Base.metadata,
-                Column("userid_key", Integer, ForeignKey("dimension.userid.key")),
-                Column("mac_key", Integer, ForeignKey("dimension.mac.key")),
-                Column("ap_key", Integer, ForeignKey("dimension.ap.key")),
-                Column("ssid_key", Integer, ForeignKey("dimension.ssid.key")),
-                Column("protocol_key", Integer, ForeignKey("dimension.protocol.key")),
-                Column("session_start", DateTime(timezone=False)),
+                Column("userid_key", Integer, *references("dimension.userid.key")),
+                Column("mac_key", Integer, *references("dimension.mac.key")),
+                Column("ap_key", Integer, *references("dimension.ap.key")),
+                Column("ssid_key", Integer, *references("dimension.ssid.key")),
+                Column("protocol_key", Integer, *references("dimension.protocol.key")),
+                # with the check constraint below, not null implies the range
+                # partition bounds of the daily table
+                Column("session_start", DateTime(timezone=False), nullable=bool(name)),
                 Column(
-                    "session_start_day_key", Integer, ForeignKey("dimension.day.key")
+                    "session_start_day_key", Integer, *references("dimension.day.key")
                 ),
                 Column("session_end", DateTime(timezone=False)),
-                Column("session_end_day_key", Integer, ForeignKey("dimension.day.key")),
+                Column(
+                    "session_end_day_key", Integer, *references("dimension.day.key")
+                ),
                 Column("session_duration", INTERVAL),
                 Column("pulltime", DateTime(timezone=False)),
-                Column("pulltime_day_key", Integer, ForeignKey("dimension.day.key")),
+                Column("pulltime_day_key", Integer, *references("dimension.day.key")),
                 Column("pulltime_last", Boolean),
                 Column("status", cls.sessionstatus),
                 Column("rssi", Integer),
+                *session_key,
                 CheckConstraint(
                     f"""
                     session_start >= '{date_str}'::TIMESTAMP AND
@@ -388,19 +1228,107 @@ class Fact:
                     """
                 ),
                 schema=schema,
+                # load tables are dropped after each run, no need to log them
+                prefixes=["UNLOGGED"] if name else [],
             )
 
         return Base.metadata.tables[f"{schema}.{table_name}"]
 
+    @classmethod
+    def delta_table(cls, date):
+        """ table of the sessions inserted since the last consolidation. """
+
+        table_name = f"session_delta_{date.format('YYYY_MM_DD')}"
+
+        if f"etl.{table_name}" not in Base.metadata.tables:
+            if FACT_SESSION_KEY:
+                columns = [Column("session_key", BigInteger)]
+            else:
+                columns = [
+                    Column("userid_key", Integer),
+                    Column("mac_key", Integer),
+                    Column("ap_key", Integer),
+                    Column("ssid_key", Integer),
+                    Column("protocol_key", Integer),
+                    Column("session_start", DateTime(timezone=False)),
+                ]
+            Table(table_name, Base.metadata, *columns, schema="etl")
+
+        return Base.metadata.tables[f"etl.{table_name}"]
+
+    @classmethod
+    def attach(cls, child_fact, date, conn):
+        """ attach a daily fact table to fact.session. """
+
+        if FACT_PARTITIONING == "range":
+            # the check and not null constraints of the daily table imply the
+            # partition bounds, attaching it does not require scanning the
+            # table, tables created without the not null constraint are
+            # scanned
+            date_str = date.format("YYYY-MM-DD")
+            next_date_str = date.add(days=1).format("YYYY-MM-DD")
+            conn.execute(
+                f"""
+                ALTER TABLE fact.session ATTACH PARTITION {child_fact.fullname}
+                FOR VALUES FROM ('{date_str}') TO ('{next_date_str}')
+                """
+            )
+        else:
+            conn.execute(f"ALTER TABLE {child_fact.fullname} INHERIT fact.session")
+
+    @classmethod
+    def create_partitions(cls, dates):
+        """create the daily fact tables of the given dates if they do not
+        exist yet."""
+
+        for date in dates:
+            child_fact = cls.child_or_load_table(date)
+            if child_fact.exists(engine):
+                continue
+            with engine.begin() as conn:
+                # table creation encapsulated in a try because of
+                # concurrency issues, we assume that whenever this fails
+                # it is because the table already exists and it was
+                # created by a concurrent DAG run.
+                try:
+                    child_fact.create(conn, checkfirst=True)
+                    cls.attach(child_fact, date, conn)
+                    if FACT_UPSERT:
+                        cls.create_unique_index(child_fact, conn)
+                except:
+                    logging.info(
+                        f"Failed to create table {child_fact}, it probably already exists."
+                    )
+
     @classmethod
     def update_dimension(cls, extract_table):
-        """ update dimension from the new data. """
-        User.update(extract_table)
-        Mac.update(extract_table)
-        AP.update(extract_table)
-        SSID.update(extract_table)
-        Protocol.update(extract_table)
-        logging.info("All dimensions were updated.")
+        """update dimension from the new data.
+
+        All dimensions are updated by a single statement, in which each
+        dimension insert is a common table expression. The inserts are
+        evaluated in the order of `dimensions` when counting their rows, the
+        number of new values of each dimension is returned.
+        """
+        inserts = [
+            d.insert_new(extract_table)
+            .returning(d.__table__.c.key)
+            .cte(f"new_{d.__tablename__}")
+            for d in cls.dimensions
+        ]
+        with engine.begin() as conn:
+            counts = conn.execute(
+                select(
+                    [
+                        select([func.count()])
+                        .select_from(inserted)
+                        .scalar_subquery()
+                        .label(d.__tablename__)
+                        for d, inserted in zip(cls.dimensions, inserts)
+                    ]
+                )
+            ).fetchone()
+        logging.info(f"All dimensions were updated, new values: {dict(counts)}.")
+        return dict(counts)
 
     @classmethod
     def remove_tables(cls, *args):
@@ -412,17 +1340,98 @@ class Fact:
                     table.drop(bind=conn)
                     Base.metadata.remove(table)
 
+    @classmethod
+    def remove_auxiliary_tables(cls, *args):
+        """drop auxiliary tables and the per-file tables suffixed with their
+        date, including those created by another process."""
+
+        with engine.begin() as conn:
+            for name in args:
+                schema, table_name = name.split(".")
+                tables = conn.execute(
+                    text(
+                        """
+                        SELECT c.oid::REGCLASS::TEXT, c.relkind = 'f'
+                        FROM pg_class c
+                        JOIN pg_namespace n ON c.relnamespace = n.oid
+                        WHERE n.nspname = :schema
+                        AND c.relname ~ ('^' || :name || '(_[0-9_]+)?$')
+                        AND c.relkind IN ('r', 'f')
+                        """
+                    ),
+                    schema=schema,
+                    name=table_name,
+                ).fetchall()
+                for table, foreign in tables:
+                    logging.info(f"Removing ETL table {table}.")
+                    conn.execute(
+                        f"DROP {'FOREIGN' if foreign else ''} TABLE IF EXISTS {table}"
+                    )
+                for table in list(Base.metadata.tables.values()):
+                    if table.schema == schema and re.match(
+                        f"^{table_name}(_[0-9_]+)?$", table.name
+                    ):
+                        Base.metadata.remove(table)
+
+    @classmethod
+    def extract_day_keys(cls, extract):
+        """select the extracted rows with the day keys of their timestamps.
+
+        Day keys are joined from dimension.day, or computed from the
+        timestamps if DAY_KEY is "yyyymmdd".
+        """
+
+        if DAY_KEY == "yyyymmdd":
+            return select(
+                [
+                    extract,
+                    SessionDay.key_of(extract.c.sessionstarttime).label(
+                        "session_start_day_key"
+                    ),
+                    SessionDay.key_of(extract.c.sessionendtime).label(
+                        "session_end_day_key"
+                    ),
+                    SessionDay.key_of(extract.c.pulltime).label("pulltime_day_key"),
+                ]
+            )
+
+        return select(
+            [
+                extract,
+                literal_column("start_day.key").label("session_start_day_key"),
+                literal_column("end_day.key").label("session_end_day_key"),
+                literal_column("pull_day.key").label("pulltime_day_key"),
+            ]
+        ).select_from(
+            extract.join(
+                SessionDay.__table__.alias("start_day"),
+                SessionDay.where_clause(extract.c.sessionstarttime, "start_day"),
+                isouter=True,
+            )
+            .join(
+                SessionDay.__table__.alias("end_day"),
+                SessionDay.where_clause(extract.c.sessionendtime, "end_day"),
+                isouter=True,
+            )
+            .join(
+                SessionDay.__table__.alias("pull_day"),
+                SessionDay.where_clause(extract.c.pulltime, "pull_day"),
+                isouter=True,
+            )
+        )
+
     @classmethod
     def etl(cls, date, file_basename, extract_table_name, load_table_name):
         """performs the etl process.
 
-        Extracts the csv file to a foreign table, than copy its
-        content to a fact table.
+        Extracts the staged file to a foreign or staging table, than copy
+        its content to a fact table.
 
         Create a fact table corresponding to the target date if it
         has not been created yet. In case, the table already exists, we
         insert to the existing table and remove duplicates, leaving the
-        entry with the latest pulltime.
+        entry with the latest pulltime. With FACT_UPSERT, rows already in the
+        table for the same session and pulltime are not inserted again.
         """
 
         extract = cls.extract_table(file_basename, extract_table_name)
@@ -432,58 +1441,46 @@ class Fact:
         logging.basicConfig()
         logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
 
-        with engine.begin() as conn:
+        def stage(name):
+            return Metric.measure(name, date, child_fact.fullname, file_basename)
+
+        with stage("extract"), engine.begin() as conn:
             logging.info("Preparing extract table create query.")
             extract.create(conn, checkfirst=True)
+            if not isinstance(extract, ForeignTable):
+                cls.copy_extract(extract, file_basename, conn)
             logging.info("Preparing load table create query.")
             print(load)
             load.create(conn, checkfirst=True)
             logging.info("Auxiliary tables finished creating.")
 
-        with engine.begin() as conn:
-            cls.update_dimension(extract)
+        if DAY_KEY == "yyyymmdd":
+            with stage("days"):
+                SessionDay.update(extract)
 
-            extracted_fact = (
-                select(
-                    [
-                        extract,
-                        literal_column("start_day.key").label("session_start_day_key"),
-                        literal_column("end_day.key").label("session_end_day_key"),
-                        literal_column("pull_day.key").label("pulltime_day_key"),
-                    ]
-                )
-                .select_from(
-                    extract.join(
-                        SessionDay.__table__.alias("start_day"),
-                        SessionDay.where_clause(
-                            extract.c.sessionstarttime, "start_day"
-                        ),
-                        isouter=True,
-                    )
-                    .join(
-                        SessionDay.__table__.alias("end_day"),
-                        SessionDay.where_clause(extract.c.sessionendtime, "end_day"),
-                        isouter=True,
-                    )
-                    .join(
-                        SessionDay.__table__.alias("pull_day"),
-                        SessionDay.where_clause(extract.c.pulltime, "pull_day"),
-                        isouter=True,
-                    )
+        if RESOLVE_KEYS == "server":
+            with stage("dimensions") as details:
+                details.update(cls.update_dimension(extract))
+
+        with stage("load"), engine.begin() as conn:
+            extracted_fact = cls.extract_day_keys(extract).alias("extracted_fact")
+
+            if RESOLVE_KEYS == "client":
+                # dimension keys were resolved while preprocessing
+                keys = [extracted_fact.c[d.fact_key] for d in cls.dimensions]
+                condition = true()
+            else:
+                keys = [d.key.label(d.fact_key) for d in cls.dimensions]
+                condition = and_(
+                    *[d.where_clause(extracted_fact) for d in cls.dimensions]
                 )
-                .alias("extracted_fact")
-            )
 
             conn.execute(
                 load.insert().from_select(
                     load.columns,
                     select(
                         [
-                            User.key.label("userid_key"),
-                            Mac.key.label("mac_key"),
-                            AP.key.label("ap_key"),
-                            SSID.key.label("ssid_key"),
-                            Protocol.key.label("protocol_key"),
+                            *keys,
                             extracted_fact.c.sessionstarttime,
                             extracted_fact.c.session_start_day_key,
                             # adjust session end such that it is equal or later than session start
@@ -545,46 +1542,415 @@ class Fact:
                             ),
                             extracted_fact.c.rssi,
                         ]
-                    ).where(
-                        and_(
-                            User.where_clause(extracted_fact),
-                            Mac.where_clause(extracted_fact),
-                            AP.where_clause(extracted_fact),
-                            SSID.where_clause(extracted_fact),
-                            Protocol.where_clause(extracted_fact),
+                    ).where(condition),
+                )
+            )
+
+        with stage("partitions"):
+            cls.create_partitions([date])
+
+        if CONSOLIDATION_MODE == "incremental":
+            delta = cls.delta_table(date)
+            if not delta.exists(engine):
+                with engine.begin() as conn:
+                    # same as above, this fails if a concurrent DAG run
+                    # created the table first
+                    try:
+                        delta.create(conn, checkfirst=True)
+                    except:
+                        logging.info(
+                            f"Failed to create table {delta}, it probably already exists."
                         )
-                    ),
+
+        if FACT_UPSERT:
+            with stage("unique index"), engine.begin() as conn:
+                cls.create_unique_index(child_fact, conn)
+
+        if FACT_SESSION_KEY:
+            facts = select([*load.c, cls.session_key(load.fullname)])
+            sessions = select([cls.session_key(load.fullname)]).select_from(load)
+        else:
+            facts = load.select()
+            sessions = select([load.c[c] for c in cls.session_columns])
+
+        with stage("insert"), engine.begin() as conn:
+            if FACT_UPSERT:
+                conn.execute(
+                    insert(child_fact)
+                    .from_select(child_fact.columns, facts)
+                    .on_conflict_do_nothing(index_elements=cls.session_index()[1])
+                )
+            else:
+                conn.execute(child_fact.insert().from_select(child_fact.columns, facts))
+            if CONSOLIDATION_MODE == "incremental":
+                # the sessions are recorded in the same transaction as the
+                # facts, so that consolidation never misses them
+                conn.execute(
+                    delta.insert().from_select(delta.columns, sessions.distinct())
                 )
+
+        logging.info(f"Removing ETL tables: {extract_table_name}, {load_table_name}")
+        cls.remove_tables(extract_table_name, load_table_name)
+
+        logging.getLogger("sqlalchemy.engine").setLevel(logging.WARN)
+
+    @classmethod
+    def create_indices(cls, child_fact, conn, concurrently=False):
+        """create the missing indices of a daily fact table.
+
+        Indices are named after their table and columns, so that each one is
+        built once. If `concurrently`, indices are built without blocking
+        inserts, which requires `conn` to be in autocommit mode, and invalid
+        indices left by interrupted builds are built again.
+        """
+
+        logging.info("Creating table indices.")
+        concurrently = "CONCURRENTLY" if concurrently else ""
+
+        for suffix, columns in cls.get_indices().items():
+            name = f"ix_{child_fact.schema}_{child_fact.name}_{suffix}"
+            valid = conn.execute(
+                text(
+                    """
+                    SELECT i.indisvalid
+                    FROM pg_index i
+                    JOIN pg_class c ON i.indexrelid = c.oid
+                    JOIN pg_namespace n ON c.relnamespace = n.oid
+                    WHERE n.nspname = :schema AND c.relname = :name
+                    """
+                ),
+                schema=child_fact.schema,
+                name=name,
+            ).scalar()
+            if valid:
+                continue
+            if valid is not None:
+                logging.info(f"Dropping invalid index {name}.")
+                conn.execute(
+                    f"DROP INDEX {concurrently} {child_fact.schema}.{name}"
+                )
+            # upserts rely on the session and pulltime index being unique
+            session_index = suffix == cls.session_index()[0]
+            unique = "UNIQUE" if FACT_UPSERT and session_index else ""
+            conn.execute(
+                f"""
+                CREATE {unique} INDEX {concurrently} IF NOT EXISTS {name}
+                ON {child_fact.fullname} ({", ".join(columns)})
+                """
             )
 
-        if not child_fact.exists(engine):
+    @classmethod
+    def create_unique_index(cls, child_fact, conn):
+        """make the session and pulltime index of a daily fact table unique.
+
+        Upserts rely on this index. If it is missing or not unique, for
+        instance on tables ingested before FACT_UPSERT was set, duplicate
+        inserts are removed and the index is built again, the table is locked
+        against inserts in the meantime.
+        """
+
+        suffix, columns = cls.session_index()
+        name = f"ix_{child_fact.schema}_{child_fact.name}_{suffix}"
+
+        def is_unique():
+            return conn.execute(
+                text(
+                    """
+                    SELECT i.indisunique AND i.indisvalid
+                    FROM pg_index i
+                    JOIN pg_class c ON i.indexrelid = c.oid
+                    JOIN pg_namespace n ON c.relnamespace = n.oid
+                    WHERE n.nspname = :schema AND c.relname = :name
+                    """
+                ),
+                schema=child_fact.schema,
+                name=name,
+            ).scalar()
+
+        if is_unique():
+            return
+
+        # checked again once concurrent runs are locked out
+        conn.execute(f"LOCK TABLE {child_fact.fullname} IN SHARE ROW EXCLUSIVE MODE")
+        if is_unique():
+            return
+
+        logging.info(f"Creating unique index {name}.")
+        cls.remove_duplicates(child_fact, conn)
+        conn.execute(f"DROP INDEX IF EXISTS {child_fact.schema}.{name}")
+        conn.execute(
+            f"""
+            CREATE UNIQUE INDEX {name}
+            ON {child_fact.fullname} ({", ".join(columns)})
+            """
+        )
+
+    @classmethod
+    def remove_duplicates(cls, child_fact, conn):
+        """ remove duplicate inserts of a session and pulltime. """
+
+        logging.info("Removing duplicate inserts.")
+        conn.execute(
+            f"""
+                DELETE FROM {child_fact.fullname} T1
+                       USING {child_fact.fullname} T2
+                WHERE T1.ctid > T2.ctid
+                AND   T1.pulltime = T2.pulltime
+                AND   {cls.session_join("T1", "T2")};
+                """
+        )
+
+    @classmethod
+    def index(cls, child_fact):
+        """ create the missing indices of a daily fact table as configured. """
+
+        if FACT_INDEX_BUILD == "concurrently":
+            with engine.connect().execution_options(
+                isolation_level="AUTOCOMMIT"
+            ) as conn:
+                cls.create_indices(child_fact, conn, concurrently=True)
+        else:
             with engine.begin() as conn:
-                # table creation encapsulated in a try because of
-                # concurrency issues, we assume that whenever this fails
-                # it is because the table already exists and it was
-                # created by a concurrent DAG run.
-                try:
-                    child_fact.create(conn, checkfirst=True)
-                    conn.execute(
-                        f"ALTER TABLE {child_fact.fullname} INHERIT fact.session"
+                cls.create_indices(child_fact, conn)
+
+    @classmethod
+    def rebuild(cls, date, child_fact, indexed=True):
+        """consolidate a daily fact table in a single pass.
+
+        The consolidated rows are written to a new table in one scan, where
+        duplicate inserts are dropped and every session takes the end, status
+        and duration of its last pull. The new table then replaces the daily
+        table, which is locked against inserts in the meantime. The indices
+        are built on the new table if `indexed`.
+
+        The new table is indexed and analyzed before it replaces the daily
+        table, fact.session is only locked by the swap, at the end of the
+        transaction.
+        """
+
+        rebuilt_name = f"{child_fact.name}_rebuild"
+        rebuilt = f"{child_fact.schema}.{rebuilt_name}"
+        session = ", ".join(cls.get_session_columns())
+        session_key = ", session_key" if FACT_SESSION_KEY else ""
+
+        with engine.begin() as conn:
+
+            conn.execute(f"LOCK TABLE {child_fact.fullname} IN SHARE MODE")
+
+            logging.info(f"Writing consolidated sessions to {rebuilt}.")
+            conn.execute(
+                f"""
+                CREATE TABLE {rebuilt} (
+                    LIKE {child_fact.fullname}
+                    INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+                )
+                """
+            )
+            conn.execute(
+                f"""
+                    INSERT INTO {rebuilt} (
+                        userid_key,
+                        mac_key,
+                        ap_key,
+                        ssid_key,
+                        protocol_key,
+                        session_start,
+                        session_start_day_key,
+                        session_end,
+                        session_end_day_key,
+                        session_duration,
+                        pulltime,
+                        pulltime_day_key,
+                        pulltime_last,
+                        status,
+                        rssi{session_key}
                     )
-                except:
-                    logging.info(
-                        f"Failed to create table {child_fact}, it probably already exists."
+                    SELECT
+                        userid_key,
+                        mac_key,
+                        ap_key,
+                        ssid_key,
+                        protocol_key,
+                        session_start,
+                        session_start_day_key,
+                        CASE
+                            WHEN last_status = 'ongoing' THEN last_pulltime
+                            ELSE last_session_end
+                        END,
+                        CASE
+                            WHEN last_status = 'ongoing' THEN last_pulltime_day_key
+                            ELSE last_session_end_day_key
+                        END,
+                        CASE
+                            WHEN last_status = 'ongoing' THEN last_pulltime
+                            ELSE last_session_end
+                        END - session_start,
+                        pulltime,
+                        pulltime_day_key,
+                        pulltime = last_pulltime,
+                        last_status,
+                        rssi{session_key}
+                    FROM (
+                        SELECT
+                            T1.*,
+                            last_value(pulltime) OVER wnd AS last_pulltime,
+                            last_value(pulltime_day_key) OVER wnd
+                                AS last_pulltime_day_key,
+                            last_value(session_end) OVER wnd AS last_session_end,
+                            last_value(session_end_day_key) OVER wnd
+                                AS last_session_end_day_key,
+                            last_value(status) OVER wnd AS last_status
+                        FROM (
+                            SELECT DISTINCT ON ({session}, pulltime) *
+                            FROM {child_fact.fullname}
+                            ORDER BY {session}, pulltime, ctid
+                        ) T1
+                        WINDOW wnd AS (
+                            PARTITION BY {session}
+                            ORDER BY pulltime
+                            ROWS BETWEEN
+                                UNBOUNDED PRECEDING
+                                AND UNBOUNDED FOLLOWING
+                        )
+                    ) T2
+                """
+            )
+
+            # rows were copied from a table with the same foreign keys, these
+            # do not need to be validated again
+            foreign_keys = ", ".join(
+                f"""
+                ADD FOREIGN KEY ({fk.parent.name})
+                REFERENCES {fk.column.table.fullname} ({fk.column.name})
+                NOT VALID
+                """
+                for fk in child_fact.foreign_keys
+            )
+            conn.execute(f"ALTER TABLE {rebuilt} {foreign_keys}")
+            conn.execute(
+                f"ALTER TABLE {rebuilt} ALTER COLUMN session_start SET NOT NULL"
+            )
+
+            # the new table is not visible to other transactions yet, there
+            # is no need to build its indices concurrently
+            staging = Table(rebuilt_name, MetaData(), schema=child_fact.schema)
+            if indexed:
+                cls.create_indices(staging, conn)
+            elif FACT_UPSERT:
+                cls.create_unique_index(staging, conn)
+            conn.execute(f"ANALYZE {rebuilt}")
+
+            logging.info(f"Replacing {child_fact.fullname} with {rebuilt}.")
+            conn.execute(f"DROP TABLE {child_fact.fullname}")
+            conn.execute(f"ALTER TABLE {rebuilt} RENAME TO {child_fact.name}")
+            prefix = f"ix_{child_fact.schema}_{rebuilt_name}_"
+            indices = conn.execute(
+                text(
+                    """
+                    SELECT indexname FROM pg_indexes
+                    WHERE schemaname = :schema AND tablename = :name
+                    """
+                ),
+                schema=child_fact.schema,
+                name=child_fact.name,
+            ).fetchall()
+            for (index,) in indices:
+                if index.startswith(prefix):
+                    suffix = index[len(prefix) :]
+                    conn.execute(
+                        f"""
+                        ALTER INDEX {child_fact.schema}.{index}
+                        RENAME TO ix_{child_fact.schema}_{child_fact.name}_{suffix}
+                        """
                     )
+            cls.attach(child_fact, date, conn)
+
+    @classmethod
+    def consolidate_delta(cls, date, child_fact):
+        """consolidate the sessions inserted since the last consolidation.
+
+        The sessions recorded in the delta table are consumed, their duplicate
+        inserts are removed and their rows take the end, status and duration
+        of their last pull. Other sessions are left untouched.
+        """
+
+        delta = cls.delta_table(date)
+        session_columns = cls.get_session_columns()
+        session = ", ".join(session_columns)
+        join = cls.session_join
 
         with engine.begin() as conn:
+
+            logging.info(f"Consuming sessions from {delta.fullname}.")
             conn.execute(
-                child_fact.insert().from_select(child_fact.columns, load.select())
+                f"""
+                    CREATE TEMPORARY TABLE delta ON COMMIT DROP AS
+                    SELECT * FROM {delta.fullname} WITH NO DATA
+                """
+            )
+            conn.execute(
+                f"""
+                    WITH consumed AS (
+                        DELETE FROM {delta.fullname} RETURNING *
+                    )
+                    INSERT INTO delta SELECT DISTINCT * FROM consumed
+                """
             )
+            conn.execute("ANALYZE delta")
 
-        logging.info(f"Removing ETL tables: {extract_table_name}, {load_table_name}")
-        cls.remove_tables(extract_table_name, load_table_name)
+            # upserts never write duplicate inserts
+            if not FACT_UPSERT:
+                logging.info("Removing duplicate inserts.")
+                conn.execute(
+                    f"""
+                        DELETE FROM {child_fact.fullname} T1
+                               USING {child_fact.fullname} T2, delta D
+                        WHERE T1.ctid > T2.ctid
+                        AND   T1.pulltime = T2.pulltime
+                        AND   {join("T1", "T2")}
+                        AND   {join("T1", "D")}
+                    """
+                )
 
-        logging.getLogger("sqlalchemy.engine").setLevel(logging.WARN)
+            logging.info("Resolving last pulltime, session end and status.")
+            conn.execute(
+                f"""
+                    UPDATE {child_fact.fullname} T1
+                    SET
+                        pulltime_last = T1.pulltime = T2.pulltime,
+                        session_end = T2.session_end,
+                        session_end_day_key = T2.session_end_day_key,
+                        status = T2.status,
+                        session_duration = T2.session_end - T1.session_start
+                    FROM (
+                        SELECT DISTINCT ON ({session})
+                            {", ".join(f"F.{c}" for c in session_columns)},
+                            F.pulltime,
+                            CASE
+                                WHEN F.status = 'ongoing' THEN F.pulltime
+                                ELSE F.session_end
+                            END AS session_end,
+                            CASE
+                                WHEN F.status = 'ongoing' THEN F.pulltime_day_key
+                                ELSE F.session_end_day_key
+                            END AS session_end_day_key,
+                            F.status
+                        FROM {child_fact.fullname} F JOIN delta D USING ({session})
+                        ORDER BY {session}, F.pulltime DESC, F.ctid DESC
+                    ) T2
+                    WHERE {join("T1", "T2")}
+                """
+            )
 
     @classmethod
-    def consolidate(cls, date):
+    def consolidate(cls, date, final=False):
+        """consolidate a daily fact table.
+
+        Indices are built on every consolidation, or only when the day is
+        `final` if FACT_INDEX_POLICY is "final". With incremental
+        consolidations, a `final` one goes over the whole table and drops its
+        delta table.
+        """
 
         child_fact = cls.child_or_load_table(date)
 
@@ -593,29 +1959,47 @@ class Fact:
 
         logging.info(f"Consolidating {child_fact.fullname}.")
 
-        with engine.begin() as conn:
-            logging.info("Creating table indices.")
-            Index(None, child_fact.c.session_start).create(conn)
-            Index(None, child_fact.c.session_end).create(conn)
-            Index(None, child_fact.c.pulltime_last).create(conn)
+        indexed = FACT_INDEX_POLICY == "always" or final
 
-        with engine.begin() as conn:
+        def stage(name):
+            return Metric.measure(name, date, child_fact.fullname)
 
-            logging.info("Removing duplicate inserts.")
-            conn.execute(
-                f"""
-                    DELETE FROM {child_fact.fullname} T1
-                           USING {child_fact.fullname} T2
-                    WHERE T1.ctid > T2.ctid
-                    AND   T1.pulltime = T2.pulltime
-                    AND   T1.userid_key = T2.userid_key
-                    AND   T1.mac_key = T2.mac_key
-                    AND   T1.ap_key = T2.ap_key
-                    AND   T1.ssid_key = T2.ssid_key
-                    AND   T1.protocol_key = T2.protocol_key
-                    AND   T1.session_start = T2.session_start;
-                    """
-            )
+        if CONSOLIDATION_MODE == "rebuild":
+            with stage("rebuild"):
+                cls.rebuild(date, child_fact, indexed)
+            logging.getLogger("sqlalchemy.engine").setLevel(logging.WARN)
+            return
+
+        if indexed:
+            with stage("index"):
+                cls.index(child_fact)
+
+        # without a delta table, for instance when the facts were ingested
+        # before switching modes, or on a final consolidation, the whole table
+        # is consolidated
+        if (
+            CONSOLIDATION_MODE == "incremental"
+            and not final
+            and cls.delta_table(date).exists(engine)
+        ):
+            with stage("consolidate delta"):
+                cls.consolidate_delta(date, child_fact)
+            logging.getLogger("sqlalchemy.engine").setLevel(logging.WARN)
+            return
+
+        session = ", ".join(cls.get_session_columns())
+
+        with stage("consolidate"), engine.begin() as conn:
+
+            if CONSOLIDATION_MODE == "incremental" and final:
+                # dropped first, the sessions a concurrent etl run records in
+                # it make that run fail and be retried once the date is final
+                logging.info("Dropping the delta table.")
+                conn.execute(f"DROP TABLE IF EXISTS {cls.delta_table(date).fullname}")
+
+            # upserts never write duplicate inserts
+            if not FACT_UPSERT:
+                cls.remove_duplicates(child_fact, conn)
 
             logging.info("Resetting pulltime flag.")
             conn.execute(
@@ -645,30 +2029,12 @@ class Fact:
                             ELSE T1.session_end
                         END - T1.session_start
                     FROM (
-                        SELECT DISTINCT ON (
-                            userid_key,
-                            mac_key,
-                            ap_key,
-                            ssid_key,
-                            protocol_key,
-                            session_start
-                        )
-                        userid_key,
-                        mac_key,
-                        ap_key,
-                        ssid_key,
-                        protocol_key,
-                        session_start,
+                        SELECT DISTINCT ON ({session})
+                        {session},
                         last_value(pulltime) OVER wnd AS pulltime
                         FROM {child_fact.fullname}
                         WINDOW wnd AS (
-                            PARTITION BY
-                                userid_key,
-                                mac_key,
-                                ap_key,
-                                ssid_key,
-                                protocol_key,
-                                session_start
+                            PARTITION BY {session}
                             ORDER BY pulltime, ctid
                             ROWS BETWEEN
                                 UNBOUNDED PRECEDING
@@ -676,12 +2042,7 @@ class Fact:
                         )
                     ) T2
                     WHERE T1.pulltime = T2.pulltime
-                    AND T1.userid_key = T2.userid_key
-                    AND T1.mac_key = T2.mac_key
-                    AND T1.ap_key = T2.ap_key
-                    AND T1.ssid_key = T2.ssid_key
-                    AND T1.protocol_key = T2.protocol_key
-                    AND T1.session_start = T2.session_start;
+                    AND {cls.session_join("T1", "T2")};
                 """
             )
 
@@ -696,12 +2057,7 @@ class Fact:
                         session_duration = T2.session_duration
                     FROM (
                         SELECT
-                            userid_key,
-                            mac_key,
-                            ap_key,
-                            ssid_key,
-                            protocol_key,
-                            session_start,
+                            {session},
                             session_end,
                             session_end_day_key,
                             status,
@@ -709,12 +2065,7 @@ class Fact:
                         FROM {child_fact.fullname}
                         WHERE pulltime_last
                     ) T2
-                    WHERE T1.userid_key = T2.userid_key
-                    AND T1.mac_key = T2.mac_key
-                    AND T1.ap_key = T2.ap_key
-                    AND T1.ssid_key = T2.ssid_key
-                    AND T1.protocol_key = T2.protocol_key
-                    AND T1.session_start = T2.session_start;
+                    WHERE {cls.session_join("T1", "T2")};
                 """
             )
 
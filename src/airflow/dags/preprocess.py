@@ -0,0 +1,270 @@
+import csv
+import struct
+import logging
+import pandas as pd
+import numpy as np
+from pathlib import Path
+
+from environment import TIMEZONE_OFFSET
+
+COLUMNS = [
+    "username",
+    "macaddress",
+    "protocol",
+    "apname",
+    "location",
+    "ssid",
+    "sessionstarttime",
+    "sessionendtime",
+    "pulltime",
+    "rssi",
+]
+
+# columns identifying a session across pulls
+SESSION_COLUMNS = [
+    "username",
+    "macaddress",
+    "protocol",
+    "apname",
+    "location",
+    "ssid",
+    "sessionstarttime",
+]
+
+# open sessions are logged with an end time of 2100-01-01 00:00:00 GMT+00:00
+MISSING_TIME = 4102444800 + TIMEZONE_OFFSET
+
+# file suffix of each staging format
+STAGING_SUFFIXES = {"csv": ".csv", "binary": ".pgcopy"}
+
+# postgres binary copy header, trailer and epoch (2000-01-01) in microseconds
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+PGCOPY_TRAILER = struct.pack(">h", -1)
+PGCOPY_EPOCH = 946684800 * 1000000
+PGCOPY_NULL = struct.pack(">i", -1)
+
+
+def read_pull_file(file_name, chunksize=None):
+    """read a raw pull file.
+
+    If `chunksize` is given the file is read in chunks of at most `chunksize`
+    rows, otherwise a single chunk with the whole file is returned.
+    """
+
+    reader = pd.read_csv(
+        file_name,
+        header=None,
+        names=COLUMNS,
+        sep="\t",
+        quoting=csv.QUOTE_NONE,
+        chunksize=chunksize if chunksize else None,
+    )
+    if chunksize:
+        return reader
+    else:
+        return [reader]
+
+
+def transform(df):
+    """convert timestamps and assign null values to missing end times.
+
+    Timestamps are converted with integer arithmetic on the raw epoch values,
+    flooring to the second, before being cast to datetimes in bulk.
+    """
+
+    df.fillna("N/A", inplace=True)
+
+    start = df["sessionstarttime"].values.astype(np.int64) // 1000 + TIMEZONE_OFFSET
+    end = df["sessionendtime"].values.astype(np.int64) // 1000 + TIMEZONE_OFFSET
+    pull = df["pulltime"].values.astype(np.int64) + TIMEZONE_OFFSET
+
+    df["sessionstarttime"] = start.astype("datetime64[s]").astype("datetime64[ns]")
+    df["sessionendtime"] = np.where(
+        end == MISSING_TIME, np.datetime64("NaT"), end.astype("datetime64[s]")
+    ).astype("datetime64[ns]")
+    df["pulltime"] = pull.astype("datetime64[s]").astype("datetime64[ns]")
+
+    return df
+
+
+def assign_keys(df, dimensions, resolve):
+    """add the surrogate key column of each dimension to preprocessed rows.
+
+    `dimensions` maps each key column to the columns holding the dimension
+    values, `resolve` receives the unique value tuples of each key column and
+    returns their keys.
+    """
+
+    values = {}
+    for key, columns in dimensions.items():
+        values[key] = df[columns].astype(str).drop_duplicates()
+
+    keys = resolve(
+        {k: list(v.itertuples(index=False, name=None)) for k, v in values.items()}
+    )
+
+    for key, columns in dimensions.items():
+        lookup = pd.Series(keys[key], index=pd.MultiIndex.from_frame(values[key]))
+        rows = pd.MultiIndex.from_frame(df[columns].astype(str))
+        df[key] = lookup.reindex(rows).values
+
+    return df
+
+
+class DuplicateFilter:
+    """Remove duplicate rows across the chunks of a pull file.
+
+    Rows are identified by a 64-bit hash of their content, or of `columns` if
+    given, seen hashes are kept in a sorted array so that memory usage is 8
+    bytes per unique row. The first of duplicate rows is kept.
+    """
+
+    def __init__(self, columns=None):
+        self.columns = columns
+        self.seen = np.empty(0, dtype=np.uint64)
+
+    def __call__(self, df):
+        rows = df if self.columns is None else df[self.columns]
+        hashes = pd.util.hash_pandas_object(rows, index=False).values
+        idx = np.searchsorted(self.seen, hashes)
+        idx[idx == len(self.seen)] = 0
+        if len(self.seen) > 0:
+            seen = self.seen[idx] == hashes
+        else:
+            seen = np.zeros(len(hashes), dtype=bool)
+        keep = ~(seen | pd.Series(hashes).duplicated().values)
+        self.seen = np.sort(np.concatenate([self.seen, hashes[keep]]), kind="mergesort")
+        return df[keep]
+
+
+class LatestPullFilter(DuplicateFilter):
+    """Keep only the latest pull of each session.
+
+    Pull files must be filtered from the most recent to the oldest, rows of a
+    session are then dropped once a row with the same session columns has
+    been kept, within a chunk the row with the latest pull time is kept.
+    """
+
+    def __init__(self):
+        super().__init__(SESSION_COLUMNS)
+
+    def __call__(self, df):
+        df = df.sort_values("pulltime", ascending=False, kind="mergesort")
+        return super().__call__(df)
+
+
+def pgcopy_text(values):
+    """ encode text values as binary copy fields. """
+    out = []
+    for value in values:
+        value = f"{value}".encode("utf-8")
+        out.append(struct.pack(">i", len(value)) + value)
+    return out
+
+
+def pgcopy_timestamp(values):
+    """ encode datetime64 values as binary copy timestamp fields. """
+    null = np.isnat(values)
+    micros = values.astype("datetime64[us]").astype(np.int64) - PGCOPY_EPOCH
+    fields = np.empty(len(values), dtype=[("length", ">i4"), ("value", ">i8")])
+    fields["length"] = 8
+    fields["value"] = micros
+    fields = fields.tobytes()
+    return [
+        PGCOPY_NULL if null[i] else fields[i * 12 : (i + 1) * 12]
+        for i in range(len(values))
+    ]
+
+
+def pgcopy_integer(values):
+    """ encode integer values as binary copy int4 fields. """
+    values = pd.to_numeric(values, errors="coerce")
+    null = np.isnan(values.values.astype(float))
+    fields = np.empty(len(values), dtype=[("length", ">i4"), ("value", ">i4")])
+    fields["length"] = 4
+    fields["value"] = np.where(null, 0, values.values).astype(np.int32)
+    fields = fields.tobytes()
+    return [
+        PGCOPY_NULL if null[i] else fields[i * 8 : (i + 1) * 8]
+        for i in range(len(values))
+    ]
+
+
+def to_pgcopy(df):
+    """encode preprocessed rows as postgres binary copy tuples.
+
+    This allows the database to load the rows without parsing any text, the
+    columns are encoded in the order of the data frame.
+    """
+
+    fields = []
+    for column in df.columns:
+        if column in ["sessionstarttime", "sessionendtime", "pulltime"]:
+            fields.append(pgcopy_timestamp(df[column].values))
+        elif column == "rssi" or column.endswith("_key"):
+            fields.append(pgcopy_integer(df[column]))
+        else:
+            fields.append(pgcopy_text(df[column].values))
+    field_count = struct.pack(">h", len(df.columns))
+    return b"".join(field_count + b"".join(row) for row in zip(*fields))
+
+
+class DateWriter:
+    """Append preprocessed rows to one staging file per session start date.
+
+    Each date file is truncated the first time it is written to, and
+    appended to afterwards. Files that `can_process` rejects are skipped.
+    Rows are staged as csv, or as postgres binary copy files if `format` is
+    "binary", in which case `close` must be called once all rows are written.
+    """
+
+    def __init__(self, directory, file_stem, can_process, format="csv"):
+        self.directory = Path(directory)
+        self.file_stem = file_stem
+        self.can_process = can_process
+        self.format = format
+        self.suffix = STAGING_SUFFIXES[format]
+        self.files = {}
+
+    def write(self, df):
+        """ split rows by session start date and append them to their file. """
+
+        days = df["sessionstarttime"].values.astype("datetime64[D]")
+
+        for day, group in df.groupby(days):
+
+            date_str = pd.Timestamp(day).strftime("%Y_%m_%d")
+            group_file_path = (
+                self.directory / f"{self.file_stem}_{date_str}{self.suffix}"
+            )
+
+            if date_str not in self.files:
+                if self.can_process(group_file_path, date_str):
+                    self.files[date_str] = group_file_path
+                    mode, header = "w", True
+                else:
+                    self.files[date_str] = None
+                    continue
+            elif self.files[date_str] is None:
+                continue
+            else:
+                mode, header = "a", False
+
+            if self.format == "binary":
+                with open(group_file_path, f"{mode}b") as f:
+                    if header:
+                        f.write(PGCOPY_HEADER)
+                    f.write(to_pgcopy(group))
+            else:
+                # timestamps are written in ISO format by pandas' native
+                # formatter, missing end times are written as empty fields
+                group.to_csv(group_file_path, index=False, mode=mode, header=header)
+            logging.info(f"Preprocessed group, {group_file_path}:\n{group.head()}")
+
+    def close(self):
+        """ finish writing the staging files. """
+        if self.format == "binary":
+            for group_file_path in self.files.values():
+                if group_file_path is not None:
+                    with open(group_file_path, "ab") as f:
+                        f.write(PGCOPY_TRAILER)
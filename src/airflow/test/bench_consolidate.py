@@ -0,0 +1,206 @@
+#!/bin/python
+#
+# CONSOLIDATION BENCHMARK
+# =======================
+#
+# Compares the consolidation of a daily fact table in place, through a
+# sequence of DELETE and UPDATE statements ("update" mode), with rebuilding it
+# from a single pass over its rows ("rebuild" mode), see `Fact.consolidate` in
+# `src/airflow/dags/models.py`.
+#
+# A synthetic day of pulls is written to the daily fact table of `--date` before
+# each run. Sessions are pulled every 15 minutes until they complete, some are
+# still ongoing at their last pull and a fraction of the rows is inserted
+# twice. Dimension keys are sampled from the existing dimensions, so the
+# warehouse must hold some ingested data. The daily table of `--date` is
+# dropped, make sure it does not hold real data.
+#
+# The database connection is resolved as for the tests, from the environment
+# or from `.env-dev`.
+#
+#   python src/airflow/test/bench_consolidate.py --sessions 200000
+
+import sys
+import time
+import logging
+import argparse
+import pendulum
+from pathlib import Path
+from sqlalchemy import text
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv(".env-dev"))
+
+sys.path.insert(0, (Path(__file__).parent / "../dags").resolve().__str__())
+
+import models
+from models import engine, Fact
+
+
+def fill(table, date, sessions, pulls, duplicates, seed):
+    """write a synthetic day of pulls to a daily fact table.
+
+    Each session is pulled on average `pulls` times, a `duplicates` fraction of
+    the rows is inserted twice.
+    """
+
+    with engine.begin() as conn:
+        conn.execute(text("SELECT setseed(:seed)"), seed=seed)
+        conn.execute(
+            text(
+                f"""
+            INSERT INTO {table.fullname} (
+                userid_key,
+                mac_key,
+                ap_key,
+                ssid_key,
+                protocol_key,
+                session_start,
+                session_end,
+                pulltime,
+                pulltime_last,
+                status,
+                rssi
+            )
+            SELECT
+                s.userid_key,
+                s.mac_key,
+                s.ap_key,
+                s.ssid_key,
+                s.protocol_key,
+                s.session_start,
+                CASE WHEN s.session_end <= p.pulltime THEN s.session_end END,
+                p.pulltime,
+                FALSE,
+                CASE
+                    WHEN s.session_end <= p.pulltime THEN 'completed'
+                    ELSE 'ongoing'
+                END::SESSIONSTATUS,
+                s.rssi
+            FROM (
+                SELECT
+                    k.u[1 + floor(random() * array_length(k.u, 1))::INTEGER] AS userid_key,
+                    k.m[1 + floor(random() * array_length(k.m, 1))::INTEGER] AS mac_key,
+                    k.a[1 + floor(random() * array_length(k.a, 1))::INTEGER] AS ap_key,
+                    k.s[1 + floor(random() * array_length(k.s, 1))::INTEGER] AS ssid_key,
+                    k.p[1 + floor(random() * array_length(k.p, 1))::INTEGER] AS protocol_key,
+                    f.session_start,
+                    f.session_start + f.pull_count * random() * INTERVAL '15 minutes'
+                        AS session_end,
+                    f.pull_count,
+                    -90 + floor(random() * 60)::INTEGER AS rssi
+                FROM (
+                    SELECT
+                        (SELECT array_agg(key) FROM dimension.userid) AS u,
+                        (SELECT array_agg(key) FROM dimension.mac) AS m,
+                        (SELECT array_agg(key) FROM dimension.ap) AS a,
+                        (SELECT array_agg(key) FROM dimension.ssid) AS s,
+                        (SELECT array_agg(key) FROM dimension.protocol) AS p
+                ) k,
+                LATERAL (
+                    SELECT
+                        :date + date_trunc('second', random() * INTERVAL '1 day')
+                            AS session_start,
+                        1 + floor(random() * (2 * :pulls - 1))::INTEGER AS pull_count
+                    FROM generate_series(1, :sessions)
+                ) f
+            ) s,
+            LATERAL (
+                SELECT s.session_start + i * INTERVAL '15 minutes' AS pulltime
+                FROM generate_series(1, s.pull_count) i
+            ) p,
+            LATERAL generate_series(
+                1, CASE WHEN random() < :duplicates THEN 2 ELSE 1 END
+            ) d
+            """
+            ),
+            date=date,
+            sessions=sessions,
+            pulls=pulls,
+            duplicates=duplicates,
+        )
+        conn.execute(f"ANALYZE {table.fullname}")
+        return conn.execute(f"SELECT COUNT(*) FROM {table.fullname}").scalar()
+
+
+def checksum(table):
+    """ checksum of the table content, regardless of the row order. """
+    with engine.begin() as conn:
+        return conn.execute(
+            f"""
+            SELECT md5(string_agg(t::TEXT, ',' ORDER BY t::TEXT))
+            FROM {table.fullname} t
+            """
+        ).scalar()
+
+
+def drop(date):
+    """ drop the daily fact table, forgetting its indices. """
+    table = Fact.child_or_load_table(date)
+    table.drop(engine, checkfirst=True)
+    models.Base.metadata.remove(table)
+
+
+def bench(mode, date, args):
+
+    drop(date)
+    Fact.create_partitions([date])
+    table = Fact.child_or_load_table(date)
+    rows = fill(table, date, args.sessions, args.pulls, args.duplicates, args.seed)
+
+    models.CONSOLIDATION_MODE = mode
+    start = time.perf_counter()
+    Fact.consolidate(date)
+    elapsed = time.perf_counter() - start
+
+    print(f"{mode:<8} {elapsed:>8.2f}s {rows / elapsed:>14,.0f} rows/s")
+    result = checksum(table)
+    drop(date)
+    return elapsed, result
+
+
+def main(args):
+
+    date = pendulum.parse(args.date).naive()
+
+    with engine.begin() as conn:
+        for dimension in ["userid", "mac", "ap", "ssid", "protocol"]:
+            if conn.execute(f"SELECT 1 FROM dimension.{dimension} LIMIT 1").scalar():
+                continue
+            raise Exception(f"dimension.{dimension} is empty, ingest some data first.")
+
+    # consolidation logs every statement
+    logging.disable(logging.WARNING)
+
+    before, expected = bench("update", date, args)
+    after, result = bench("rebuild", date, args)
+    print(f"Speed-up: {before / after:.1f}x")
+    print(f"Same result: {expected == result}")
+
+
+if __name__ == "__main__":
+
+    cli = argparse.ArgumentParser(description="Benchmark the consolidation stage.")
+    cli.add_argument(
+        "-d",
+        "--date",
+        default="1999-01-01",
+        help="date of the daily fact table, which is dropped.",
+    )
+    cli.add_argument(
+        "-n", "--sessions", default=200000, type=int, help="sessions in the day."
+    )
+    cli.add_argument(
+        "-p", "--pulls", default=4, type=int, help="average pulls per session."
+    )
+    cli.add_argument(
+        "-u",
+        "--duplicates",
+        default=0.01,
+        type=float,
+        help="fraction of rows inserted twice.",
+    )
+    cli.add_argument(
+        "-s", "--seed", default=0, type=float, help="random seed, from -1 to 1."
+    )
+    main(cli.parse_args())
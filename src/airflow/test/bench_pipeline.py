@@ -0,0 +1,422 @@
+#!/bin/python
+#
+# PIPELINE BENCHMARK
+# ==================
+#
+# Measures the throughput of the whole pipeline, from raw pull files to
+# consolidated daily fact tables, by running `dag_etl.preprocess_callable`,
+# `dag_etl.ingest_callable` (and hence `Fact.etl`) and `Fact.consolidate` on a
+# synthetic campus as the Airflow DAGs would.
+#
+# The campus has `--users` users carrying on average `--devices` devices each.
+# Users spend most of their sessions on the access points of their home
+# building and the rest on popular access points elsewhere, session starts
+# follow a daily profile peaking during office hours and durations are log
+# normal. Every 5 minutes a pull file lists the sessions that are open, with a
+# missing end time, or that ended since the previous pull, so open sessions are
+# pulled again and again, and a fraction of the rows is duplicated.
+#
+# Pull files cover `--hours` hours from the start of `--date`. They are
+# ingested in batches of `--batch` files and the days they touch are
+# consolidated every `--consolidate-every` batches, then a last time as final.
+# The daily tables of the days around `--date` are dropped before the run and
+# those of every day it touched after it, make sure they do not hold real
+# data. The synthetic users, devices and access points are left in the
+# dimensions.
+#
+# The settings of `src/airflow/dags/environment.py` apply, for instance
+# `STAGING_FORMAT=binary CONSOLIDATION_MODE=incremental
+# CONSOLIDATION_CLOSE_AFTER=6`. The database
+# connection is resolved as for the tests, from the environment or from
+# `.env-dev`. Each run prints the wall time and throughput of every stage and
+# the peak memory, and appends them as a JSON line to `--output` along with
+# the settings, so that runs can be compared over time.
+#
+#   python src/airflow/test/bench_pipeline.py --hours 2 --output bench.jsonl
+
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+import pendulum
+from pathlib import Path
+from sqlalchemy import or_
+from dotenv import load_dotenv, find_dotenv
+
+load_dotenv(find_dotenv(".env-dev"))
+
+sys.path.insert(0, (Path(__file__).parent / "../dags").resolve().__str__())
+
+import models
+import dag_etl
+import environment
+from models import engine, ETL, Fact
+from preprocess import COLUMNS, MISSING_TIME
+from environment import AIRFLOW_IMPORT, TIMEZONE_OFFSET
+
+# seconds between pulls
+PULL_INTERVAL = 5 * 60
+
+# relative session starts by hour of the day
+DAILY_PROFILE = np.array(
+    [1, 1, 1, 1, 1, 2, 4, 8, 14, 18, 20, 20, 18, 20, 20, 18, 16, 12, 9, 7, 5, 3, 2, 1]
+)
+
+# settings recorded with each run
+SETTINGS = [
+    "STAGING_FORMAT",
+    "EXTRACT_MODE",
+    "RESOLVE_KEYS",
+    "PREPROCESS_CHUNKSIZE",
+    "PREPROCESS_LATEST_ONLY",
+    "INGEST_WORKERS",
+    "DAY_KEY",
+    "FACT_PARTITIONING",
+    "FACT_UPSERT",
+    "FACT_SESSION_KEY",
+    "CONSOLIDATION_MODE",
+    "FACT_INDEX_POLICY",
+    "FACT_INDEX_BUILD",
+]
+
+
+class TaskInstance:
+    """ task instance holding the configuration of an etl run. """
+
+    def __init__(self, config):
+        self.xcom = {"config": config}
+
+    def xcom_pull(self, key, task_ids):
+        return self.xcom[key]
+
+    def xcom_push(self, key, value):
+        self.xcom[key] = value
+
+
+def campus_sessions(args, start, end, rng):
+    """sessions of a synthetic campus, with epoch times in seconds.
+
+    Sessions start from 4 hours before `start`, so that the first pulls find
+    sessions already open.
+    """
+
+    buildings = max(args.aps // 30, 1)
+    devices = 1 + rng.poisson(args.devices - 1, args.users)
+    user = np.repeat(np.arange(args.users), devices)
+    device = np.concatenate([np.arange(n) for n in devices])
+    home = rng.integers(0, buildings, args.users)[user]
+    protocol = rng.choice(["802.11ac", "802.11n", "802.11ax"], len(user))
+
+    history = 4 * 60 * 60
+    hours = (end - start + history) / 3600
+    count = rng.poisson(args.sessions_per_hour * hours, len(user))
+    idx = np.repeat(np.arange(len(user)), count)
+    n = len(idx)
+
+    # starts follow the daily profile, offsets within the hour are uniform
+    first_hour = (start - history) // 3600
+    last_hour = -(-end // 3600)
+    hour = np.arange(first_hour, last_hour)
+    local_hour = (hour * 3600 + TIMEZONE_OFFSET) // 3600 % 24
+    weights = DAILY_PROFILE[local_hour] / DAILY_PROFILE[local_hour].sum()
+    session_start = rng.choice(hour, n, p=weights) * 3600 + rng.integers(0, 3600, n)
+    duration = np.exp(rng.normal(np.log(args.duration * 60), 1, n)).astype(np.int64)
+    duration = np.maximum(duration, 1)
+
+    # most sessions take place in the home building, the others at popular
+    # access points anywhere on campus
+    aps_per_building = max(args.aps // buildings, 1)
+    local_ap = home[idx] * aps_per_building + rng.integers(0, aps_per_building, n)
+    popular_ap = np.minimum(rng.zipf(1.5, n) - 1, args.aps - 1)
+    roaming = rng.random(n) < args.roaming
+    ap = np.where(roaming, popular_ap, local_ap)
+
+    return pd.DataFrame(
+        {
+            "username": [f"bench{u:06x}" for u in user[idx]],
+            "macaddress": [f"bench{u:06x}:{d}" for u, d in zip(user[idx], device[idx])],
+            "protocol": protocol[idx],
+            "apname": [f"BENCH-{a // aps_per_building}-{a}" for a in ap],
+            "location": [f"Campus > BENCH-{a // aps_per_building}" for a in ap],
+            "ssid": rng.choice(["campus", "eduroam", "guest"], n, p=[0.8, 0.15, 0.05]),
+            "start": session_start,
+            "end": session_start + duration,
+            "rssi": np.clip(rng.normal(-65, 10, n), -90, -30).astype(int),
+        }
+    )
+
+
+def write_pulls(sessions, directory, start, end, duplicates, rng):
+    """write a pull file every 5 minutes between `start` and `end`.
+
+    Each pull holds the sessions open at the pull time and those which ended
+    since the previous pull. Returns the configuration of each pull file.
+    """
+
+    pulls = []
+    for pulltime in range(start + PULL_INTERVAL, end + 1, PULL_INTERVAL):
+        pulled = sessions[
+            (sessions["start"] <= pulltime)
+            & (sessions["end"] > pulltime - PULL_INTERVAL)
+        ]
+        df = pd.DataFrame(
+            {
+                "username": pulled["username"],
+                "macaddress": pulled["macaddress"],
+                "protocol": pulled["protocol"],
+                "apname": pulled["apname"],
+                "location": pulled["location"],
+                "ssid": pulled["ssid"],
+                "sessionstarttime": pulled["start"] * 1000,
+                "sessionendtime": np.where(
+                    pulled["end"] <= pulltime,
+                    pulled["end"] * 1000,
+                    (MISSING_TIME - TIMEZONE_OFFSET) * 1000,
+                ),
+                "pulltime": pulltime,
+                "rssi": pulled["rssi"],
+            },
+            columns=COLUMNS,
+        )
+        df = pd.concat([df, df[rng.random(len(df)) < duplicates]])
+
+        local = pendulum.from_timestamp(pulltime + TIMEZONE_OFFSET)
+        file_stem = f"{local.format('YYYY_MM_DD_HH_mm_ss')}-v2"
+        file_name = directory / f"{file_stem}.tsv"
+        df.to_csv(file_name, sep="\t", header=False, index=False)
+
+        pulls.append(
+            {
+                "file_name": f"{file_name}",
+                "file_stem": file_stem,
+                "pulltime": str(local.naive()),
+                "rows": len(df),
+            }
+        )
+    return pulls
+
+
+def peak_memory():
+    """ peak resident memory of this process and of its children, in MB. """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(own / 1024, 1), round(children / 1024, 1)
+
+
+def drop(dates):
+    """ drop the daily fact and delta tables of the given dates. """
+    for date in dates:
+        for table in [Fact.child_or_load_table(date), Fact.delta_table(date)]:
+            table.drop(engine, checkfirst=True)
+            models.Base.metadata.remove(table)
+
+
+def run(args, pulls, dates):
+    """ingest and consolidate the pull files, timing every stage.
+
+    The dates of the daily tables are added to `dates` as they are touched, so
+    that they can be dropped even if the run fails.
+    """
+
+    stages = {"preprocess": 0.0, "ingest": 0.0, "consolidate": 0.0}
+    touched = set()
+
+    def consolidate(final=False):
+        start = time.perf_counter()
+        for date in sorted(touched):
+            Fact.consolidate(date, final)
+        stages["consolidate"] += time.perf_counter() - start
+        touched.clear()
+
+    for i in range(0, len(pulls), args.batch):
+        batch = pulls[i : i + args.batch]
+        hex = hashlib.sha1(f"{pendulum.now()}{batch[0]['file_name']}".encode())
+        hex = hex.hexdigest()
+        config = {
+            **batch[0],
+            "extract_table": f"etl.x{hex}",
+            "load_table": f"etl.l{hex}",
+            "batch": batch,
+        }
+        task_instance = TaskInstance(config)
+
+        start = time.perf_counter()
+        dag_etl.preprocess_callable(ti=task_instance)
+        stages["preprocess"] += time.perf_counter() - start
+
+        staged = sorted(AIRFLOW_IMPORT.glob(f"{config['file_stem']}_*"))
+        for file_path in staged:
+            date = pendulum.from_format(file_path.stem[23:], "YYYY_MM_DD").naive()
+            touched.add(date)
+            dates.add(date)
+
+        start = time.perf_counter()
+        dag_etl.ingest_callable(ti=task_instance)
+        stages["ingest"] += time.perf_counter() - start
+
+        for file_path in staged:
+            file_path.unlink()
+
+        if (i // args.batch + 1) % args.consolidate_every == 0:
+            consolidate()
+
+    touched.update(dates)
+    consolidate(final=True)
+
+    with engine.begin() as conn:
+        facts = sum(
+            conn.execute(
+                f"SELECT COUNT(*) FROM {Fact.child_or_load_table(date).fullname}"
+            ).scalar()
+            for date in dates
+        )
+
+    return stages, facts
+
+
+def main(args):
+
+    logging.disable(logging.WARNING)
+    rng = np.random.default_rng(args.seed)
+
+    date = pendulum.parse(args.date)
+    start = date.int_timestamp - TIMEZONE_OFFSET
+    end = start + int(args.hours * 3600)
+    # the pull files may hold sessions started up to a day earlier
+    days = [date.subtract(days=1).naive(), date.naive(), date.add(days=1).naive()]
+    dates = set()
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        started = time.perf_counter()
+        sessions = campus_sessions(args, start, end, rng)
+        pulls = write_pulls(sessions, Path(tmp), start, end, args.duplicates, rng)
+        rows = sum(pull["rows"] for pull in pulls)
+        generated = time.perf_counter() - started
+        print(
+            f"{len(pulls)} pull files with {rows:,} rows "
+            f"from {len(sessions):,} sessions, generated in {generated:.1f}s."
+        )
+
+        drop(days)
+        try:
+            started = time.perf_counter()
+            stages, facts = run(args, pulls, dates)
+            elapsed = time.perf_counter() - started
+        finally:
+            drop(sorted(dates))
+            # etl statuses of the staged session files, named after the pulls
+            stems = [f"{AIRFLOW_IMPORT}/{pull['file_stem']}_" for pull in pulls]
+            with engine.begin() as conn:
+                conn.execute(
+                    ETL.__table__.delete().where(
+                        (ETL.task_type == "session_file")
+                        & or_(*[ETL.task_name.startswith(stem) for stem in stems])
+                    )
+                )
+
+    for stage, seconds in stages.items():
+        print(f"{stage:<12} {seconds:>8.2f}s {rows / seconds:>14,.0f} rows/s")
+    print(f"{'total':<12} {elapsed:>8.2f}s {rows / elapsed:>14,.0f} rows/s")
+    own, children = peak_memory()
+    print(f"Peak memory: {own} MB, {children} MB in worker processes.")
+    print(f"{facts:,} consolidated facts over {len(dates)} days.")
+
+    if args.output:
+        try:
+            commit = subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                capture_output=True,
+                text=True,
+                cwd=Path(__file__).parent,
+            ).stdout.strip()
+        except OSError:
+            commit = None
+        result = {
+            "timestamp": str(pendulum.now()),
+            "commit": commit,
+            "settings": {name: getattr(environment, name) for name in SETTINGS},
+            "args": vars(args),
+            "pulls": len(pulls),
+            "rows": rows,
+            "sessions": len(sessions),
+            "facts": facts,
+            "seconds": {**stages, "total": elapsed},
+            "rows_per_second": {
+                **{stage: rows / seconds for stage, seconds in stages.items()},
+                "total": rows / elapsed,
+            },
+            "peak_memory_mb": {"main": own, "workers": children},
+        }
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+        print(f"Results appended to {args.output}.")
+
+
+if __name__ == "__main__":
+
+    cli = argparse.ArgumentParser(description="Benchmark the whole pipeline.")
+    cli.add_argument(
+        "-d",
+        "--date",
+        default="1999-01-01",
+        help="date of the first pull, whose daily tables are dropped.",
+    )
+    cli.add_argument(
+        "-H", "--hours", default=2, type=float, help="hours of pull files."
+    )
+    cli.add_argument("-n", "--users", default=20000, type=int, help="users.")
+    cli.add_argument(
+        "-m", "--devices", default=1.6, type=float, help="average devices per user."
+    )
+    cli.add_argument("-a", "--aps", default=3000, type=int, help="access points.")
+    cli.add_argument(
+        "-r",
+        "--sessions-per-hour",
+        default=0.3,
+        type=float,
+        help="average sessions per device and hour.",
+    )
+    cli.add_argument(
+        "-t",
+        "--duration",
+        default=20,
+        type=float,
+        help="median session duration in minutes.",
+    )
+    cli.add_argument(
+        "-g",
+        "--roaming",
+        default=0.3,
+        type=float,
+        help="fraction of sessions outside the home building.",
+    )
+    cli.add_argument(
+        "-u",
+        "--duplicates",
+        default=0.01,
+        type=float,
+        help="fraction of rows pulled twice.",
+    )
+    cli.add_argument(
+        "-b", "--batch", default=1, type=int, help="pull files per etl run."
+    )
+    cli.add_argument(
+        "-c",
+        "--consolidate-every",
+        default=1,
+        type=int,
+        help="etl runs between consolidations.",
+    )
+    cli.add_argument("-s", "--seed", default=0, type=int, help="random seed.")
+    cli.add_argument(
+        "-o", "--output", default=None, help="file to append the results to."
+    )
+    main(cli.parse_args())
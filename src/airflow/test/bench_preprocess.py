@@ -0,0 +1,169 @@
+#!/bin/python
+#
+# PREPROCESS BENCHMARK
+# ====================
+#
+# Compares the throughput of the legacy preprocessing routine, which converted
+# timestamps with pandas datetime operations, bucketed rows by date with a
+# per-row lambda and formatted timestamps with strftime for every group, with
+# the vectorized routine in `src/airflow/dags/preprocess.py`.
+#
+# Both routines are run against the same synthetic pull file and write their
+# per-date csv files to a temporary directory. Only pandas and numpy are
+# required, the database is not touched.
+#
+#   python src/airflow/test/bench_preprocess.py --rows 1000000
+
+import sys
+import csv
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.insert(0, (Path(__file__).parent / "../dags").resolve().__str__())
+
+from preprocess import (
+    COLUMNS,
+    MISSING_TIME,
+    DateWriter,
+    DuplicateFilter,
+    read_pull_file,
+    transform,
+)
+from environment import TIMEZONE_OFFSET
+
+
+def synthetic_pull_file(file_path, rows, seed=0):
+    """write a raw pull file with `rows` sessions pulled at a single time.
+
+    Session starts are spread over the 3 days before the pull, a third of the
+    sessions are still open and about 1 percent of the rows are duplicated.
+    """
+
+    rng = np.random.default_rng(seed)
+    pulltime = 1585699200
+    users = rng.integers(0, max(rows // 10, 1), rows)
+    start = (pulltime - rng.integers(0, 3 * 24 * 60 * 60, rows)) * 1000
+    start += rng.integers(0, 1000, rows)
+    end = start + rng.integers(0, 4 * 60 * 60 * 1000, rows)
+    end[rng.random(rows) < 1 / 3] = (MISSING_TIME - TIMEZONE_OFFSET) * 1000
+
+    df = pd.DataFrame(
+        {
+            "username": [f"u{u:x}" for u in users],
+            "macaddress": [f"m{u:x}{d}" for u, d in zip(users, users % 3)],
+            "protocol": rng.choice(["802.11ac", "802.11n", "802.11g"], rows),
+            "apname": [f"AP-{a}" for a in rng.integers(0, 5000, rows)],
+            "location": "Campus > Building > Floor",
+            "ssid": rng.choice(["campus", "guest", "eduroam"], rows),
+            "sessionstarttime": start,
+            "sessionendtime": end,
+            "pulltime": pulltime,
+            "rssi": rng.integers(-90, -30, rows),
+        },
+        columns=COLUMNS,
+    )
+    duplicates = df.sample(frac=0.01, random_state=seed)
+    df = pd.concat([df, duplicates])
+    df.to_csv(file_path, sep="\t", header=False, index=False)
+
+    return len(df)
+
+
+def legacy_preprocess(file_name, directory, file_stem):
+    """ preprocessing routine as implemented before vectorization. """
+
+    df = pd.read_csv((file_name), header=None, sep="\t", quoting=csv.QUOTE_NONE)
+    df.columns = COLUMNS
+    df.fillna("N/A", inplace=True)
+
+    df["sessionstarttime"] = pd.to_datetime(df["sessionstarttime"], unit="ms").dt.floor(
+        "s"
+    )
+    df["sessionendtime"] = pd.to_datetime(df["sessionendtime"], unit="ms").dt.floor("s")
+    df["pulltime"] = pd.to_datetime(df["pulltime"], unit="s")
+
+    timezone_offset = pd.Timedelta("8 hours")
+    df["sessionstarttime"] = df["sessionstarttime"] + timezone_offset
+    df["sessionendtime"] = df["sessionendtime"] + timezone_offset
+    df["pulltime"] = df["pulltime"] + timezone_offset
+
+    df = df[-df.duplicated()]
+
+    missing_time = pd.to_datetime("2100-01-01 00:00:00") + timezone_offset
+    df.loc[df.sessionendtime == missing_time, "sessionendtime"] = np.nan
+
+    for date, group in df.groupby(df["sessionstarttime"].map(lambda x: x.date())):
+        date_str = date.strftime("%Y_%m_%d")
+        group_file_path = Path(directory) / f"{file_stem}_{date_str}.csv"
+        group = group.copy()
+        group.loc[:, "sessionstarttime"] = group["sessionstarttime"].dt.strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+        group.loc[:, "sessionendtime"] = group["sessionendtime"].dt.strftime(
+            "%Y-%m-%d %H:%M:%S"
+        )
+        group.loc[group.sessionendtime == "NaT", "sessionendtime"] = ""
+        group.loc[:, "pulltime"] = group["pulltime"].dt.strftime("%Y-%m-%d %H:%M:%S")
+        group.to_csv(group_file_path, index=False)
+
+
+def vectorized_preprocess(file_name, directory, file_stem, chunksize=None):
+    """ preprocessing routine as run by `dag_etl.preprocess_callable`. """
+
+    writer = DateWriter(directory, file_stem, lambda path, date_str: True)
+    remove_duplicates = DuplicateFilter()
+    for df in read_pull_file(file_name, chunksize):
+        writer.write(remove_duplicates(transform(df)))
+
+
+def bench(name, rows, func, *args):
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {elapsed:>8.2f}s {rows / elapsed:>14,.0f} rows/s")
+    return elapsed
+
+
+def main(args):
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        file_stem = "2020_04_01_00_00_00-v2"
+        file_name = tmp / f"{file_stem}.tsv"
+        rows = synthetic_pull_file(file_name, args.rows, args.seed)
+        print(f"Synthetic pull file with {rows:,} rows.")
+
+        (tmp / "legacy").mkdir()
+        (tmp / "vectorized").mkdir()
+        before = bench("legacy", rows, legacy_preprocess, file_name, tmp / "legacy", file_stem)
+        after = bench(
+            "vectorized",
+            rows,
+            vectorized_preprocess,
+            file_name,
+            tmp / "vectorized",
+            file_stem,
+            args.chunksize,
+        )
+        print(f"Speed-up: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+
+    cli = argparse.ArgumentParser(description="Benchmark the preprocess stage.")
+    cli.add_argument(
+        "-r", "--rows", default=1000000, type=int, help="rows in the pull file."
+    )
+    cli.add_argument(
+        "-c",
+        "--chunksize",
+        default=None,
+        type=int,
+        help="rows read at a time by the vectorized routine.",
+    )
+    cli.add_argument("-s", "--seed", default=0, type=int, help="random seed.")
+    main(cli.parse_args())
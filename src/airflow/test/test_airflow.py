@@ -1,12 +1,15 @@
 import os
 import sys
 import pytest
+import argparse
+import importlib
 import logging
 import hashlib
 import pendulum
+import pandas as pd
 
 from pathlib import Path
-from sqlalchemy import and_, delete, select
+from sqlalchemy import and_, delete, literal, select
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv(".env-dev"))
@@ -14,7 +17,20 @@ os.chdir(Path(find_dotenv(".env-dev")).parent)
 
 sys.path.insert(0, Path("src/airflow/dags").resolve().__str__())
 
-from models import engine, Session, ETL, ETLStatus, Fact
+import models
+from models import (
+    engine,
+    Session,
+    ETL,
+    ETLLatest,
+    ETLStatus,
+    DimensionCache,
+    Fact,
+    Metric,
+    SessionDay,
+    SSID,
+    Watermark,
+)
 from environment import (
     AIRFLOW_DATA,
     AIRFLOW_RAW,
@@ -22,8 +38,12 @@ from environment import (
     WIFI_CONN,
     POSTGRES_IMPORT,
 )
-from dag_etl_sensor import sense_callable as etl_sense_callable
+import dag_etl
+import dag_etl_sensor
+from dag_etl_sensor import sense_callable as etl_sense_callable, batch_work
 from dag_etl import preprocess_callable
+from preprocess import COLUMNS, STAGING_SUFFIXES, DateWriter, LatestPullFilter
+import dag_consolidate_sensor
 from dag_consolidate_sensor import sense_callable as consolidate_sense_callable
 from dag_consolidate import consolidate_callable
 
@@ -51,7 +71,8 @@ class TaskInstanceMock:
                 with engine.begin() as conn:
                     conn.execute(delete(ETL).where(ETL.task_name == f"{file_path}"))
 
-                file_task_dict = mock_sensor.xcom_pull(f"{file_path}", "sense")
+                work = mock_sensor.xcom_pull("work", "sense")
+                file_task_dict = work[f"{file_path}"]
                 ti = cls("init")
                 ti.xcom_push("config", file_task_dict["config"])
 
@@ -201,12 +222,12 @@ def clean_etl():
 
 def test_etl_sensor(mock_sensor):
 
-    files = mock_sensor.xcom_pull("files", "sense")
-    assert len(files) == 4
-    assert len(mock_sensor._xcom["sense"]) == (len(files) + 1)
+    work = mock_sensor.xcom_pull("work", "sense")
+    assert len(work) == 4
+    assert len(mock_sensor._xcom["sense"]) == 1
 
-    file_path = files[0]
-    file_task_dict = mock_sensor.xcom_pull(file_path, "sense")
+    file_path = list(work.keys())[0]
+    file_task_dict = work[file_path]
     file_config = file_task_dict["config"]
     run_id = file_task_dict["run_id"]
 
@@ -216,6 +237,29 @@ def test_etl_sensor(mock_sensor):
     assert file_config["load_table"][5:] == file_config["extract_table"][5:]
 
 
+def test_etl_batches(mock_sensor):
+
+    work = mock_sensor.xcom_pull("work", "sense")
+
+    batches = batch_work(work)
+    assert len(batches) == len(work)
+    assert all(len(batch["config"]["batch"]) == 1 for batch in batches)
+
+    batches = batch_work(work, size=len(work))
+    assert len(batches) == 1
+    batch_config = batches[0]["config"]
+    first = list(work.values())[0]
+    assert batches[0]["run_id"] == first["run_id"]
+    assert batch_config["extract_table"] == first["config"]["extract_table"]
+    assert [c["file_name"] for c in batch_config["batch"]] == list(work.keys())
+
+    batches = batch_work(work, size=len(work), window=5)
+    assert sum(len(batch["config"]["batch"]) for batch in batches) == len(work)
+    for batch in batches:
+        pulltimes = [pendulum.parse(c["pulltime"]) for c in batch["config"]["batch"]]
+        assert pulltimes[-1] <= pulltimes[0].add(minutes=5)
+
+
 def test_etl_states(session, task_instance):
 
     ti = task_instance(AIRFLOW_RAW / "2020_04_01_00_00_00-v2.tsv")
@@ -260,6 +304,50 @@ def test_etl_states(session, task_instance):
         ETL.set_status("quarantine", file_name, pulltime, "completed", session)
 
 
+def test_etl_can_process_many(session, mock_etl):
+
+    date = pendulum.from_format("2020_02_01", "YYYY_MM_DD").naive()
+
+    mock_etl("session_file", "foo", date, "ongoing")
+    mock_etl("session_file", "foo", date, "completed")
+    mock_etl("session_file", "bar", date, "ongoing")
+    mock_etl("session_file", "bar", date, "quarantine")
+
+    tasks = [("foo", date), ("bar", str(date)), ("baz", date)]
+    assert ETL.can_process_many("session_file", tasks, session) == [
+        ETL.can_process("session_file", *task, session) for task in tasks
+    ]
+    assert ETL.can_process_many("session_file", tasks, session) == [
+        False,
+        True,
+        True,
+    ]
+
+
+def test_etl_install(session, monkeypatch):
+
+    monkeypatch.setattr(ETL, "installed", False)
+
+    date = pendulum.from_format("2020_02_01", "YYYY_MM_DD").naive()
+
+    # installing leaves the pending work of the session alone
+    session.add(ETL("session_file", "install", date, "ongoing"))
+    session.flush()
+    ETL.install()
+    session.rollback()
+    assert ETL.get_most_recent("session_file", "install", date, session) is None
+
+    with engine.begin() as conn:
+        triggered = conn.execute(
+            """
+            SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = 'etl.etl_latest'::REGCLASS AND attname = 'triggered'
+            """
+        ).scalar()
+    assert triggered == "timestamp without time zone"
+    assert not ETLLatest.__table__.c.triggered.type.timezone
+
+
 def test_preprocess(preprocess):
 
     file_stem = "2020_04_01_00_00_00-v2"
@@ -279,6 +367,104 @@ def test_preprocess(preprocess):
     assert (lines_before + 24) == lines_after
 
 
+def test_preprocess_chunked(preprocess, task_instance, monkeypatch):
+
+    file_stem = "2020_04_01_00_00_00-v2"
+    file_path = AIRFLOW_RAW / f"{file_stem}.tsv"
+    preprocess(file_path)
+
+    expected = {}
+    for f in AIRFLOW_IMPORT.glob(f"{file_stem}_*.csv"):
+        expected[f.name] = sorted(open(f))
+
+    monkeypatch.setattr(dag_etl, "PREPROCESS_CHUNKSIZE", 7)
+    ti = task_instance(file_path)
+    preprocess_callable(ti=ti)
+
+    new_files = list(AIRFLOW_IMPORT.glob(f"{file_stem}_*.csv"))
+    assert len(new_files) == 24
+
+    for f in new_files:
+        # rows are written in chunk order, but the content must be the same
+        assert sorted(open(f)) == expected[f.name]
+
+
+def test_preprocess_latest_only():
+
+    def pull(pulltime, rows):
+        df = pd.DataFrame(
+            [
+                ["u", mac, "p", "ap", "loc", "ssid", start, end, pulltime, -60]
+                for mac, start, end in rows
+            ],
+            columns=COLUMNS,
+        )
+        return df.astype({c: "datetime64[ns]" for c in COLUMNS[6:9]})
+
+    remove_superseded = LatestPullFilter()
+
+    # files are filtered from the most recent to the oldest
+    df = remove_superseded(
+        pull("2020-04-01 00:10", [("a", "2020-04-01", "2020-04-01 00:08")])
+    )
+    assert len(df) == 1
+    assert str(df["sessionendtime"].iloc[0]) == "2020-04-01 00:08:00"
+
+    df = remove_superseded(
+        pull(
+            "2020-04-01 00:05",
+            [("a", "2020-04-01", None), ("b", "2020-04-01", None)],
+        )
+    )
+    assert list(df["macaddress"]) == ["b"]
+
+
+def test_staging_binary(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(models, "AIRFLOW_IMPORT", tmp_path)
+    monkeypatch.setattr(models, "EXTRACT_MODE", "copy")
+    monkeypatch.setattr(models, "RESOLVE_KEYS", "client")
+
+    # open sessions, a session ending at a later time and a second date
+    df = pd.DataFrame(
+        [
+            ["u1", "m1", "p", "ap", "loc", "ssid", "2020-04-01 00:00:01", None],
+            ["u2", "m2", "p", "ap", "loc", "ssid", "2020-04-01 10:00", "2020-04-02"],
+            ["u3", "m3", "p", "ap", "N/A", "ssid", "2020-04-02 23:59:59", None],
+        ],
+        columns=COLUMNS[:8],
+    )
+    df["pulltime"] = "2020-04-03 00:00:00"
+    df["rssi"] = pd.array([-60, None, -70], dtype="Int64")
+    df = df.astype({c: "datetime64[ns]" for c in COLUMNS[6:9]})
+    for i, dimension in enumerate(Fact.dimensions):
+        df[dimension.fact_key] = pd.array([i + 1, None, 100000 + i], dtype="Int64")
+
+    tables = {}
+    for format in ["csv", "binary"]:
+        writer = DateWriter(tmp_path, "2020_04_03_00_00_00-v2", lambda *_: True, format)
+        writer.write(df)
+        writer.close()
+
+        name = f"etl.x_staging_{format}"
+        rows = []
+        for file_path in sorted(tmp_path.glob(f"*{STAGING_SUFFIXES[format]}")):
+            extract = Fact.extract_table(file_path.name, name)
+            with engine.begin() as conn:
+                extract.create(bind=conn, checkfirst=True)
+                conn.execute(extract.delete())
+                Fact.copy_extract(extract, file_path.name, conn)
+                rows += conn.execute(extract.select()).fetchall()
+            Fact.remove_tables(name)
+        tables[format] = sorted(tuple(row) for row in rows)
+
+    assert len(tables["binary"]) == 3
+    assert tables["binary"] == tables["csv"]
+    # missing end times, rssi and keys are loaded as nulls
+    assert sum(row[7] is None for row in tables["binary"]) == 2
+    assert tables["binary"][1][9:] == (None,) * (1 + len(Fact.dimensions))
+
+
 def test_ingest_preprocessed(ingest):
 
     file_stem = "2020_04_01_00_00_00-v2"
@@ -298,6 +484,235 @@ def test_ingest_preprocessed(ingest):
         assert count == 104
 
 
+def test_ingest_preprocessed_copy(ingest, monkeypatch):
+
+    monkeypatch.setattr(models, "EXTRACT_MODE", "copy")
+
+    file_stem = "2020_04_01_00_00_00-v2"
+    file_path = Path(f"tmp/raw/{file_stem}_2020_03_27.csv")
+    ingest(file_path)
+
+    date = pendulum.from_format(file_path.stem[23:], "YYYY_MM_DD").naive()
+    child_fact = Fact.child_or_load_table(date)
+
+    with engine.begin() as conn:
+        count = conn.execute(child_fact.select()).rowcount
+        assert count == 104
+
+        count = conn.execute(
+            child_fact.select(child_fact.c.session_end == None)
+        ).rowcount
+        assert count == 104
+
+
+def test_ingest_upsert(ingest, monkeypatch):
+
+    monkeypatch.setattr(models, "FACT_UPSERT", True)
+
+    file_stem = "2020_04_01_00_00_00-v2"
+    file_path = Path(f"tmp/raw/{file_stem}_2020_03_27.csv")
+    ingest(file_path)
+    ingest(file_path)
+
+    date = pendulum.from_format(file_path.stem[23:], "YYYY_MM_DD").naive()
+    child_fact = Fact.child_or_load_table(date)
+
+    with engine.begin() as conn:
+        count = conn.execute(child_fact.select()).rowcount
+        assert count == 104
+
+        unique = conn.execute(
+            f"""
+            SELECT indisunique FROM pg_index
+            WHERE indexrelid =
+                'fact.ix_fact_{child_fact.name}_session_pulltime'::REGCLASS
+            """
+        ).scalar()
+        assert unique
+
+
+def test_ingest_session_key(ingest, monkeypatch):
+
+    monkeypatch.setattr(models, "FACT_SESSION_KEY", True)
+
+    file_stem = "2020_04_01_00_00_00-v2"
+    file_path = Path(f"tmp/raw/{file_stem}_2020_03_27.csv")
+    ingest(file_path)
+
+    date = pendulum.from_format(file_path.stem[23:], "YYYY_MM_DD").naive()
+    child_fact = Fact.child_or_load_table(date)
+    session = ", ".join(Fact.session_columns)
+
+    with engine.begin() as conn:
+        keys, sessions = conn.execute(
+            f"""
+            SELECT COUNT(DISTINCT session_key), COUNT(DISTINCT ({session}))
+            FROM {child_fact.fullname}
+            WHERE session_key IS NOT NULL
+            """
+        ).fetchone()
+        assert keys == sessions
+        assert keys > 0
+
+
+def test_ingest_workers(preprocess, clean_etl, monkeypatch):
+
+    monkeypatch.setattr(dag_etl, "INGEST_WORKERS", 4)
+
+    file_stem = "2020_04_01_00_00_00-v2"
+    ti = preprocess(AIRFLOW_RAW / f"{file_stem}.tsv")
+    file_config = ti.xcom_pull("config", "init")
+
+    dates = []
+    rows = 0
+    for f in AIRFLOW_IMPORT.glob(f"{file_stem}_*.csv"):
+        date = pendulum.from_format(f.stem[23:], "YYYY_MM_DD").naive()
+        clean_etl("session_file", f"{f}", date)
+        dates.append(date)
+        # staged files contain header
+        rows += sum(1 for _ in open(f)) - 1
+
+    dag_etl.ingest_callable(ti=ti)
+
+    tables = [Fact.child_or_load_table(date) for date in dates]
+    auxiliary = f"^({file_config['extract_table'][4:]}|{file_config['load_table'][4:]})"
+    with engine.begin() as conn:
+        count = sum(conn.execute(table.select()).rowcount for table in tables)
+        assert count == rows
+
+        count = conn.execute(
+            f"SELECT COUNT(*) FROM pg_tables WHERE tablename ~ '{auxiliary}'"
+        ).scalar()
+        assert count == 0
+
+    Fact.remove_tables(*[table.fullname for table in tables])
+
+
+def test_ingest_file_failure(tmp_path, clean_etl, monkeypatch):
+
+    monkeypatch.setattr(models, "AIRFLOW_IMPORT", tmp_path)
+    monkeypatch.setattr(models, "EXTRACT_MODE", "copy")
+
+    def fail(dates):
+        raise Exception("Failing after the auxiliary tables are created.")
+
+    monkeypatch.setattr(Fact, "create_partitions", fail)
+
+    file_path = tmp_path / "2020_04_01_00_00_00-v2_2020_03_27.csv"
+    file_path.write_text(",".join(COLUMNS) + "\n")
+    date = pendulum.from_format("2020_03_27", "YYYY_MM_DD").naive()
+    clean_etl("session_file", f"{file_path}", date)
+
+    names = ["etl.x_failure_2020_03_27", "etl.l_failure_2020_03_27"]
+    assert dag_etl.ingest_file(file_path, *names)
+
+    with engine.begin() as conn:
+        for name in names:
+            assert conn.execute(f"SELECT to_regclass('{name}')").scalar() is None
+    assert not any(name in models.Base.metadata.tables for name in names)
+
+
+def test_day_key():
+
+    pulltime = pendulum.parse("2020-04-01T23:59:59").naive()
+    with engine.begin() as conn:
+        key = conn.execute(select([SessionDay.key_of(literal(pulltime))])).scalar()
+    assert key == 20200401
+
+
+def test_dimension_cache_eviction():
+
+    names = [f"test_cache_{name}" for name in "abcde"]
+    cache = DimensionCache(SSID, 3)
+    cache.warm = True
+
+    with engine.begin() as conn:
+        keys = dict(zip(names, cache.resolve([(n,) for n in names[:3]], conn)))
+
+        # hits must survive the eviction of the misses of the same call
+        assert cache.resolve([(names[0],), (names[3],)], conn)[0] == keys[names[0]]
+        assert list(cache.keys) == [(names[2],), (names[0],), (names[3],)]
+
+        # more values than the cache holds
+        resolved = cache.resolve([(n,) for n in names], conn)
+        assert resolved[:3] == [keys[n] for n in names[:3]]
+        assert len(cache.keys) == 3
+        assert (cache.hits, cache.misses) == (1 + 3, 3 + 1 + 2)
+
+        conn.execute(SSID.__table__.delete().where(SSID.name.in_(names)))
+
+
+def test_update_dimension_existing_values(ingest):
+
+    file_stem = "2020_04_01_00_00_00-v2"
+    file_path = Path(f"tmp/raw/{file_stem}_2020_03_27.csv")
+    ingest(file_path)
+
+    def last_keys():
+        with engine.begin() as conn:
+            return [
+                conn.execute(f"SELECT last_value FROM {name}_key_seq").scalar()
+                for name in [d.__table__.fullname for d in Fact.dimensions]
+            ]
+
+    # values already in the dimensions do not draw keys from the sequences
+    before = last_keys()
+    ingest(file_path)
+    assert last_keys() == before
+
+
+def test_ingest_metrics(ingest, monkeypatch):
+
+    monkeypatch.setattr(models, "ETL_METRICS", True)
+    monkeypatch.setattr(models, "ETL_METRICS_EXPLAIN", True)
+
+    file_stem = "2020_04_01_00_00_00-v2"
+    file_path = Path(f"tmp/raw/{file_stem}_2020_03_27.csv")
+    ingest(file_path)
+
+    date = pendulum.from_format(file_path.stem[23:], "YYYY_MM_DD").naive()
+    child_fact = Fact.child_or_load_table(date)
+    metrics = Metric.__table__
+
+    with engine.begin() as conn:
+        # explained statements are rolled back before being executed
+        count = conn.execute(child_fact.select()).rowcount
+        assert count == 104
+
+        rows = conn.execute(
+            metrics.select().where(metrics.c.file_name == file_path.name)
+        ).fetchall()
+        conn.execute(metrics.delete().where(metrics.c.file_name == file_path.name))
+
+    stages = {row.stage: row for row in rows if row.statement is None}
+    assert {"extract", "dimensions", "load", "partitions", "insert"} <= set(stages)
+    assert all(row.seconds >= 0 for row in rows)
+    assert set(stages["dimensions"].details) == {
+        d.__tablename__ for d in Fact.dimensions
+    }
+
+    inserts = [row for row in rows if row.stage == "insert" and row.statement == 0]
+    assert inserts[0].rows == 104
+    assert inserts[0].details[0]["Plan"]["Node Type"] == "ModifyTable"
+
+
+def test_metrics_failed_statement(monkeypatch):
+
+    monkeypatch.setattr(models, "ETL_METRICS", True)
+
+    recorded = []
+    monkeypatch.setattr(Metric, "record", lambda *args: recorded.append(args[5]))
+
+    with Metric.measure("test", None, None), engine.connect() as conn:
+        with pytest.raises(Exception):
+            conn.execute("SELECT 1 / 0")
+        conn.execute("SELECT 1")
+        # nothing is left behind on the pooled connection by the failure
+        assert not conn.info.get("metrics")
+
+    assert [statement["sql"] for statement in recorded[0]] == ["SELECT 1"]
+
+
 def test_consolidate_sensor_without_prior_consolidation(session, mock_etl):
 
     date1 = pendulum.from_format("2020_02_01", "YYYY_MM_DD").naive()
@@ -370,7 +785,104 @@ def test_consolidate_sensor_all_done(session, mock_etl):
     assert len(sensor._xcom["sense"]) == 1
 
 
-def test_consolidate(ingest, clean_etl):
+def test_consolidate_sensor_watermark(session, mock_etl):
+
+    date = pendulum.from_format("2020_02_01", "YYYY_MM_DD").naive()
+
+    mock_etl("session_file", "foo", date, "completed")
+    assert date in ETL.ready_for_consolidation(session)
+
+    # the watermark stops before the session file waiting for consolidation
+    assert date in ETL.ready_for_consolidation(session)
+    ingested = session.execute(
+        select([ETL.triggered]).where(ETL.task_name == "foo")
+    ).scalar()
+    watermark = Watermark.get("consolidation", session)
+    assert watermark <= ingested
+
+    mock_etl("consolidation", "conso", date, "completed")
+    assert date not in ETL.ready_for_consolidation(session)
+
+
+def test_consolidate_sensor_min_interval(session, mock_etl, monkeypatch):
+
+    monkeypatch.setattr(dag_consolidate_sensor, "CONSOLIDATION_MIN_INTERVAL", 30)
+
+    date = pendulum.from_format("2020_02_01", "YYYY_MM_DD").naive()
+
+    mock_etl("session_file", "foo", date, "completed")
+    mock_etl("consolidation", "fact.session_2020_02_01", date, "completed")
+    mock_etl("session_file", "bar", date, "completed")
+
+    # the new file is left for a later consolidation
+    sensor = TaskInstanceMock("sense")
+    consolidate_sense_callable(ti=sensor)
+
+    tables = sensor.xcom_pull(key="tables", task_ids="sense")
+    assert "fact.session_2020_02_01" not in tables
+
+
+def test_consolidate_sensor_final(session, mock_etl, monkeypatch):
+
+    monkeypatch.setattr(dag_consolidate_sensor, "CONSOLIDATION_CLOSE_AFTER", 6)
+    monkeypatch.setattr(dag_consolidate_sensor, "SENSOR_WATERMARK", False)
+
+    date1 = pendulum.from_format("2020_02_01", "YYYY_MM_DD").naive()
+    date2 = pendulum.from_format("2020_04_01", "YYYY_MM_DD").naive()
+
+    # the watermark table is created on first use
+    Watermark.get("final_consolidation", session)
+    session.execute(delete(Watermark).where(Watermark.name == "final_consolidation"))
+    Watermark.set("final_consolidation", date1, session)
+
+    mock_etl("session_file", "foo", date1, "completed")
+    mock_etl("consolidation", "fact.session_2020_02_01", date1, "completed")
+    mock_etl("final_consolidation", "fact.session_2020_02_01", date1, "completed")
+    mock_etl("session_file", "bar", date2, "completed")
+    mock_etl("consolidation", "fact.session_2020_04_01", date2, "completed")
+
+    sensor = TaskInstanceMock("sense")
+    consolidate_sense_callable(ti=sensor)
+
+    # only the closed date without a final consolidation gets one
+    tables = sensor.xcom_pull(key="tables", task_ids="sense")
+    assert "fact.session_2020_02_01" not in tables
+    assert "fact.session_2020_04_01" in tables
+
+    table_task_dict = sensor.xcom_pull(key="fact.session_2020_04_01", task_ids="sense")
+    assert table_task_dict["config"]["final"]
+
+    # late files of a final date get another final consolidation
+    mock_etl("session_file", "baz", date1, "completed")
+
+    sensor = TaskInstanceMock("sense")
+    consolidate_sense_callable(ti=sensor)
+
+    table_task_dict = sensor.xcom_pull(key="fact.session_2020_02_01", task_ids="sense")
+    assert table_task_dict["config"]["final"]
+
+    session.execute(delete(Watermark).where(Watermark.name == "final_consolidation"))
+    session.commit()
+
+
+@pytest.mark.parametrize(
+    "mode, final",
+    [
+        ("update", False),
+        ("rebuild", False),
+        ("incremental", False),
+        ("incremental", True),
+    ],
+)
+def test_consolidate(ingest, clean_etl, monkeypatch, mode, final):
+
+    monkeypatch.setattr(models, "CONSOLIDATION_MODE", mode)
+    if final:
+        # final consolidations go over the whole table
+        def consolidate_delta(date, child_fact):
+            raise Exception("Consolidated the delta table only.")
+
+        monkeypatch.setattr(Fact, "consolidate_delta", consolidate_delta)
 
     date = pendulum.from_format("2020_03_27", "YYYY_MM_DD").naive()
 
@@ -378,13 +890,23 @@ def test_consolidate(ingest, clean_etl):
         file_path = Path(f"tmp/raw/{file_stem}_2020_03_27.csv")
         ingest(file_path)
 
+    delta = Fact.delta_table(date)
+    if mode == "incremental":
+        with engine.begin() as conn:
+            assert conn.execute(delta.select()).rowcount > 0
+
     table = Fact.child_or_load_table(date)
     task_instance = TaskInstanceMock("init")
-    task_instance.xcom_push("config", {"date": str(date), "table_name": table.fullname})
+    task_instance.xcom_push(
+        "config", {"date": str(date), "table_name": table.fullname, "final": final}
+    )
 
     clean_etl("consolidation", table.fullname, date)
+    clean_etl("final_consolidation", table.fullname, date)
     consolidate_callable(ti=task_instance)
 
+    session = ", ".join(Fact.session_columns)
+
     with engine.begin() as conn:
         count = conn.execute(table.select()).rowcount
         assert count == 198
@@ -417,3 +939,271 @@ def test_consolidate(ingest, clean_etl):
             )
         ).rowcount
         assert count1 == count2
+
+        # earlier pulls take the end, status and duration of their session's
+        # last pull
+        count = conn.execute(
+            f"""
+            SELECT COUNT(*)
+            FROM {table.fullname} T1
+            JOIN {table.fullname} T2
+            USING ({session})
+            WHERE NOT T1.pulltime_last AND T2.pulltime_last AND (
+                T1.pulltime >= T2.pulltime OR
+                (T1.session_end, T1.status, T1.session_duration)
+                IS DISTINCT FROM (T2.session_end, T2.status, T2.session_duration)
+            )
+            """
+        ).scalar()
+        assert count == 0
+
+        count = conn.execute(
+            table.select(
+                table.c.session_duration != table.c.session_end - table.c.session_start
+            )
+        ).rowcount
+        assert count == 0
+
+        if mode == "incremental" and not final:
+            count = conn.execute(delta.select()).rowcount
+            assert count == 0
+
+    if final:
+        # the delta table of a final date is dropped
+        assert not delta.exists(engine)
+        models.Base.metadata.remove(delta)
+    elif mode == "incremental":
+        Fact.remove_tables(delta.fullname)
+
+
+def test_consolidate_indices(ingest):
+
+    date = pendulum.from_format("2020_03_27", "YYYY_MM_DD").naive()
+
+    file_path = Path(f"tmp/raw/2020_04_01_00_00_00-v2_2020_03_27.csv")
+    ingest(file_path)
+
+    # consolidating again must neither fail nor add indices
+    Fact.consolidate(date)
+    Fact.consolidate(date)
+
+    table = Fact.child_or_load_table(date)
+    with engine.begin() as conn:
+        indices = conn.execute(
+            f"""
+            SELECT indexname FROM pg_indexes
+            WHERE schemaname = '{table.schema}' AND tablename = '{table.name}'
+            """
+        ).fetchall()
+
+    assert sorted(name for (name,) in indices) == sorted(
+        f"ix_fact_session_2020_03_27_{suffix}" for suffix in Fact.indices.keys()
+    )
+
+
+def test_attach_range_partition(monkeypatch, caplog):
+
+    monkeypatch.setattr(models, "FACT_PARTITIONING", "range")
+    # server messages are logged by the dialect
+    caplog.set_level(logging.INFO, logger="sqlalchemy.dialects.postgresql")
+
+    date = pendulum.from_format("2019_01_01", "YYYY_MM_DD").naive()
+    child_fact = Fact.child_or_load_table(date)
+
+    # fact.session is partitioned in a transaction which is rolled back
+    with engine.connect() as conn:
+        transaction = conn.begin()
+        conn.execute("ALTER TABLE fact.session RENAME TO session_inherit")
+        conn.execute(
+            """
+            CREATE TABLE fact.session (LIKE fact.session_inherit)
+            PARTITION BY RANGE (session_start)
+            """
+        )
+        child_fact.create(conn)
+        conn.execute("SET LOCAL client_min_messages = debug1")
+        caplog.clear()
+        Fact.attach(child_fact, date, conn)
+        partitions = conn.execute(
+            """
+            SELECT c.oid::REGCLASS::TEXT
+            FROM pg_inherits i JOIN pg_class c ON i.inhrelid = c.oid
+            WHERE i.inhparent = 'fact.session'::REGCLASS AND c.relispartition
+            """
+        ).fetchall()
+        transaction.rollback()
+
+    models.Base.metadata.remove(child_fact)
+    assert partitions == [(child_fact.fullname,)]
+    # the constraints of the daily table spare attaching it a scan
+    assert "is implied by existing constraints" in caplog.text
+
+
+def test_etl_sensor_partitions_ahead(monkeypatch):
+
+    monkeypatch.setattr(dag_etl_sensor, "FACT_PARTITIONING", "range")
+    monkeypatch.setattr(dag_etl_sensor, "FACT_PARTITIONS_AHEAD", 2)
+
+    created = []
+    monkeypatch.setattr(Fact, "create_partitions", lambda dates: created.extend(dates))
+
+    sensor = TaskInstanceMock("sense")
+    etl_sense_callable(ti=sensor)
+    work = sensor.xcom_pull("work", "sense")
+
+    # the days around the pull time of each queued file
+    days = set()
+    for file_task_dict in work.values():
+        pulltime = pendulum.parse(file_task_dict["config"]["pulltime"]).naive()
+        day = pulltime.start_of("day")
+        days.update(day.add(days=i) for i in range(-1, 3))
+    assert len(work) > 0
+    assert created == sorted(days)
+
+
+def test_etl_sensor_watermark(tmp_path, monkeypatch, session):
+
+    monkeypatch.setattr(dag_etl_sensor, "SENSOR_WATERMARK", True)
+    monkeypatch.setattr(dag_etl_sensor, "AIRFLOW_RAW", tmp_path)
+
+    stems = [f"2019_01_01_00_0{i}_00-v2" for i in range(5)]
+    files = [tmp_path / f"{stem}.tsv" for stem in stems]
+    pulltimes = [
+        pendulum.from_format(stem, "YYYY_MM_DD_HH_mm_ss[-v2]").naive()
+        for stem in stems
+    ]
+    for file_name in files:
+        file_name.touch()
+
+    def cleanup():
+        with engine.begin() as conn:
+            conn.execute(delete(ETL).where(ETL.task_name.in_(map(str, files))))
+        Watermark.get("pull_file", session)
+        session.execute(delete(Watermark).where(Watermark.name == "pull_file"))
+        session.commit()
+
+    def sense():
+        sensor = TaskInstanceMock("sense")
+        etl_sense_callable(ti=sensor)
+        return set(sensor.xcom_pull("work", "sense"))
+
+    cleanup()
+    try:
+        for i, status in [(0, "completed"), (1, "quarantine"), (2, "completed")]:
+            ETL.set_status("pull_file", files[i], pulltimes[i], status, session)
+
+        # the watermark moves past the quarantined file
+        assert sense() == {str(files[i]) for i in [1, 3, 4]}
+        assert Watermark.get("pull_file", session) == pulltimes[2]
+
+        # which is still retried, the name of the completed file is skipped
+        files[0].rename(tmp_path / "2019_01_01_00_00_00x-v2.tsv")
+        assert sense() == {str(files[i]) for i in [1, 3, 4]}
+
+        ETL.set_status("pull_file", files[3], pulltimes[3], "quarantine", session)
+        ETL.set_status("pull_file", files[4], pulltimes[4], "completed", session)
+        assert sense() == {str(files[i]) for i in [1, 3]}
+        assert Watermark.get("pull_file", session) == pulltimes[4]
+
+        # quarantined files gone from the raw directory are not retried
+        files[1].unlink()
+        assert sense() == {str(files[3])}
+    finally:
+        cleanup()
+
+
+@pytest.fixture(scope="module")
+def user_mac_classification():
+
+    # executables import their helpers from bin/__init__.py as a module
+    bin_path = Path("bin").resolve().__str__()
+    sys.path.insert(0, bin_path)
+    yield importlib.import_module("01_user_mac_classification")
+    sys.path.remove(bin_path)
+
+
+def test_user_mac_classification(ingest, mock_etl, user_mac_classification):
+
+    classification = user_mac_classification
+    args = argparse.Namespace(
+        short_ratio=0.1, short_minutes=10, long_hours=24, workers=2
+    )
+
+    date = pendulum.from_format("2020_03_27", "YYYY_MM_DD").naive()
+    table_name = f"fact.session_{date.format('YYYY_MM_DD')}"
+
+    def snapshot():
+        with engine.begin() as conn:
+            rows = conn.execute(
+                """
+                SELECT userid_key, mac_key, day_key, mobile, main
+                FROM dimension.userid_mac
+                """
+            )
+            return sorted(rows.fetchall())
+
+    def reset():
+        with engine.begin() as conn:
+            conn.execute("DROP TABLE IF EXISTS dimension.userid_mac")
+            conn.execute("DROP TABLE IF EXISTS dimension.userid_mac_day")
+            conn.execute(f"DROP TABLE IF EXISTS {classification.THRESHOLDS}")
+            classification.create_daily_table(conn)
+            conn.execute(
+                f"""
+                DELETE FROM etl.watermark
+                WHERE name = '{classification.WATERMARK}'
+                """
+            )
+
+    def full(args):
+        reset()
+        classification.create_dimension_table(engine)
+        classification.classify_as_mobile(engine, args)
+        classification.classify_as_main(engine)
+        return snapshot()
+
+    def consolidate(file_stem):
+        ingest(Path(f"tmp/raw/{file_stem}_2020_03_27.csv"))
+        Fact.consolidate(date)
+        mock_etl("consolidation", table_name, date, "completed")
+
+    with engine.begin() as conn:
+        pull_hours_missing = conn.execute(
+            f"SELECT pull_hours_missing FROM dimension.day WHERE day = '{date}'"
+        ).scalar()
+        conn.execute(
+            f"UPDATE dimension.day SET pull_hours_missing = 0 WHERE day = '{date}'"
+        )
+
+    try:
+        reset()
+
+        # incremental runs classify pairs as a full run does
+        consolidate("2020_03_27_00_00_00-v2")
+        classification.classify_incrementally(engine, args)
+        consolidate("2020_04_01_00_00_00-v2")
+        classification.classify_incrementally(engine, args)
+        incremental = snapshot()
+        assert len(incremental) > 0
+        assert incremental == full(args)
+
+        # incremental runs with other thresholds classify all pairs again
+        for thresholds in [
+            {"short_minutes": 30},
+            {"short_ratio": 0.3},
+            {"long_hours": 1},
+        ]:
+            changed = argparse.Namespace(**{**vars(args), **thresholds})
+            full(args)
+            classification.classify_incrementally(engine, changed)
+            assert snapshot() == full(changed)
+
+    finally:
+        reset()
+        with engine.begin() as conn:
+            conn.execute(
+                f"""
+                UPDATE dimension.day SET pull_hours_missing = {pull_hours_missing}
+                WHERE day = '{date}'
+                """
+            )